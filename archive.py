@@ -0,0 +1,75 @@
+import threading
+from datetime import datetime, timedelta
+
+from database_root import session_per_update, ARCHIVE_RECORDS
+from settings import ARCHIVE_INTERVAL_SECONDS, ARCHIVE_BATCH_SIZE, ARCHIVE_PAUSE_SECONDS, ARCHIVE_AFTER_HOURS, \
+    OUTBOX_MAX_ATTEMPTS
+
+
+# Фоновый перенос прошедших и отменённых записей из records в records_archive. Раз в ARCHIVE_INTERVAL_SECONDS
+# переносятся все записи, закончившиеся больше ARCHIVE_AFTER_HOURS часов назад, пачками по ARCHIVE_BATCH_SIZE:
+# каждая пачка — своя короткая транзакция, а между пачками пауза ARCHIVE_PAUSE_SECONDS, чтобы запись
+# пользователей не ждала блокировку БД. Так в records остаются только будущие записи, сколько бы лет ни работал бот
+class RecordArchiver:
+    def __init__(self, interval=ARCHIVE_INTERVAL_SECONDS, batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_PAUSE_SECONDS,
+                 keep=timedelta(hours=ARCHIVE_AFTER_HOURS)):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.keep = keep
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self.stats = {"archived": 0, "batches": 0}
+
+    # Все накопившиеся записи; возвращает число перенесённых
+    def run_once(self, now=None):
+        before = (now or datetime.now()) - self.keep
+        archived = 0
+        while not self._stopped:
+            moved = _archive(before, self.batch_size)
+            archived += moved
+            self.stats["archived"] += moved
+            self.stats["batches"] += 1
+            if moved < self.batch_size:
+                break
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(self.pause)
+        return archived
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name='archive', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Не удалось перенести записи в архив: {e}")
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(self.interval)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+
+@session_per_update
+def _archive(before, limit):
+    return ARCHIVE_RECORDS(before, limit, OUTBOX_MAX_ATTEMPTS)
+
+
+record_archiver = RecordArchiver()
+
+
+def start_archive():
+    record_archiver.start()
@@ -0,0 +1,97 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from database_root import *
+from settings import ASYNC_DB_THREADS
+
+# SQLite и ORM остаются синхронными: асинхронные версии методов выполняют их в отдельном пуле потоков,
+# у каждого из которых своя сессия. Цикл событий при этом никогда не ждёт БД и продолжает обслуживать
+# остальные чаты. Сессия закрывается после каждого вызова, поэтому возвращаемые объекты отсоединены
+# от неё: все ленивые связи нужно загружать внутри функции, переданной в run_in_db_thread
+_db_executor = ThreadPoolExecutor(max_workers=ASYNC_DB_THREADS, thread_name_prefix='db')
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Контекст копируется, чтобы SQL-запросы в потоке БД попадали в метрики апдейта, который их вызвал
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_db_executor, partial(context.run, session_per_update(func), *args, **kwargs))
+
+
+def _refreshed(obj):
+    # После commit объект просрочен; загружаем его поля, пока сессия ещё открыта
+    if obj is not None and obj in cur_session:
+        cur_session.refresh(obj)
+    return obj
+
+
+class AsyncDatabaseService:
+    def __init__(self, service):
+        self.service = service
+
+    async def commit(self):
+        return await run_in_db_thread(self.service.commit)
+
+    async def add(self, obj):
+        return await run_in_db_thread(lambda: _refreshed(self.service.add(obj) or obj))
+
+    async def get(self, model, obj_id):
+        return await run_in_db_thread(self.service.get, model, obj_id)
+
+    async def get_by_key(self, model, key, value):
+        return await run_in_db_thread(self.service.get_by_key, model, key, value)
+
+    async def update(self, model, obj_id, **kwargs):
+        return await run_in_db_thread(lambda: _refreshed(self.service.update(model, obj_id, **kwargs)))
+
+    async def delete(self, model, obj_id):
+        return await run_in_db_thread(self.service.delete, model, obj_id)
+
+    async def list(self, model):
+        return await run_in_db_thread(self.service.list, model)
+
+    async def list_with_filter(self, model, key, value):
+        return await run_in_db_thread(self.service.list_with_filter, model, key, value)
+
+
+async_db_service = AsyncDatabaseService(db_service)
+
+
+def _to_async(func, materialize=None):
+    # materialize превращает ленивые результаты (Query, связи) в список, пока сессия открыта
+    def call(*args, **kwargs):
+        result = func(*args, **kwargs)
+        return materialize(result) if materialize else result
+
+    async def wrapper(*args, **kwargs):
+        return await run_in_db_thread(call, *args, **kwargs)
+    wrapper.__name__ = f"{func.__name__}_ASYNC"
+    return wrapper
+
+
+SET_USER_CITY_ASYNC = _to_async(SET_USER_CITY)
+ADD_USER_TO_BD_ASYNC = _to_async(ADD_USER_TO_BD)
+ADD_PREUSER_TO_BD_ASYNC = _to_async(ADD_PREUSER_TO_BD)
+ADD_PREPREUSER_TO_BD_ASYNC = _to_async(ADD_PREPREUSER_TO_BD)
+GET_USER_ASYNC = _to_async(GET_USER)
+GET_USER_STATE_ASYNC = _to_async(GET_USER_STATE)
+CHECK_PREPREUSER_ASYNC = _to_async(CHECK_PREPREUSER)
+CHECK_PREUSER_ASYNC = _to_async(CHECK_PREUSER)
+CHECK_USER_ASYNC = _to_async(CHECK_USER)
+GET_TYPE_ASYNC = _to_async(GET_TYPE)
+GET_TYPES_ASYNC = _to_async(GET_TYPES)
+GET_CITY_ASYNC = _to_async(GET_CITY)
+GET_CITY_OBJECT_ASYNC = _to_async(GET_CITY_OBJECT)
+GET_CITIES_ASYNC = _to_async(GET_CITIES)
+GET_CENTERS_BY_TYPE_ASYNC = _to_async(GET_CENTERS_BY_TYPE, materialize=list)
+GET_CENTERS_BY_TYPE_AND_CITY_ASYNC = _to_async(GET_CENTERS_BY_TYPE_AND_CITY)
+GET_CENTER_ASYNC = _to_async(GET_CENTER)
+GET_PLACES_BY_CENTER_ASYNC = _to_async(GET_PLACES_BY_CENTER)
+GET_PLACES_BY_CENTER_AND_CITY_ASYNC = _to_async(GET_PLACES_BY_CENTER_AND_CITY, materialize=list)
+GET_PLACES_ASYNC = _to_async(GET_PLACES)
+GET_PLACE_ASYNC = _to_async(GET_PLACE)
+GET_SERVICE_ASYNC = _to_async(GET_SERVICE)
+GET_SERVICES_BY_PLACE_ASYNC = _to_async(GET_SERVICES_BY_PLACE, materialize=list)
+GET_ACTIVE_RECORD_INTERVALS_ASYNC = _to_async(GET_ACTIVE_RECORD_INTERVALS)
@@ -0,0 +1,77 @@
+import asyncio
+
+from telebot.async_telebot import AsyncTeleBot
+
+import screens
+from archive import start_archive
+from async_database import run_in_db_thread
+from metrics import instrument_update_async, start_metrics_export
+from outbox import outbox_dispatcher
+from reminders import reminder_scheduler
+from wizard import start_wizard_flush
+from renderer import render_async
+from router import router
+
+try:
+    from config import API_KEY
+except Exception as e:
+    print("Ошибка получения ключа бота из файла config.py: {}".format(e))
+    exit()
+
+# Асинхронный режим бота: те же экраны, что и в main.py, но сетевые запросы к Telegram не блокируют потоки,
+# а обращения к БД выполняются в пуле потоков из async_database.py
+bot = AsyncTeleBot(API_KEY)
+
+
+async def send_replies(message, replies, edit=False):
+    await render_async(bot, message, replies, edit=edit)
+
+
+@bot.message_handler(commands=['start'])
+@instrument_update_async("start")
+async def start(message):
+    await send_replies(message, await run_in_db_thread(screens.on_start, message))
+
+
+@bot.message_handler(commands=['report'])
+@instrument_update_async("report")
+async def report(message):
+    await send_replies(message, await run_in_db_thread(screens.on_report, message))
+
+
+@bot.message_handler(func=lambda message: True)
+@instrument_update_async("handle_message")
+async def handle_message(message):
+    await send_replies(message, await run_in_db_thread(screens.on_message, message))
+
+
+@bot.message_handler(content_types=['contact'])
+@instrument_update_async("contact")
+async def contact(message):
+    await send_replies(message, await run_in_db_thread(screens.on_contact, message))
+
+
+@bot.callback_query_handler(func=lambda call: True)
+@instrument_update_async("callback", label=lambda call: f"callback/{router.route_name(call.data)}")
+async def callback_inline(call):
+    if call.data:
+        await send_replies(call.message, await run_in_db_thread(screens.on_callback, call), edit=True)
+
+
+async def main():
+    # Напоминания и уведомления салонам рассылаются из своих потоков через цикл событий бота
+    loop = asyncio.get_running_loop()
+
+    def send(chat_id, text):
+        return asyncio.run_coroutine_threadsafe(bot.send_message(chat_id, text), loop)
+
+    reminder_scheduler.start(send)
+    outbox_dispatcher.start(send)
+    start_wizard_flush()
+    start_archive()
+    await bot.polling(none_stop=True)
+
+
+if __name__ == "__main__":
+    start_metrics_export()
+    asyncio.run(main())
@@ -0,0 +1,301 @@
+from bisect import bisect_left
+from datetime import date, datetime, timedelta, time
+from threading import Lock, RLock
+
+import cache_bus
+from database_root import GET_ACTIVE_RECORD_INTERVALS, GET_ACTIVE_SLOT_HOLDS, CANCEL_USER_RECORD, HOLD_SLOT, \
+    RELEASE_SLOT_HOLDS, ADD_RECORD_IF_FREE, GET_PLACE_OCCUPANCY
+from catalog import catalog
+from reminders import reminder_scheduler
+from settings import WORK_DAY_START_HOUR, WORK_DAY_END_HOUR, SLOT_STEP_MINUTES, SLOT_HOLD_SECONDS, \
+    AVAILABILITY_LOCK_STRIPES, BOOKING_DAYS_AHEAD
+
+
+class SlotIsBusy(Exception):
+    pass
+
+
+# Слот, который нельзя занять независимо от расписания: уже прошёл, не на сетке, вне рабочего дня или окна записи,
+# или в салоне нет такой услуги (например, кнопка из старого сообщения)
+class SlotIsInvalid(SlotIsBusy):
+    pass
+
+
+# Расписание одного салона: отсортированный список непересекающихся интервалов записей.
+# Так как интервалы не пересекаются, списки начал и концов отсортированы одновременно,
+# и любой конфликт проверяется одним бинарным поиском.
+# Отдельно хранятся временные брони слотов (не больше одной на пользователя): их немного, и они скоро истекают
+class PlaceSchedule:
+    def __init__(self, intervals=(), holds=()):
+        self.starts = list()
+        self.ends = list()
+        self.record_ids = list()
+        for record_id, start, end in sorted(intervals, key=lambda interval: interval[1]):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.record_ids.append(record_id)
+        self.holds = {user_id: (start, end, expires_at) for user_id, start, end, expires_at in holds}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def has_conflict(self, start, end, user_id=None, now=None):
+        # Последний интервал, который начинается раньше конца нового, единственный кандидат на пересечение
+        index = bisect_left(self.starts, end)
+        if index > 0 and self.ends[index - 1] > start:
+            return True
+        return any(hold_start < end and hold_end > start for hold_start, hold_end in self.held(user_id, now))
+
+    def held(self, user_id=None, now=None):
+        # Действующие брони других пользователей; просроченные удаляются по ходу
+        now = now or datetime.now()
+        result = list()
+        for hold_user_id, (start, end, expires_at) in list(self.holds.items()):
+            if expires_at <= now:
+                del self.holds[hold_user_id]
+            elif hold_user_id != user_id:
+                result.append((start, end))
+        return result
+
+    def add(self, record_id, start, end):
+        index = bisect_left(self.starts, start)
+        self.starts.insert(index, start)
+        self.ends.insert(index, end)
+        self.record_ids.insert(index, record_id)
+
+    def remove(self, record_id):
+        if record_id in self.record_ids:
+            index = self.record_ids.index(record_id)
+            del self.starts[index], self.ends[index], self.record_ids[index]
+
+    def hold(self, user_id, start, end, expires_at):
+        self.holds[user_id] = (start, end, expires_at)
+
+    def release_hold(self, user_id):
+        self.holds.pop(user_id, None)
+
+    def busy_between(self, start, end):
+        first = bisect_left(self.starts, start)
+        if first > 0 and self.ends[first - 1] > start:
+            first -= 1
+        last = bisect_left(self.starts, end)
+        return list(zip(self.starts[first:last], self.ends[first:last]))
+
+    def free_slots(self, day, duration, now=None, user_id=None):
+        day_start = datetime.combine(day, time(hour=WORK_DAY_START_HOUR))
+        day_end = datetime.combine(day, time(hour=WORK_DAY_END_HOUR))
+        step = timedelta(minutes=SLOT_STEP_MINUTES)
+        duration = timedelta(minutes=duration)
+
+        candidate = day_start
+        if now is not None and now > candidate:
+            candidate = _align(now, day_start, step)
+
+        busy = self.busy_between(day_start, day_end)
+        held = [(start, end) for start, end in self.held(user_id, now) if start < day_end and end > day_start]
+        if held:
+            busy = sorted(busy + held)
+
+        result = list()
+        for busy_start, busy_end in busy + [(day_end, day_end)]:
+            while candidate + duration <= busy_start:
+                result.append(candidate)
+                candidate += step
+            if busy_end > candidate:
+                candidate = _align(busy_end, day_start, step)
+        return result
+
+
+def _align(moment, origin, step):
+    # Округление вверх до ближайшего шага сетки слотов, отсчитанной от начала рабочего дня
+    steps = -(-(moment - origin) // step)
+    return origin + steps * step
+
+
+# Индекс расписаний по салонам. Расписание салона загружается из БД один раз при первом обращении,
+# а дальше поддерживается в памяти при каждой новой записи, брони или отмене.
+# Вместо одной общей блокировки у каждого салона своя из AVAILABILITY_LOCK_STRIPES блокировок (по place_id),
+# так что запись в разные салоны идёт параллельно. Индекс только отсекает заведомо занятые слоты:
+# окончательная проверка делается в БД в той же транзакции, что и вставка (HOLD_SLOT, ADD_RECORD_IF_FREE),
+# поэтому двойная запись невозможна и тогда, когда бот запущен в нескольких процессах со своими индексами
+class AvailabilityIndex:
+    def __init__(self, loader=GET_ACTIVE_RECORD_INTERVALS, holds_loader=GET_ACTIVE_SLOT_HOLDS,
+                 stripes=AVAILABILITY_LOCK_STRIPES):
+        self._loader = loader
+        self._holds_loader = holds_loader
+        self._schedules = dict()
+        self._schedules_lock = Lock()
+        self._held_places = dict()
+        self._stripes = [RLock() for _ in range(stripes)]
+
+    def lock(self, place_id):
+        return self._stripes[int(place_id) % len(self._stripes)]
+
+    def schedule(self, place_id):
+        place_id = int(place_id)
+        schedule = self._schedules.get(place_id)
+        if schedule is None:
+            with self.lock(place_id):
+                schedule = self._schedules.get(place_id)
+                if schedule is None:
+                    now = datetime.now()
+                    schedule = PlaceSchedule(self._loader(place_id, now), self._holds_loader(place_id, now))
+                    with self._schedules_lock:
+                        self._schedules[place_id] = schedule
+        return schedule
+
+    def has_conflict(self, place_id, start, end, user_id=None):
+        with self.lock(place_id):
+            return self.schedule(place_id).has_conflict(start, end, user_id=user_id)
+
+    def free_slots(self, place_id, day, duration, now=None, user_id=None):
+        with self.lock(place_id):
+            return self.schedule(place_id).free_slots(day, duration, now=now, user_id=user_id)
+
+    def reserve(self, place_id, user_id, start, end, create, apply):
+        # create() проверяет и вставляет строку в БД одной транзакцией и возвращает None, если слот уже занят
+        # (например, другим процессом, о котором этот индекс не знает): тогда расписание перечитывается из БД.
+        # apply(schedule, result) обновляет расписание под той же блокировкой салона
+        with self.lock(place_id):
+            schedule = self.schedule(place_id)
+            if schedule.has_conflict(start, end, user_id=user_id):
+                raise SlotIsBusy(f"Слот {start} в салоне {place_id} уже занят")
+            result = create()
+            if result is None:
+                self.invalidate(place_id)
+                raise SlotIsBusy(f"Слот {start} в салоне {place_id} уже занят")
+            apply(schedule, result)
+        # В БД у пользователя остаётся не больше одной брони, поэтому бронь в другом салоне больше не действует
+        with self._schedules_lock:
+            previous_place_id = self._held_places.pop(user_id, None)
+        if previous_place_id is not None and previous_place_id != int(place_id):
+            self.release_hold(previous_place_id, user_id)
+        return result
+
+    def remember_hold(self, place_id, user_id):
+        with self._schedules_lock:
+            self._held_places[user_id] = int(place_id)
+
+    def release(self, place_id, record_id):
+        with self.lock(place_id):
+            self.schedule(place_id).remove(record_id)
+
+    def release_hold(self, place_id, user_id):
+        with self.lock(place_id):
+            schedule = self._schedules.get(int(place_id))
+            if schedule is not None:
+                schedule.release_hold(user_id)
+        with self._schedules_lock:
+            if self._held_places.get(user_id) == int(place_id):
+                del self._held_places[user_id]
+
+    def invalidate(self, place_id=None):
+        with self._schedules_lock:
+            if place_id is None:
+                self._schedules.clear()
+            else:
+                self._schedules.pop(int(place_id), None)
+
+
+availability_index = AvailabilityIndex()
+# Запись, бронь или отмена в другом процессе бота: расписание салона перечитается из БД при следующем обращении
+cache_bus.subscribe('availability', lambda place_id: availability_index.invalidate(place_id))
+
+
+def _longest_service():
+    return timedelta(minutes=max((service.duration for service in catalog.snapshot().service_by_id.values()),
+                                 default=0))
+
+
+def GET_FREE_SLOTS(place_id, service_id, day, user_id=None):
+    service = catalog.snapshot().service_by_id[int(service_id)]
+    return availability_index.free_slots(place_id, day, service.duration, now=datetime.now(), user_id=user_id)
+
+
+def HAS_FREE_SLOTS(place_id, service_id, day, user_id=None):
+    return len(GET_FREE_SLOTS(place_id, service_id, day, user_id=user_id)) > 0
+
+
+# Дни из [first_day, last_day], в которые у салона остаётся время на услугу, по place_day_occupancy — один запрос
+# на весь месяц. День занят, если свободных минут меньше длительности услуги; день, где минут хватает, но они
+# разбиты на короткие промежутки, остаётся свободным, и точные слоты показывает уже выбор времени.
+# Сегодняшний день проверяется точно по расписанию: часть его уже прошла
+def GET_FREE_DAYS(place_id, service_id, first_day, last_day, user_id=None):
+    duration = catalog.snapshot().service_by_id[int(service_id)].duration
+    work_minutes = (WORK_DAY_END_HOUR - WORK_DAY_START_HOUR) * 60
+    busy = GET_PLACE_OCCUPANCY(int(place_id), first_day, last_day)
+    today = date.today()
+    result = set()
+    for offset in range((last_day - first_day).days + 1):
+        day = first_day + timedelta(days=offset)
+        if day == today:
+            if HAS_FREE_SLOTS(place_id, service_id, day, user_id=user_id):
+                result.add(day)
+        elif work_minutes - busy.get(day, 0) >= duration:
+            result.add(day)
+    return result
+
+
+# Слот приходит из callback_data, поэтому перед бронью и записью он проверяется так же, как его строит
+# free_slots. Возвращает время окончания услуги
+def _check_slot(place_id, service_id, start_date, now):
+    snapshot = catalog.snapshot()
+    if service_id not in {service.id for service in snapshot.services_by_place.get(place_id, ())}:
+        raise SlotIsInvalid(f"В салоне {place_id} нет услуги {service_id}")
+    end_date = start_date + timedelta(minutes=snapshot.service_by_id[service_id].duration)
+    day_start = datetime.combine(start_date.date(), time(hour=WORK_DAY_START_HOUR))
+    if start_date <= now or start_date.date() >= now.date() + timedelta(days=BOOKING_DAYS_AHEAD):
+        raise SlotIsInvalid(f"Слот {start_date} вне окна записи")
+    if start_date < day_start or end_date > datetime.combine(start_date.date(), time(hour=WORK_DAY_END_HOUR)) or \
+            (start_date - day_start) % timedelta(minutes=SLOT_STEP_MINUTES):
+        raise SlotIsInvalid(f"Слот {start_date} не на сетке рабочего дня")
+    return end_date
+
+
+# Бронь слота на SLOT_HOLD_SECONDS, пока пользователь подтверждает запись. Возвращает время окончания брони
+def HOLD_RECORD(user_id, place_id, service_id, start_date, index=availability_index):
+    place_id, service_id = int(place_id), int(service_id)
+    now = datetime.now()
+    end_date = _check_slot(place_id, service_id, start_date, now)
+    expires_at = now + timedelta(seconds=SLOT_HOLD_SECONDS)
+    index.reserve(place_id, user_id, start_date, end_date,
+                  lambda: HOLD_SLOT(user_id, place_id, service_id, start_date, end_date, expires_at, now,
+                                    _longest_service()),
+                  lambda schedule, hold_id: schedule.hold(user_id, start_date, end_date, expires_at))
+    index.remember_hold(place_id, user_id)
+    cache_bus.publish('availability', place_id)
+    return expires_at
+
+
+# Пользователь ушёл с подтверждения записи: слот сразу освобождается для остальных, а не через SLOT_HOLD_SECONDS
+def RELEASE_HOLD(user_id, place_id, index=availability_index):
+    RELEASE_SLOT_HOLDS(user_id)
+    index.release_hold(place_id, user_id)
+    cache_bus.publish('availability', int(place_id))
+
+
+def BOOK_RECORD(user_id, place_id, service_id, start_date, index=availability_index):
+    place_id, service_id = int(place_id), int(service_id)
+    now = datetime.now()
+    end_date = _check_slot(place_id, service_id, start_date, now)
+
+    def apply(schedule, record):
+        schedule.add(record.id, start_date, end_date)
+        schedule.release_hold(user_id)
+
+    record = index.reserve(place_id, user_id, start_date, end_date,
+                           lambda: ADD_RECORD_IF_FREE(user_id, place_id, service_id, start_date, end_date, now,
+                                                      _longest_service()),
+                           apply)
+    reminder_scheduler.schedule(record.id, start_date)
+    cache_bus.publish('availability', place_id)
+    return record
+
+
+def CANCEL_RECORD(user_id, record_id):
+    record = CANCEL_USER_RECORD(user_id, record_id)
+    if record:
+        availability_index.release(record.place_id, record.id)
+        reminder_scheduler.cancel(record.id)
+        cache_bus.publish('availability', record.place_id)
+    return record
@@ -0,0 +1,114 @@
+# Конкурентная запись: много потоков одновременно бронируют и подтверждают слоты, в основном в одном популярном
+# салоне. Сравниваются одна общая блокировка (--stripes 1) и блокировки по салонам, а также два индекса
+# расписаний над одной БД (как два процесса бота). В конце проверяется, что в БД нет пересекающихся записей.
+# Запуск из корня репозитория: python -m benchmarks.booking_contention --workers 1,4,16,32 --seconds 3
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from availability import AvailabilityIndex, HOLD_RECORD, BOOK_RECORD, SlotIsBusy
+from benchmarks.synthetic_data import SCALES, generate
+from catalog import catalog
+from database_root import session_per_update, db_service, Place, ServicePlace
+from service_index import service_index
+from settings import AVAILABILITY_LOCK_STRIPES, BOOKING_DAYS_AHEAD
+
+
+@session_per_update
+def load_targets():
+    links = db_service.session.query(ServicePlace.place_id, ServicePlace.service_id) \
+        .join(Place, Place.id == ServicePlace.place_id).order_by(ServicePlace.place_id).all()
+    by_place = dict()
+    for place_id, service_id in links:
+        by_place.setdefault(place_id, service_id)
+    return sorted(by_place.items())
+
+
+@session_per_update
+def try_booking(index, user_id, place_id, service_id, day, rnd):
+    duration = catalog.snapshot().service_by_id[service_id].duration
+    slots = index.free_slots(place_id, day, duration, now=datetime.now(), user_id=user_id)
+    if not slots:
+        return "full"
+    start = rnd.choice(slots)
+    HOLD_RECORD(user_id, place_id, service_id, start, index=index)
+    BOOK_RECORD(user_id, place_id, service_id, start, index=index)
+    return "booked"
+
+
+@session_per_update
+def count_overlaps():
+    return db_service.session.execute(text(
+        "SELECT COUNT(*) FROM records a JOIN records b ON a.place_id = b.place_id AND a.id < b.id "
+        "AND a.active AND b.active AND a.start_date < b.end_date AND b.start_date < a.end_date "
+        "WHERE a.start_date >= :since"), {"since": datetime.combine(date.today(), datetime.min.time())}).scalar()
+
+
+def run(workers, seconds, stripes, indexes, popular_share, days):
+    generate(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'booking.db')}", SCALES["small"]._replace(records_per_user=0))
+    catalog.invalidate()
+    service_index.invalidate()
+    targets = load_targets()
+    popular = targets[0]
+    index_list = [AvailabilityIndex(stripes=stripes) for _ in range(indexes)]
+    counts = {"booked": 0, "busy": 0, "full": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(num):
+        rnd = random.Random(num)
+        index = index_list[num % indexes]
+        user_id = 1 + num
+        while time.perf_counter() < deadline:
+            place_id, service_id = popular if rnd.random() < popular_share else rnd.choice(targets)
+            day = date.today() + timedelta(days=1 + rnd.randrange(days))
+            try:
+                result = try_booking(index, user_id, place_id, service_id, day, rnd)
+            except SlotIsBusy:
+                result = "busy"
+            except OperationalError:
+                result = "errors"
+            with lock:
+                counts[result] += 1
+
+    threads = [threading.Thread(target=worker, args=(num,)) for num in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    attempts = sum(counts.values())
+    return {"workers": workers, "stripes": stripes, "indexes": indexes, "seconds": round(elapsed, 2),
+            "attempts": attempts, **counts, "attempts_per_s": round(attempts / elapsed, 1),
+            "bookings_per_s": round(counts["booked"] / elapsed, 1), "overlapping_records": count_overlaps()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,4,16,32")
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--popular-share", type=float, default=0.8, help="доля попыток в популярный салон")
+    parser.add_argument("--days", type=int, default=BOOKING_DAYS_AHEAD - 1,
+                        help="на сколько дней вперёд бронируют (не больше BOOKING_DAYS_AHEAD - 1)")
+    args = parser.parse_args()
+
+    results = list()
+    for workers in (int(value) for value in args.workers.split(",")):
+        for stripes, indexes in ((1, 1), (AVAILABILITY_LOCK_STRIPES, 1), (AVAILABILITY_LOCK_STRIPES, 2)):
+            results.append(run(workers, args.seconds, stripes, indexes, args.popular_share, args.days))
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if any(result["overlapping_records"] for result in results):
+        raise SystemExit("Найдены пересекающиеся записи")
+
+
+if __name__ == '__main__':
+    main()
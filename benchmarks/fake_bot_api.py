@@ -0,0 +1,186 @@
+# Локальная замена Bot API для нагрузочных тестов без интернета. Понимает методы, которыми пользуется бот
+# (sendMessage, editMessageText, deleteMessage, answerCallbackQuery, getMe, getUpdates), отвечает 429
+# с retry_after при превышении общего лимита или лимита на чат и считает все запросы.
+# Запуск отдельно: python -m benchmarks.fake_bot_api --port 8081
+import argparse
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+from telebot import apihelper
+
+from send_queue import TokenBucket
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake Beauty Planner", "username": "fake_beauty_planner_bot"}
+
+
+class FakeBotApi:
+    def __init__(self, host='127.0.0.1', port=0, global_rate=30, global_burst=30, chat_rate=1, chat_burst=3,
+                 latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.rejected = 0
+        self.updates = deque()
+        self._global_rate = (global_rate, global_burst)
+        self._chat_rate = (chat_rate, chat_burst)
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = dict()
+        self._message_id = 0
+        self._update_id = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def install(self):
+        apihelper.API_URL = self.url + "/bot{0}/{1}"
+        return self
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        apihelper.API_URL = None
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.rejected = 0
+            self._global = TokenBucket(*self._global_rate)
+            self._chats.clear()
+
+    # Входящие апдейты, которые бот получит через getUpdates
+    def push_update(self, update):
+        with self._lock:
+            self._update_id += 1
+            update = dict(update, update_id=self._update_id)
+            self.updates.append(update)
+            return update
+
+    def push_message(self, chat_id, text):
+        return self.push_update({"message": self._message(chat_id, text, from_user={
+            "id": chat_id, "is_bot": False, "first_name": f"user {chat_id}"})})
+
+    def push_callback(self, chat_id, data, message_id=1):
+        return self.push_update({"callback_query": {
+            "id": str(self._update_id), "chat_instance": str(chat_id), "data": data,
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user {chat_id}"},
+            "message": self._message(chat_id, "", message_id=message_id)}})
+
+    def _message(self, chat_id, text, message_id=None, from_user=None):
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        return {"message_id": message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": int(chat_id), "type": "private"}, "from": from_user or BOT_USER}
+
+    def _rate_limited(self, chat_id):
+        now = time.monotonic()
+        with self._lock:
+            buckets = [self._global]
+            if chat_id is not None:
+                bucket = self._chats.get(chat_id)
+                if bucket is None:
+                    bucket = self._chats[chat_id] = TokenBucket(*self._chat_rate)
+                buckets.append(bucket)
+            delay = max(cur_bucket.delay(now) for cur_bucket in buckets)
+            if delay > 0:
+                self.rejected += 1
+                return max(1, round(delay))
+            for cur_bucket in buckets:
+                cur_bucket.take(now)
+            return None
+
+    def handle(self, method, params):
+        with self._lock:
+            self.calls[method] += 1
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0) or 0)
+            with self._lock:
+                while self.updates and self.updates[0]["update_id"] < offset:
+                    self.updates.popleft()
+                result = list(self.updates)[:int(params.get('limit', 100) or 100)]
+            if not result:
+                time.sleep(min(float(params.get('timeout', 0) or 0), 0.05))
+            return result
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = params.get('chat_id')
+        if method == 'sendMessage':
+            with self._lock:
+                return self._message(chat_id, params.get('text', ''))
+        if method == 'editMessageText':
+            return self._message(chat_id, params.get('text', ''), message_id=int(params.get('message_id', 0)))
+        return True
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                url = urlparse(self.path)
+                parts = url.path.strip('/').split('/')
+                if parts == ['stats']:
+                    return self._reply(200, {"calls": dict(api.calls), "rejected": api.rejected})
+                method = parts[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode()
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body))
+                if method not in ('getMe', 'getUpdates'):
+                    retry_after = api._rate_limited(params.get('chat_id'))
+                    if retry_after is not None:
+                        return self._reply(429, {"ok": False, "error_code": 429,
+                                                 "description": f"Too Many Requests: retry after {retry_after}",
+                                                 "parameters": {"retry_after": retry_after}})
+                self._reply(200, {"ok": True, "result": api.handle(method, params)})
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--global-rate", type=float, default=30)
+    parser.add_argument("--chat-rate", type=float, default=1)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    api = FakeBotApi(port=args.port, global_rate=args.global_rate, chat_rate=args.chat_rate, latency=args.latency)
+    print(f"Fake Bot API: {api.url}/bot<token>/<method>, статистика: {api.url}/stats")
+    api._server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
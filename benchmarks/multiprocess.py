@@ -0,0 +1,113 @@
+# Пропускная способность обычного режима (main.py: один процесс, пул потоков telebot) против многопроцессного
+# (workers.py: Supervisor и N процессов-обработчиков). Оба режима получают одни и те же апдейты из FakeBotApi
+# через getUpdates, а время считается до того, как на каждый апдейт ушёл ответ в Bot API.
+# Запуск из корня репозитория: python -m benchmarks.multiprocess --scale medium --updates 2000 --processes 1,2,4
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+from benchmarks.fake_bot_api import FakeBotApi
+from benchmarks.synthetic_data import SCALES, generate
+from database_root import session_per_update, db_service, ServicePlace
+from handlers import create_bot
+from router import router
+from workers import Supervisor
+
+TOKEN = "123:fake"
+UNLIMITED = 10 ** 6
+# Очередь отправки не должна ограничивать замер: FakeBotApi отвечает без лимитов
+FAST_SEND = {"global_rate": UNLIMITED, "global_burst": UNLIMITED, "chat_rate": UNLIMITED, "chat_burst": UNLIMITED}
+RESPONSES = ('sendMessage', 'editMessageText', 'deleteMessage')
+
+
+@session_per_update
+def load_links():
+    return db_service.session.query(ServicePlace.place_id, ServicePlace.service_id).all()
+
+
+# Нажатия на кнопки от пользователей синтетической БД; на каждое нажатие бот отвечает одной правкой сообщения
+def make_updates(count, users, links, seed=0):
+    rnd = random.Random(seed)
+    screens = [lambda: router.encode("main_menu"), lambda: router.encode("start_record_by_type"),
+               lambda: router.encode("show_records"),
+               lambda: router.encode("choose_record_time", *rnd.choice(links), date.today() + timedelta(days=1))]
+    return [(rnd.randint(1, users), rnd.choice(screens)()) for _ in range(count)]
+
+
+def responses(api):
+    return sum(api.calls[method] for method in RESPONSES)
+
+
+def push_and_wait(api, updates, timeout):
+    api.reset()
+    api.updates.clear()
+    started = time.perf_counter()
+    for chat_id, data in updates:
+        api.push_callback(chat_id, data)
+    deadline = started + timeout
+    while responses(api) < len(updates) and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return time.perf_counter() - started, responses(api)
+
+
+def run_single(api, updates, timeout):
+    bot, send_queue = create_bot(TOKEN, **FAST_SEND)
+    thread = threading.Thread(target=bot.polling, kwargs={"none_stop": True, "interval": 0, "timeout": 1},
+                              daemon=True)
+    thread.start()
+    push_and_wait(api, updates[:50], timeout)
+    elapsed, done = push_and_wait(api, updates, timeout)
+    bot.stop_polling()
+    thread.join()
+    send_queue.close()
+    return {"mode": "single", "processes": 1, "seconds": round(elapsed, 3), "responses": done,
+            "updates_per_s": round(done / elapsed, 1)}
+
+
+def run_supervisor(api, updates, processes, threads, database_url, timeout):
+    supervisor = Supervisor(TOKEN, processes=processes, threads=threads, database_url=database_url,
+                            api_url=api.url + "/bot{0}/{1}", send_queue_options=FAST_SEND).start()
+    thread = threading.Thread(target=supervisor.poll, kwargs={"timeout": 1}, daemon=True)
+    thread.start()
+    # Прогрев: процессы запускаются и загружают кэши
+    push_and_wait(api, updates[:50 * processes], timeout)
+    elapsed, done = push_and_wait(api, updates, timeout)
+    supervisor.stop()
+    thread.join()
+    return {"mode": "workers", "processes": processes, "threads": threads, "seconds": round(elapsed, 3),
+            "responses": done, "updates_per_s": round(done / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--processes", default=f"1,2,{os.cpu_count() or 1}")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'multiprocess.db')}"
+    scale = SCALES[args.scale]
+    generate(database_url, scale)
+    updates = make_updates(args.updates, scale.users, load_links())
+
+    api = FakeBotApi(global_rate=UNLIMITED, global_burst=UNLIMITED, chat_rate=UNLIMITED, chat_burst=UNLIMITED)
+    api.start().install()
+    try:
+        results = [run_single(api, updates, args.timeout)]
+        for processes in sorted({int(value) for value in args.processes.split(",")}):
+            results.append(run_supervisor(api, updates, processes, args.threads, database_url, args.timeout))
+    finally:
+        api.stop()
+    print(json.dumps({"cpu_count": os.cpu_count(), "updates": len(updates), "results": results},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
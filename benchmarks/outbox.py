@@ -0,0 +1,66 @@
+# Уведомления владельцам салонов через outbox и SendQueue на локальном Fake Bot API: у одного владельца больше
+# DIGEST_MAX_ROWS уведомлений за пачку (несколько сводок подряд) и ещё одна пачка, пока прошлые сводки в очереди.
+# Проверяется, что каждая сводка — отдельное сообщение и все уведомления отмечены отправленными после первого раза.
+# Запуск из корня репозитория: python -m benchmarks.outbox --rows 40
+import argparse
+import math
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import telebot
+
+from benchmarks.fake_bot_api import FakeBotApi
+from benchmarks.synthetic_data import SCALES, generate
+from database_root import session_per_update, db_service, OutboxMessage, Record, OUTBOX_NEW_RECORD
+from outbox import OutboxDispatcher, DIGEST_MAX_ROWS
+from send_queue import SendQueue, LANE_NOTIFICATION
+
+
+@session_per_update
+def add_notifications(recipient_id, count, now):
+    record_ids = db_service.session.query(Record.id).order_by(Record.id).limit(count).all()
+    db_service.add_all([OutboxMessage(recipient_id=recipient_id, record_id=record_id, kind=OUTBOX_NEW_RECORD,
+                                      created_at=now, next_attempt_at=now) for record_id, in record_ids])
+    return len(record_ids)
+
+
+@session_per_update
+def unsent():
+    return db_service.session.query(OutboxMessage).filter(OutboxMessage.sent_at.is_(None)).count()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=40)
+    args = parser.parse_args()
+
+    generate(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'outbox.db')}", SCALES["small"])
+    api = FakeBotApi(latency=0.05).start().install()
+    queue = SendQueue(telebot.TeleBot("123:fake"))
+    dispatcher = OutboxDispatcher(send=lambda chat_id, text: queue.send_message(chat_id, text,
+                                                                                 lane=LANE_NOTIFICATION),
+                                  batch_size=args.rows, lease=timedelta(seconds=60))
+    try:
+        now = datetime.now()
+        # Вторая пачка берётся сразу, пока сводки первой ещё ждут лимита на чат
+        rows = add_notifications(1, args.rows, now)
+        dispatcher.run_once(now)
+        rows += add_notifications(1, args.rows, now)
+        dispatcher.run_once(now)
+        queue.close()
+    finally:
+        api.stop()
+
+    digests = 2 * math.ceil(args.rows / DIGEST_MAX_ROWS)
+    left = unsent()
+    print(f"уведомлений {rows}, сводок {dispatcher.stats['digests']}, доставлено {api.calls['sendMessage']}, "
+          f"не отмечено отправленными {left}")
+    if left or api.calls["sendMessage"] != digests:
+        print(f"Ожидалось {digests} сообщений и 0 неотмеченных уведомлений", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
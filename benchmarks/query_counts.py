@@ -0,0 +1,204 @@
+# Проверка, что каждый экран и каждый GET_* помощник выполняет постоянное число SQL-запросов,
+# не зависящее от размера справочников и не больше своего бюджета из QUERY_BUDGETS. Лишний запрос — обычно
+# ленивая загрузка связи, которой нет в профиле загрузки (LOAD_PROFILES в database_root.py).
+# Запуск из корня репозитория: python -m benchmarks.query_counts (код возврата 1, если что-то не так);
+# с --strict первое превышение бюджета падает с QueryBudgetExceeded и списком выполненных запросов
+import argparse
+import os
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+from database_root import configure_db, query_budget, session_per_update, db_service, user_state_cache, \
+    Type, City, Center, Place, Service, User, Record, \
+    GET_CENTERS_BY_TYPE, GET_CENTERS_BY_TYPE_AND_CITY, GET_PLACES_BY_CENTER_AND_CITY, GET_SERVICES_BY_PLACE, \
+    GET_TYPES, GET_CITIES, GET_PLACE, GET_PLACES, GET_PLACES_BY_CENTER, GET_CENTER, GET_SERVICE, GET_USER, \
+    GET_RECORD, SEARCH_PLACES
+from catalog import catalog
+from availability import availability_index
+from service_index import service_index
+import screens
+
+USER_ID = 1
+RECORD_ID = 1
+
+# Бюджеты SQL-запросов: помощник — число запросов (связи результата тоже перебираются),
+# экран — (с пустыми кэшами, с прогретыми кэшами). Снимок каталога с пустым кэшем — это 6 запросов
+QUERY_BUDGETS = {
+    "GET_TYPES": 1,
+    "GET_CITIES": 1,
+    "GET_USER": 1,
+    "GET_CENTER": 1,
+    "GET_PLACE": 2,
+    "GET_PLACES": 1,
+    "GET_PLACES_BY_CENTER": 1,
+    "GET_SERVICE": 2,
+    "GET_RECORD": 1,
+    "GET_CENTERS_BY_TYPE": 1,
+    "GET_CENTERS_BY_TYPE_AND_CITY": 1,
+    "GET_PLACES_BY_CENTER_AND_CITY": 1,
+    "GET_SERVICES_BY_PLACE": 1,
+    "SEARCH_PLACES": 1,
+    "main_menu": (1, 0),
+    "start_record_by_type": (6, 0),
+    "start_record_by_type_of_service": (0, 0),
+    "start_record_by_center": (7, 0),
+    "start_record_by_place": (7, 0),
+    "start_record_by_service": (8, 0),
+    "start_record_by_service_center": (8, 0),
+    "start_record_by_service_place": (8, 0),
+    "start_record": (6, 0),
+    "start_record_by_date": (6, 0),
+    "choose_record_date": (9, 1),
+    "choose_record_month": (9, 1),
+    "choose_record_time": (8, 0),
+    "release_hold": (9, 1),
+    "release_hold_to_main_menu": (2, 1),
+    "show_records": (7, 1),
+    "show_records_after": (8, 2),
+    "show_record": (7, 1),
+    "choose_city": (6, 0),
+    "search_places": (8, 1),
+}
+
+
+@session_per_update
+def seed(cities, centers_per_type, places_per_center):
+    session = db_service.session
+    city_list = [City(name=f"Город {i}") for i in range(cities)]
+    type_list = [Type(name=f"Вид {i}") for i in range(3)]
+    session.add_all(city_list + type_list)
+    session.flush()
+    session.add(User(id=USER_ID, name="Тест", number="70000000000", city_id=city_list[0].id, list_of_records='[]'))
+    for cur_type in type_list:
+        services = [Service(name=f"Услуга {cur_type.id}.{i}", type_id=cur_type.id, duration=30) for i in range(5)]
+        session.add_all(services)
+        for i in range(centers_per_type):
+            center = Center(name=f"Сеть {cur_type.id}.{i}", type_id=cur_type.id)
+            session.add(center)
+            for j in range(places_per_center):
+                session.add(Place(center=center, address=f"ул. {i}, дом {j}", city_id=city_list[j % cities].id,
+                                  owner_id=USER_ID, services=services[:1 + j % len(services)]))
+    start = datetime.combine(date.today() + timedelta(days=1), datetime.min.time()).replace(hour=10)
+    session.add(Record(id=RECORD_ID, user_id=USER_ID, place_id=1, service_id=1, start_date=start,
+                       end_date=start + timedelta(minutes=30)))
+    session.commit()
+
+
+# Результат помощника вместе со всеми связями, которые у него обычно читают
+def touch(result, *names):
+    for obj in result if isinstance(result, list) else [result]:
+        for name in names:
+            value = getattr(obj, name)
+            [repr(item) for item in value] if isinstance(value, list) else repr(value)
+        repr(obj)
+    return result
+
+
+def helper_cases():
+    return {
+        "GET_TYPES": lambda: GET_TYPES(),
+        "GET_CITIES": lambda: GET_CITIES(),
+        "GET_USER": lambda: touch(GET_USER(USER_ID), "city"),
+        "GET_CENTER": lambda: touch(GET_CENTER(1), "type"),
+        "GET_PLACE": lambda: touch(GET_PLACE(1), "center", "city", "services"),
+        "GET_PLACES": lambda: touch(GET_PLACES(), "center", "city"),
+        "GET_PLACES_BY_CENTER": lambda: touch(GET_PLACES_BY_CENTER(1), "center", "city"),
+        "GET_SERVICE": lambda: touch(GET_SERVICE(1), "type", "places"),
+        "GET_RECORD": lambda: touch(GET_RECORD(RECORD_ID), "user", "place", "service"),
+        "GET_CENTERS_BY_TYPE": lambda: touch(GET_CENTERS_BY_TYPE(1), "type"),
+        "GET_CENTERS_BY_TYPE_AND_CITY": lambda: GET_CENTERS_BY_TYPE_AND_CITY(1, 1),
+        "GET_PLACES_BY_CENTER_AND_CITY": lambda: touch(GET_PLACES_BY_CENTER_AND_CITY(1, 1).all(), "center", "city"),
+        "GET_SERVICES_BY_PLACE": lambda: touch(GET_SERVICES_BY_PLACE(1), "type"),
+        "SEARCH_PLACES": lambda: SEARCH_PLACES("сеть ул", 1),
+    }
+
+
+def screen_cases():
+    message = SimpleNamespace(chat=SimpleNamespace(id=USER_ID), text="/start")
+    return {
+        "main_menu": lambda: screens.main_menu(message),
+        "start_record_by_type": lambda: screens.start_record_by_type(message),
+        "start_record_by_type_of_service": lambda: screens.start_record_by_type_of_service(message, "1"),
+        "start_record_by_center": lambda: screens.start_record_by_center(message, "1"),
+        "start_record_by_place": lambda: screens.start_record_by_place(message, "1"),
+        "start_record_by_service": lambda: screens.start_record_by_service(message, "1"),
+        "start_record_by_service_center": lambda: screens.start_record_by_service_center(message, "1"),
+        "start_record_by_service_place": lambda: screens.start_record_by_service_place(message, "1", "1"),
+        "start_record": lambda: screens.start_record(message, "1"),
+        "start_record_by_date": lambda: screens.start_record_by_date(message, "1"),
+        "choose_record_date": lambda: screens.choose_record_date(message, "1", "1"),
+        "choose_record_month": lambda: screens.choose_record_month(message, 1, 1, date.today().replace(day=1)),
+        "choose_record_time": lambda: screens.choose_record_time(message, 1, 1, date.today() + timedelta(days=1)),
+        "release_hold": lambda: screens.release_hold(message, 1, 1, date.today() + timedelta(days=1)),
+        "release_hold_to_main_menu": lambda: screens.release_hold_to_main_menu(message, 1),
+        "show_records": lambda: screens.show_records(message),
+        "show_records_after": lambda: screens.show_records_after(message, RECORD_ID),
+        "show_record": lambda: screens.show_record(message, RECORD_ID),
+        "choose_city": lambda: screens.choose_city(message),
+        "search_places": lambda: screens.search_places(SimpleNamespace(chat=message.chat, text="сеть дом")),
+    }
+
+
+@session_per_update
+def measure(name, case, cold, limit):
+    if cold:
+        catalog.invalidate()
+        availability_index.invalidate()
+        service_index.invalidate()
+        user_state_cache.invalidate()
+    with query_budget(limit, name) as statements:
+        case()
+    return len(statements)
+
+
+def run(size, strict=False):
+    configure_db(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'queries.db')}")
+    catalog.invalidate()
+    availability_index.invalidate()
+    service_index.invalidate()
+    seed(*size)
+    result = dict()
+    cases = [(name, case, True) for name, case in helper_cases().items()]
+    for name, case in screen_cases().items():
+        cases += [(f"{name} (холодный)", case, True), (f"{name} (тёплый)", case, False)]
+    for name, case, cold in cases:
+        limit = budget(name) if strict else None
+        result[name] = measure(name, case, cold, float("inf") if limit is None else limit)
+    return result
+
+
+def budget(name):
+    if name in QUERY_BUDGETS:
+        return QUERY_BUDGETS[name]
+    screen, _, cache = name.rpartition(" (")
+    cold, warm = QUERY_BUDGETS.get(screen, (None, None))
+    return cold if cache == "холодный)" else warm
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strict", action="store_true")
+    args = parser.parse_args()
+    small = run((2, 2, 2), args.strict)
+    large = run((20, 50, 40), args.strict)
+    failed = False
+    for name in small:
+        limit = budget(name)
+        if small[name] != large[name]:
+            status = "РАСТЁТ С ДАННЫМИ"
+        elif limit is None:
+            status = "НЕТ БЮДЖЕТА"
+        elif large[name] > limit:
+            status = f"БОЛЬШЕ БЮДЖЕТА ({limit})"
+        else:
+            status = "ok"
+        failed = failed or status != "ok"
+        print(f"{name:45} {small[name]:3} {large[name]:3}  {status}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+# Бенчмарк слоя БД и экранов на синтетических данных (benchmarks/synthetic_data.py).
+# Замеряет каждый GET_* помощник, методы DatabaseService и каждый экран, который обрабатывает main.py:
+# экраны вызываются как настоящие апдейты (session_per_update, маршрутизатор, отрисовка через очередь отправки)
+# с ботом, который ходит в локальный Fake Bot API. Результат печатается в JSON; с --compare результат
+# сравнивается с сохранённым прогоном, и при замедлении или росте числа SQL-запросов код выхода равен 1.
+# Запуск из корня репозитория:
+#   python -m benchmarks.run --scale medium --out before.json
+#   python -m benchmarks.run --scale medium --compare before.json
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+import sqlalchemy
+import telebot
+
+import database_root
+import screens
+from availability import GET_FREE_SLOTS
+from benchmarks.fake_bot_api import FakeBotApi
+from benchmarks.synthetic_data import SCALES, BENCH_USER_ID, generate
+from database_root import session_per_update, count_queries, db_service, City, Center, Place, Record, ServicePlace, \
+    User, GET_UPCOMING_RECORDS
+from renderer import Renderer
+from router import router
+from send_queue import SendQueue
+from settings import BOOKING_DAYS_AHEAD
+
+# Замедление меньше этого порога считается шумом, даже если оно больше допуска в разах
+NOISE_MS = 0.05
+
+
+def measure(func, repeat):
+    # Каждый вызов — отдельная сессия, как отдельный апдейт; первый вызов идёт с холодными кэшами
+    func = session_per_update(func)
+    times = list()
+    for i in range(repeat):
+        if i == repeat - 1:
+            with count_queries() as statements:
+                started = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - started)
+        else:
+            started = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - started)
+    times_ms = sorted(value * 1000 for value in times)
+    return {
+        "first_ms": round(times[0] * 1000, 4),
+        "mean_ms": round(statistics.fmean(times_ms), 4),
+        "p50_ms": round(times_ms[len(times_ms) // 2], 4),
+        "p95_ms": round(times_ms[min(len(times_ms) - 1, int(len(times_ms) * 0.95))], 4),
+        "max_ms": round(times_ms[-1], 4),
+        "queries": len(statements),
+    }
+
+
+@session_per_update
+def bench_context(repeat):
+    session = db_service.session
+    city_id = session.query(User.city_id).filter(User.id == BENCH_USER_ID).scalar()
+    place_id, service_id = session.query(Place.id, ServicePlace.service_id) \
+        .join(ServicePlace, ServicePlace.place_id == Place.id) \
+        .filter(Place.city_id == city_id).order_by(Place.id).first()
+    center_id, type_id = session.query(Center.id, Center.type_id) \
+        .join(Place, Place.center_id == Center.id).filter(Place.id == place_id).first()
+    records = [row.id for row in GET_UPCOMING_RECORDS(BENCH_USER_ID, datetime.now(), repeat * 2)]
+    return SimpleNamespace(user_id=BENCH_USER_ID, city_id=city_id, city_name=session.get(City, city_id).name,
+                           type_id=type_id, center_id=center_id, place_id=place_id, service_id=service_id,
+                           records=records or [0])
+
+
+def helper_cases(ctx):
+    now = datetime.now()
+    day = date.today() + timedelta(days=1)
+    return {
+        "GET_USER": lambda: database_root.GET_USER(ctx.user_id),
+        "GET_USER_STATE": lambda: database_root.GET_USER_STATE(ctx.user_id),
+        "GET_TYPE": lambda: database_root.GET_TYPE("Вид услуги 1"),
+        "GET_TYPES": lambda: database_root.GET_TYPES(),
+        "GET_CITY": lambda: database_root.GET_CITY(ctx.city_name),
+        "GET_CITY_OBJECT": lambda: database_root.GET_CITY_OBJECT(ctx.city_id),
+        "GET_CITIES": lambda: database_root.GET_CITIES(),
+        "GET_CENTERS_BY_TYPE": lambda: database_root.GET_CENTERS_BY_TYPE(ctx.type_id),
+        "GET_CENTERS_BY_TYPE_AND_CITY": lambda: database_root.GET_CENTERS_BY_TYPE_AND_CITY(ctx.type_id, ctx.city_id),
+        "GET_CENTER": lambda: database_root.GET_CENTER(ctx.center_id),
+        "GET_PLACES_BY_CENTER": lambda: database_root.GET_PLACES_BY_CENTER(ctx.center_id),
+        "GET_PLACES_BY_CENTER_AND_CITY":
+            lambda: database_root.GET_PLACES_BY_CENTER_AND_CITY(ctx.center_id, ctx.city_id).all(),
+        "GET_PLACES": lambda: database_root.GET_PLACES(),
+        "GET_PLACE": lambda: database_root.GET_PLACE(ctx.place_id),
+        "GET_SERVICE": lambda: database_root.GET_SERVICE(ctx.service_id),
+        "GET_SERVICES_BY_PLACE": lambda: database_root.GET_SERVICES_BY_PLACE(ctx.place_id),
+        "GET_SERVICE_LINKS": lambda: database_root.GET_SERVICE_LINKS(),
+        "GET_ACTIVE_RECORD_INTERVALS": lambda: database_root.GET_ACTIVE_RECORD_INTERVALS(ctx.place_id, now),
+        "GET_ACTIVE_SLOT_HOLDS": lambda: database_root.GET_ACTIVE_SLOT_HOLDS(ctx.place_id, now),
+        "GET_ROLLUPS_END": lambda: database_root.GET_ROLLUPS_END(),
+        "GET_ROLLUP_COLUMNS": lambda: database_root.GET_ROLLUP_COLUMNS([ctx.place_id], now.date() - timedelta(days=30),
+                                                                       now.date()),
+        "GET_PLACE_OCCUPANCY": lambda: database_root.GET_PLACE_OCCUPANCY(ctx.place_id, now.date(),
+                                                                         now.date() + timedelta(days=31)),
+        "SEARCH_PLACES": lambda: database_root.SEARCH_PLACES("ул дом 1", ctx.city_id),
+        "GET_RECORDS_TO_REMIND": lambda: database_root.GET_RECORDS_TO_REMIND(now, now + timedelta(days=1)),
+        "GET_RECORD": lambda: database_root.GET_RECORD(ctx.records[0]),
+        "GET_UPCOMING_RECORDS": lambda: database_root.GET_UPCOMING_RECORDS(ctx.user_id, now, 5),
+        "GET_FREE_SLOTS": lambda: GET_FREE_SLOTS(ctx.place_id, ctx.service_id, day),
+    }
+
+
+def db_service_cases(ctx):
+    # Записываемые строки — только новые пользователи с id за пределами синтетических данных,
+    # чтобы не сбрасывать снимок каталога и индексы между замерами
+    added_ids = itertools.count(10 ** 9)
+    deleted_ids = itertools.count(10 ** 9)
+    batch_ids = itertools.count(2 * 10 ** 9, 100)
+
+    def add_batch():
+        first = next(batch_ids)
+        db_service.add_all([User(id=first + i, name=f"batch {i}") for i in range(100)])
+
+    def unit_of_work():
+        first = next(batch_ids)
+        with db_service.unit_of_work():
+            for i in range(10):
+                db_service.add(User(id=first + i, name=f"unit {i}"))
+
+    return {
+        "DatabaseService.get": lambda: db_service.get(Place, ctx.place_id),
+        "DatabaseService.get_by_key": lambda: db_service.get_by_key(City, City.name, ctx.city_name),
+        "DatabaseService.list": lambda: db_service.list(Center),
+        "DatabaseService.list_with_filter": lambda: db_service.list_with_filter(Record, Record.user_id, ctx.user_id),
+        "DatabaseService.only_filter": lambda: db_service.only_filter(Place.city_id, ctx.city_id, model=Place).all(),
+        "DatabaseService.add": lambda: db_service.add(User(id=next(added_ids), name="bench")),
+        "DatabaseService.update": lambda: db_service.update(User, ctx.user_id, number=str(time.monotonic_ns())),
+        "DatabaseService.delete": lambda: db_service.delete(User, next(deleted_ids)),
+        "DatabaseService.add_all": add_batch,
+        "DatabaseService.upsert": lambda: db_service.upsert(
+            User, [{"id": 3 * 10 ** 9 + i, "name": f"upsert {i}"} for i in range(100)]),
+        "DatabaseService.unit_of_work": unit_of_work,
+    }
+
+
+def screen_args(ctx):
+    # Аргументы callback_data для каждого маршрута; hold_record и make_record каждый раз берут новый слот
+    # из окна записи (каждые 2 часа с 1-го по последний день окна), а когда слоты кончатся — идут по кругу
+    slots = itertools.cycle([datetime.combine(date.today() + timedelta(days=1 + i // 6), datetime.min.time()) +
+                             timedelta(hours=9 + 2 * (i % 6)) for i in range(6 * (BOOKING_DAYS_AHEAD - 1))])
+    records = itertools.cycle(ctx.records)
+    day = date.today() + timedelta(days=1)
+    return {
+        ("main_menu", 0): lambda: (),
+        ("start_record_by_type", 0): lambda: (),
+        ("start_record_by_type_of_service", 1): lambda: (ctx.type_id,),
+        ("start_record_by_service", 1): lambda: (ctx.type_id,),
+        ("start_record_by_service_center", 1): lambda: (ctx.service_id,),
+        ("start_record_by_service_place", 2): lambda: (ctx.service_id, ctx.center_id),
+        ("start_record_by_center", 1): lambda: (ctx.type_id,),
+        ("start_record_by_place", 1): lambda: (ctx.center_id,),
+        ("start_record", 1): lambda: (ctx.place_id,),
+        ("start_record_by_date", 1): lambda: (ctx.place_id,),
+        ("choose_record_date", 2): lambda: (ctx.place_id, ctx.service_id),
+        ("choose_record_month", 3): lambda: (ctx.place_id, ctx.service_id, day.replace(day=1)),
+        ("record_day_is_full", 3): lambda: (ctx.place_id, ctx.service_id, day),
+        ("choose_record_time", 3): lambda: (ctx.place_id, ctx.service_id, day),
+        ("hold_record", 3): lambda: (ctx.place_id, ctx.service_id, next(slots)),
+        ("release_hold", 3): lambda: (ctx.place_id, ctx.service_id, day),
+        ("release_hold_to_main_menu", 1): lambda: (ctx.place_id,),
+        ("make_record", 3): lambda: (ctx.place_id, ctx.service_id, next(slots)),
+        ("show_records", 0): lambda: (),
+        ("show_records_after", 1): lambda: (ctx.records[0],),
+        ("show_records_before", 1): lambda: (ctx.records[-1],),
+        ("show_record", 1): lambda: (ctx.records[0],),
+        ("cancel_record", 1): lambda: (next(records),),
+        ("choose_city", 0): lambda: (),
+        ("choose_city", 1): lambda: (ctx.city_id,),
+    }
+
+
+class FakeBot:
+    # Бот из main.py без сети Telegram: те же экраны, маршрутизатор и очередь отправки, но запросы уходят в FakeBotApi
+    def __init__(self):
+        self.api = FakeBotApi(global_rate=10 ** 6, global_burst=10 ** 6, chat_rate=10 ** 6, chat_burst=10 ** 6)
+        self.api.start().install()
+        self.bot = telebot.TeleBot("123:fake")
+        self.send_queue = SendQueue(self.bot, global_rate=10 ** 6, global_burst=10 ** 6, chat_rate=10 ** 6,
+                                    chat_burst=10 ** 6)
+        self.renderer = Renderer(self.send_queue)
+        self._message_ids = itertools.count(1)
+
+    def message(self, chat_id, text=""):
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text, message_id=next(self._message_ids),
+                               contact=None)
+
+    def on_message(self, handler, chat_id, text):
+        message = self.message(chat_id, text)
+        self.renderer.render(message, handler(message))
+
+    def on_callback(self, chat_id, data):
+        call = SimpleNamespace(data=data, message=self.message(chat_id), id="1")
+        self.renderer.render(call.message, screens.on_callback(call), edit=True)
+
+    def api_calls(self):
+        self.send_queue.join()
+        return sum(self.api.calls.values())
+
+    def close(self):
+        self.send_queue.close()
+        self.api.stop()
+
+
+def screen_cases(ctx, fake_bot):
+    cases = {
+        "on_start": lambda: fake_bot.on_message(screens.on_start, ctx.user_id, "/start"),
+        "on_message": lambda: fake_bot.on_message(screens.on_message, ctx.user_id, "привет"),
+        "on_report": lambda: fake_bot.on_message(screens.on_report, ctx.user_id, "/report"),
+    }
+    args = screen_args(ctx)
+    for code, route in router._by_code.items():
+        key = (route.name, len(route.arg_types))
+        if key in args:
+            make_args = args[key]
+            cases[f"{route.name}/{len(route.arg_types)}"] = \
+                lambda make_args=make_args, key=key: fake_bot.on_callback(ctx.user_id, router.encode(key[0], *make_args()))
+    return cases
+
+
+def uncovered(helpers, screens_cases):
+    names = [name for name in dir(database_root) if name.startswith("GET_") and name not in helpers]
+    names += [f"{route.name}/{len(route.arg_types)}" for route in router._by_code.values()
+              if f"{route.name}/{len(route.arg_types)}" not in screens_cases]
+    return names
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(scale_name, seed, repeat):
+    database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    started = time.perf_counter()
+    engine, counts = generate(database_url, SCALES[scale_name], seed=seed)
+    generate_time = time.perf_counter() - started
+    ctx = bench_context(repeat)
+
+    results = {"helpers": dict(), "db_service": dict(), "screens": dict()}
+    for name, case in helper_cases(ctx).items():
+        results["helpers"][name] = measure(case, repeat)
+    for name, case in db_service_cases(ctx).items():
+        results["db_service"][name] = measure(case, repeat)
+
+    fake_bot = FakeBot()
+    try:
+        cases = screen_cases(ctx, fake_bot)
+        for name, case in cases.items():
+            calls_before = fake_bot.api_calls()
+            results["screens"][name] = measure(case, repeat)
+            results["screens"][name]["api_calls"] = round((fake_bot.api_calls() - calls_before) / repeat, 2)
+    finally:
+        fake_bot.close()
+    engine.dispose()
+
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "scale": scale_name,
+            "scale_params": SCALES[scale_name]._asdict(),
+            "seed": seed,
+            "repeat": repeat,
+            "rows": counts,
+            "generate_s": round(generate_time, 3),
+            "uncovered": uncovered(results["helpers"], cases),
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance):
+    regressions = list()
+    for group, cases in current["results"].items():
+        for name, stats in cases.items():
+            old = baseline.get("results", {}).get(group, {}).get(name)
+            if old is None:
+                continue
+            slower = stats["p50_ms"] > old["p50_ms"] * tolerance and stats["p50_ms"] - old["p50_ms"] > NOISE_MS
+            more_queries = stats["queries"] > old["queries"]
+            if slower or more_queries:
+                regressions.append(f"{group}/{name}: p50 {old['p50_ms']} -> {stats['p50_ms']} мс, "
+                                   f"запросов {old['queries']} -> {stats['queries']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--out", help="куда сохранить JSON с результатами (по умолчанию stdout)")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для поиска регрессий")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="допустимое замедление p50 в разах")
+    args = parser.parse_args()
+
+    result = run(args.scale, args.seed, args.repeat)
+    if result["meta"]["uncovered"]:
+        print(f"Без замеров: {', '.join(result['meta']['uncovered'])}", file=sys.stderr)
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"РЕГРЕССИЯ {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
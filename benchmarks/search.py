@@ -0,0 +1,141 @@
+# Поиск салонов по тексту (SEARCH_PLACES, таблица place_search): задержка запросов разного вида на десятках тысяч
+# салонов и проверка, что триггеры держат индекс в актуальном состоянии — после переименования сети и услуги,
+# изменения адреса, добавления и удаления связей документы совпадают с полным пересчётом индекса.
+# Запуск из корня репозитория: python -m benchmarks.search --places 40000 --repeat 200
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import text
+
+from benchmarks.synthetic_data import Scale, generate_rows, load_rows
+from database_root import configure_db, session_per_update, db_service, rebuild_search_index, Center, Place, \
+    Service, ServicePlace, SEARCH_PLACES
+
+CITIES = 30
+TYPES = 8
+PLACES_PER_CENTER = 20
+CENTER_WORDS = ("Лак", "Шарм", "Бьюти", "Локон", "Стиль", "Ноготок", "Барбер", "Студия", "Мастер", "Роза", "Афродита",
+                "Пудра", "Гламур", "Ножницы", "Бархат", "Эстетика")
+STREETS = ("Ленина", "Баумана", "Кремлёвская", "Пушкина", "Гагарина", "Чистопольская", "Петровская", "Садовая",
+           "Мира", "Победы", "Центральная", "Молодёжная", "Школьная", "Лесная", "Советская", "Набережная")
+SERVICE_WORDS = ("Маникюр", "Педикюр", "Стрижка", "Окрашивание", "Укладка", "Массаж", "Брови", "Ресницы", "Борода",
+                 "Пилинг")
+SERVICE_KINDS = ("классический", "аппаратный", "мужской", "женский", "детский", "экспресс", "премиум", "с покрытием")
+# Запросы: одно слово, часть слова, несколько слов, слово без совпадений и запрос «хотя бы одно слово»
+QUERIES = {
+    "услуга": ("маникюр", False),
+    "часть слова": ("краш", False),
+    "улица": ("баумана", False),
+    "сеть + улица": ("шарм ленина", False),
+    "услуга + вид + улица": ("стрижка мужск садовая", False),
+    "нет совпадений": ("татуировка", False),
+    "любое слово": ("татуировка маникюр", True),
+}
+
+
+def search_rows(places, seed):
+    rnd = random.Random(seed)
+    centers_per_type = max(1, places // (TYPES * PLACES_PER_CENTER))
+    rows = generate_rows(Scale(CITIES, TYPES, centers_per_type, PLACES_PER_CENTER, len(SERVICE_KINDS), 10, 0),
+                         seed=seed)
+    for center in rows[Center]:
+        center["name"] = f"{rnd.choice(CENTER_WORDS)} {rnd.choice(CENTER_WORDS)} {center['id']}"
+    for place in rows[Place]:
+        place["address"] = f"ул. {rnd.choice(STREETS)}, дом {rnd.randint(1, 200)}"
+    for service in rows[Service]:
+        service["name"] = f"{SERVICE_WORDS[(service['type_id'] - 1) % len(SERVICE_WORDS)]} " \
+                          f"{SERVICE_KINDS[service['id'] % len(SERVICE_KINDS)]}"
+    return rows
+
+
+@session_per_update
+def search(query, city_id, any_word):
+    return SEARCH_PLACES(query, city_id, any_word=any_word)
+
+
+def latency(query, any_word, repeat, seed):
+    rnd = random.Random(seed)
+    timings = list()
+    found = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        found += len(search(query, rnd.randint(1, CITIES), any_word))
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {"p50": statistics.median(timings), "p95": timings[int(len(timings) * 0.95) - 1],
+            "found": found / repeat}
+
+
+@session_per_update
+def documents():
+    return db_service.session.execute(text("SELECT rowid, center, address, services, city FROM place_search "
+                                           "ORDER BY rowid")).all()
+
+
+# Изменения каталога обычными ORM-операциями; возвращает id салонов, которые должны находиться по новому имени
+@session_per_update
+def change_catalog():
+    session = db_service.session
+    center = db_service.get(Center, 1)
+    center.name = "Жемчужина"
+    service = db_service.get(Service, 1)
+    service.name = "Кератин"
+    place = db_service.get(Place, 2)
+    place.address = "ул. Озёрная, дом 1"
+    link = session.query(ServicePlace).filter(ServicePlace.place_id == 3).first()
+    session.delete(link)
+    session.add(ServicePlace(service_id=2, place_id=4))
+    session.commit()
+    return {place.id for place in center.places}
+
+
+@session_per_update
+def rebuild():
+    rebuild_search_index(db_service.session.connection())
+    db_service.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--places", type=int, default=40000)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    configure_db(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'search.db')}")
+    rows = search_rows(args.places, args.seed)
+    started = time.perf_counter()
+    counts = load_rows(rows)
+    print(f"Загрузка {counts['places']} салонов и {counts['service_place']} связей с триггерами: "
+          f"{time.perf_counter() - started:.1f} с")
+    started = time.perf_counter()
+    rebuild()
+    print(f"Полный пересчёт индекса: {time.perf_counter() - started:.1f} с")
+
+    for name, (query, any_word) in QUERIES.items():
+        result = latency(query, any_word, args.repeat, args.seed)
+        print(f"{name:25} {query!r:30} p50 {result['p50']:6.2f} мс  p95 {result['p95']:6.2f} мс  "
+              f"найдено {result['found']:.1f}")
+
+    place_ids = change_catalog()
+    incremental = documents()
+    rebuild()
+    failed = False
+    if incremental != documents():
+        print("Индекс после изменений каталога расходится с полным пересчётом", file=sys.stderr)
+        failed = True
+    if not place_ids.intersection(search("жемчужина", None, False)):
+        print("Переименованная сеть не находится по новому названию", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("Индекс после изменений каталога совпадает с полным пересчётом")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Сравнение прямой отправки из потоков-обработчиков и отправки через SendQueue на локальном Fake Bot API.
+# Запуск из корня репозитория: python -m benchmarks.send_queue --chats 50 --messages 400
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+from benchmarks.fake_bot_api import FakeBotApi
+from send_queue import SendQueue, LANE_INTERACTIVE, LANE_NOTIFICATION
+
+
+def workload(chats, messages):
+    # Каждое пятое сообщение — уведомление, которое можно склеить с другими уведомлениями этого чата
+    for i in range(messages):
+        chat_id = 1000 + i % chats
+        lane = LANE_NOTIFICATION if i % 5 == 4 else LANE_INTERACTIVE
+        yield chat_id, f"Сообщение {i}", lane
+
+
+def percentile(values, part):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * part))]
+
+
+def run_direct(bot, jobs, threads):
+    latencies = {LANE_INTERACTIVE: [], LANE_NOTIFICATION: []}
+    failed = [0]
+    lock = threading.Lock()
+
+    def send(chat_id, text, lane):
+        started = time.perf_counter()
+        try:
+            bot.send_message(chat_id, text)
+        except ApiTelegramException:
+            with lock:
+                failed[0] += 1
+            return
+        with lock:
+            latencies[lane].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for job in jobs:
+            executor.submit(send, *job)
+    return time.perf_counter() - started, latencies, {"failed": failed[0]}
+
+
+def run_queue(bot, jobs, args):
+    queue = SendQueue(bot, global_rate=args.global_rate, chat_rate=args.chat_rate, workers=args.threads)
+    latencies = {LANE_INTERACTIVE: [], LANE_NOTIFICATION: []}
+    lock = threading.Lock()
+    futures = list()
+
+    def track(lane, started):
+        def done(future):
+            with lock:
+                latencies[lane].append(time.perf_counter() - started)
+        return done
+
+    started = time.perf_counter()
+    for chat_id, text, lane in jobs:
+        coalesce_key = "notification" if lane == LANE_NOTIFICATION else None
+        future = queue.send_message(chat_id, text, lane=lane, coalesce_key=coalesce_key)
+        future.add_done_callback(track(lane, time.perf_counter()))
+        futures.append(future)
+    wait(futures)
+    elapsed = time.perf_counter() - started
+    queue.close()
+    return elapsed, latencies, dict(queue.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--global-rate", type=float, default=30)
+    parser.add_argument("--chat-rate", type=float, default=1)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    api = FakeBotApi(global_rate=args.global_rate, chat_rate=args.chat_rate, latency=args.latency).start().install()
+    bot = telebot.TeleBot("123:fake")
+    results = dict()
+    try:
+        for mode in ("direct", "queue"):
+            api.reset()
+            jobs = list(workload(args.chats, args.messages))
+            if mode == "direct":
+                elapsed, latencies, stats = run_direct(bot, jobs, args.threads)
+            else:
+                elapsed, latencies, stats = run_queue(bot, jobs, args)
+            results[mode] = {
+                "elapsed": round(elapsed, 3),
+                "api_calls": sum(api.calls.values()) + api.rejected,
+                "rejected_429": api.rejected,
+                "delivered": api.calls["sendMessage"],
+                "delivered_per_second": round(api.calls["sendMessage"] / elapsed, 1),
+                "interactive_p50": round(percentile(latencies[LANE_INTERACTIVE], 0.5), 3),
+                "interactive_p95": round(percentile(latencies[LANE_INTERACTIVE], 0.95), 3),
+                "notification_p95": round(percentile(latencies[LANE_NOTIFICATION], 0.95), 3),
+                **stats,
+            }
+    finally:
+        api.stop()
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Время запуска: импорт модулей в новом процессе (как у процесса-обработчика workers.py), первый запрос
+# к уже готовой БД и проверка схемы — по версии в PRAGMA user_version против полного create_all с проверкой индексов.
+# Каждый замер импорта делается в отдельном процессе во временном каталоге, поэтому файл БД репозитория не трогается.
+# Запуск из корня репозитория: python -m benchmarks.startup --repeat 10
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from database_root import Base, create_db_engine, ensure_indexes, ensure_schema
+from settings import NAME_OF_DB
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Код, который выполняется в новом процессе; печатает время в мс и появился ли файл БД.
+# Импорты проверяются в пустом каталоге, первый запрос — в каталоге с БД, схема которой уже актуальна
+PROBES = {
+    "import database_root": ("import database_root", False),
+    "import handlers": ("import handlers", False),
+    "import + first query": ("import database_root\ndatabase_root.GET_CITIES()", True),
+}
+PROBE_TEMPLATE = """import os, time
+started = time.perf_counter()
+{code}
+print((time.perf_counter() - started) * 1000, os.path.exists({db!r}))
+"""
+
+
+def run_probe(code, cwd, db_name):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    output = subprocess.run([sys.executable, "-c", PROBE_TEMPLATE.format(code=code, db=db_name)], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True).stdout.split()
+    return float(output[-2]), output[-1] == "True"
+
+
+def probe_cases(repeat):
+    results = dict()
+    with tempfile.TemporaryDirectory() as ready_cwd, tempfile.TemporaryDirectory() as empty_cwd:
+        ensure_schema(create_db_engine(f"sqlite:///{os.path.join(ready_cwd, NAME_OF_DB)}"))
+        for name, (code, needs_db) in PROBES.items():
+            runs = [run_probe(code, ready_cwd if needs_db else empty_cwd, NAME_OF_DB) for _ in range(repeat)]
+            times = [elapsed for elapsed, _ in runs]
+            results[name] = {"median_ms": round(statistics.median(times), 2), "min_ms": round(min(times), 2)}
+            if not needs_db:
+                results[name]["opens_db_file"] = any(exists for _, exists in runs)
+    return results
+
+
+def schema_cases(repeat):
+    results = dict()
+    with tempfile.TemporaryDirectory() as cwd:
+        engine = create_db_engine(f"sqlite:///{os.path.join(cwd, 'schema.db')}")
+        ensure_schema(engine)
+
+        def measure(func):
+            times = list()
+            for _ in range(repeat):
+                started = time.perf_counter()
+                func()
+                times.append((time.perf_counter() - started) * 1000)
+            return {"median_ms": round(statistics.median(times), 3), "min_ms": round(min(times), 3)}
+
+        results["ensure_schema (версия совпадает)"] = measure(lambda: ensure_schema(engine))
+        results["create_all + ensure_indexes"] = measure(lambda: (Base.metadata.create_all(engine),
+                                                                  ensure_indexes(engine)))
+        engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    print(json.dumps({"processes": probe_cases(args.repeat), "schema": schema_cases(args.repeat)},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Нагрузочная проверка модели "одна сессия на апдейт": N потоков параллельно проходят регистрацию
+# и читают каталог, после чего проверяется, что ни одна запись не потерялась и не перепуталась.
+# Запуск из корня репозитория: python -m benchmarks.stress_sessions --threads 16 --updates 200
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from database_root import configure_db, session_per_update, db_service, user_state_cache, City, Type, User, \
+    ADD_PREPREUSER_TO_BD, ADD_PREUSER_TO_BD, ADD_USER_TO_BD, SET_USER_CITY, GET_USER, GET_TYPES, GET_CITIES
+
+
+@session_per_update
+def fake_registration_update(chat_id, city_id):
+    ADD_PREPREUSER_TO_BD(chat_id)
+    ADD_PREUSER_TO_BD(chat_id, name=f"user {chat_id}")
+    ADD_USER_TO_BD(chat_id, number=str(chat_id))
+    SET_USER_CITY(chat_id, city_id)
+
+
+@session_per_update
+def fake_read_update(chat_id):
+    user = GET_USER(chat_id)
+    assert user.name == f"user {chat_id}", f"чужие данные у {chat_id}: {user.name}"
+    assert user.number == str(chat_id), f"чужой номер у {chat_id}: {user.number}"
+    assert len(GET_TYPES()) > 0 and len(GET_CITIES()) > 0
+
+
+def worker(thread_num, updates, city_id, errors):
+    for i in range(updates):
+        chat_id = thread_num * 1_000_000 + i
+        try:
+            fake_registration_update(chat_id, city_id)
+            fake_read_update(chat_id)
+        except Exception:
+            errors.append(traceback.format_exc())
+
+
+@session_per_update
+def seed():
+    db_service.add(Type(name='Барбершоп'))
+    city = City(name='Казань')
+    db_service.add(city)
+    return city.id
+
+
+@session_per_update
+def count_users():
+    return len(db_service.list(User))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--updates", type=int, default=200)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), "stress.db")
+    configure_db(f"sqlite:///{db_path}")
+    city_id = seed()
+    # Кэш отключается, чтобы каждое чтение действительно шло в БД через сессию своего потока
+    user_state_cache.maxsize = 0
+
+    errors = list()
+    threads = [threading.Thread(target=worker, args=(n, args.updates, city_id, errors)) for n in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = args.threads * args.updates
+    users = count_users()
+    print(f"{args.threads} потоков, {total * 2} апдейтов за {elapsed:.2f} с ({total * 2 / elapsed:.0f} апдейтов/с)")
+    print(f"Пользователей в БД: {users} из {total}, ошибок: {len(errors)}")
+    for error in errors[:5]:
+        print(error)
+    if errors or users != total:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# Генератор синтетических данных для бенчмарков: города, виды услуг, сети, салоны, услуги, пользователи и записи.
+# Одинаковые seed и размеры всегда дают одинаковую БД, поэтому результаты разных запусков можно сравнивать.
+# Запуск отдельно: python -m benchmarks.synthetic_data --scale medium --out /tmp/medium.db
+import argparse
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from database_root import configure_db, session_per_update, db_service, rebuild_occupancy, Type, City, Center, Place, \
+    Service, User, Record, ServicePlace
+from settings import WORK_DAY_START_HOUR, WORK_DAY_END_HOUR, SLOT_STEP_MINUTES
+
+Scale = namedtuple('Scale', ['cities', 'types', 'centers_per_type', 'places_per_center', 'services_per_type',
+                             'users', 'records_per_user'])
+
+SCALES = {
+    "small": Scale(3, 3, 5, 3, 5, 100, 5),
+    "medium": Scale(10, 5, 20, 10, 10, 2000, 20),
+    "large": Scale(30, 8, 50, 20, 20, 20000, 30),
+}
+# Пользователь, от имени которого бенчмарки открывают экраны: у него есть город и записи
+BENCH_USER_ID = 1
+BENCH_UPCOMING_RECORDS = 20
+
+
+def generate_rows(scale, seed=0, now=None):
+    rnd = random.Random(seed)
+    now = (now or datetime.now()).replace(second=0, microsecond=0)
+    rows = {model: list() for model in (Type, City, User, Center, Place, Service, ServicePlace, Record)}
+
+    rows[Type] = [{"id": i, "name": f"Вид услуги {i}"} for i in range(1, scale.types + 1)]
+    rows[City] = [{"id": i, "name": f"Город {i}"} for i in range(1, scale.cities + 1)]
+    rows[User] = [{"id": i, "name": f"Клиент {i}", "number": f"7{i:010d}", "city_id": 1 + (i - 1) % scale.cities}
+                  for i in range(1, scale.users + 1)]
+
+    services_by_type = dict()
+    for cur_type in rows[Type]:
+        services_by_type[cur_type["id"]] = list()
+        for i in range(scale.services_per_type):
+            service_id = len(rows[Service]) + 1
+            rows[Service].append({"id": service_id, "name": f"Услуга {cur_type['id']}.{i}",
+                                  "type_id": cur_type["id"], "duration": rnd.choice((15, 30, 45, 60, 90))})
+            services_by_type[cur_type["id"]].append(service_id)
+
+    for cur_type in rows[Type]:
+        for i in range(scale.centers_per_type):
+            center_id = len(rows[Center]) + 1
+            rows[Center].append({"id": center_id, "name": f"Сеть {cur_type['id']}.{i}", "type_id": cur_type["id"]})
+            for j in range(scale.places_per_center):
+                place_id = len(rows[Place]) + 1
+                rows[Place].append({"id": place_id, "center_id": center_id, "address": f"ул. {center_id}, дом {j + 1}",
+                                    "city_id": 1 + (center_id + j) % scale.cities,
+                                    "owner_id": rnd.randint(1, scale.users)})
+                type_services = services_by_type[cur_type["id"]]
+                for service_id in rnd.sample(type_services, rnd.randint(1, len(type_services))):
+                    rows[ServicePlace].append({"id": len(rows[ServicePlace]) + 1, "service_id": service_id,
+                                               "place_id": place_id})
+
+    # Записи: большая часть в прошлом (история постоянных клиентов), остальные на ближайшие две недели
+    links = [(link["service_id"], link["place_id"]) for link in rows[ServicePlace]]
+    durations = {service["id"]: service["duration"] for service in rows[Service]}
+    slots_per_day = (WORK_DAY_END_HOUR - WORK_DAY_START_HOUR) * 60 // SLOT_STEP_MINUTES
+    day_start = now.replace(hour=WORK_DAY_START_HOUR, minute=0)
+    for user_id in range(1, scale.users + 1):
+        # У пользователя бенчмарков сверх истории ещё BENCH_UPCOMING_RECORDS будущих записей, чтобы было что листать
+        upcoming = BENCH_UPCOMING_RECORDS if user_id == BENCH_USER_ID else 0
+        for i in range(scale.records_per_user + upcoming):
+            service_id, place_id = rnd.choice(links)
+            start = day_start + timedelta(days=rnd.randint(1, 14) if i < upcoming else rnd.randint(-365, 14),
+                                          minutes=rnd.randrange(slots_per_day) * SLOT_STEP_MINUTES)
+            rows[Record].append({"id": len(rows[Record]) + 1, "user_id": user_id, "place_id": place_id,
+                                 "service_id": service_id, "start_date": start,
+                                 "end_date": start + timedelta(minutes=durations[service_id]),
+                                 "active": start > now or rnd.random() < 0.9})
+    return rows
+
+
+@session_per_update
+def load_rows(rows):
+    with db_service.unit_of_work():
+        for model, model_rows in rows.items():
+            if model_rows:
+                db_service.upsert(model, model_rows)
+        rebuild_occupancy(db_service.session)
+    return {model.__tablename__: len(model_rows) for model, model_rows in rows.items()}
+
+
+def generate(database_url, scale, seed=0):
+    engine = configure_db(database_url)
+    return engine, load_rows(generate_rows(scale, seed=seed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", required=True)
+    args = parser.parse_args()
+    engine, counts = generate(f"sqlite:///{args.out}", SCALES[args.scale], seed=args.seed)
+    print(", ".join(f"{table}: {count}" for table, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
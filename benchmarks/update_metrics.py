@@ -0,0 +1,53 @@
+# Метрика bot_update_api_calls для экранов, которые отрисовываются правкой сообщения: остальные ответы такого экрана
+# уходят в очередь отправки уже после правки, из потока отправки, и всё равно должны учитываться в апдейте
+# нажатия на кнопку. На локальном Fake Bot API проверяется число запросов за апдейт для экрана «правка + ответ»
+# и для экрана, который нельзя показать правкой.
+# Запуск из корня репозитория: python -m benchmarks.update_metrics
+import sys
+from types import SimpleNamespace
+
+import telebot
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup
+
+from benchmarks.fake_bot_api import FakeBotApi
+from metrics import metrics, instrument_update
+from renderer import Renderer
+from screens import Reply
+from send_queue import SendQueue
+
+CHAT_ID = 1
+# Экран и ожидаемое число запросов: правка + новое сообщение; два новых сообщения + удаление старого
+CASES = {
+    "edit_then_send": ([Reply("Запись отменена"), Reply("Ваши записи:", InlineKeyboardMarkup(
+        [[InlineKeyboardButton("⬅️ Назад", callback_data="1a")]]))], 2),
+    "send_then_delete": ([Reply("Отправьте номер телефона", ReplyKeyboardMarkup()), Reply("Или вернитесь в меню")],
+                         3),
+}
+
+
+def main():
+    api = FakeBotApi().start().install()
+    queue = SendQueue(telebot.TeleBot("123:fake"))
+    renderer = Renderer(queue)
+    message = SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID), message_id=1, text="Старый экран", reply_markup=None)
+    failed = False
+    try:
+        for name, (replies, expected) in CASES.items():
+            handler = instrument_update(f"check/{name}")(lambda: renderer.render(message, replies, edit=True))
+            handler()
+            queue.join()
+            histogram = metrics.get('bot_update_api_calls', f"check/{name}")
+            calls = histogram.sum if histogram is not None else None
+            print(f"{name:20} запросов к Bot API за апдейт {calls}, ожидалось {expected}")
+            if calls != expected:
+                failed = True
+    finally:
+        queue.close()
+        api.stop()
+    if failed:
+        print("bot_update_api_calls не совпадает с числом запросов экрана", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
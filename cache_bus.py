@@ -0,0 +1,27 @@
+# Сброс кэшей между процессами бота. Кэш, который сбрасывается после коммита в одном процессе (снимок каталога,
+# индекс услуг, расписание салона), публикует событие publish(вид, ключ), а остальные процессы получают его
+# и вызывают обработчик, зарегистрированный через subscribe. В обычном однопроцессном режиме транспорта нет
+# и publish ничего не делает. Транспорт задаёт многопроцессный режим (workers.py)
+_handlers = dict()
+_transport = None
+
+
+def subscribe(kind, handler):
+    _handlers[kind] = handler
+
+
+def set_transport(transport):
+    global _transport
+    _transport = transport
+
+
+def publish(kind, key=None):
+    if _transport is not None:
+        _transport(kind, key)
+
+
+# Событие из другого процесса: сбрасывается только свой кэш, дальше событие не рассылается
+def apply(kind, key=None):
+    handler = _handlers.get(kind)
+    if handler is not None:
+        handler(key)
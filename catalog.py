@@ -0,0 +1,152 @@
+from collections import namedtuple, defaultdict
+from threading import RLock
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session as OrmSession
+from telebot.types import JsonSerializable
+
+import cache_bus
+from database_root import db_service, Type, City, Center, Place, Service, ServicePlace
+
+# Справочники (виды услуг, города, сети, салоны, услуги) почти не меняются, поэтому экраны навигации
+# берут их из снимка в памяти, а готовые клавиатуры хранят уже сериализованными в JSON.
+# Снимок сбрасывается после любого коммита, который изменил строки справочников (в многопроцессном режиме —
+# во всех процессах, через cache_bus).
+CatalogType = namedtuple('CatalogType', ['id', 'name'])
+CatalogCity = namedtuple('CatalogCity', ['id', 'name'])
+CatalogCenter = namedtuple('CatalogCenter', ['id', 'name', 'type_id'])
+CatalogPlace = namedtuple('CatalogPlace', ['id', 'center_id', 'city_id', 'address', 'owner_id'])
+CatalogService = namedtuple('CatalogService', ['id', 'name', 'type_id', 'duration'])
+
+CATALOG_MODELS = (Type, City, Center, Place, Service, ServicePlace)
+CATALOG_TABLES = {model.__table__ for model in CATALOG_MODELS}
+
+
+class CatalogSnapshot:
+    def __init__(self, types, cities, centers, places, services, service_place):
+        self.types = types
+        self.cities = cities
+        self.type_by_id = {cur_type.id: cur_type for cur_type in types}
+        self.city_by_id = {city.id: city for city in cities}
+        self.center_by_id = {center.id: center for center in centers}
+        self.place_by_id = {place.id: place for place in places}
+        self.service_by_id = {service.id: service for service in services}
+
+        self.centers_by_type = defaultdict(list)
+        for center in centers:
+            self.centers_by_type[center.type_id].append(center)
+
+        self.places_by_center_and_city = defaultdict(list)
+        self.center_ids_by_type_and_city = defaultdict(set)
+        for place in places:
+            self.places_by_center_and_city[(place.center_id, place.city_id)].append(place)
+            center = self.center_by_id.get(place.center_id)
+            if center is not None:
+                self.center_ids_by_type_and_city[(center.type_id, place.city_id)].add(center.id)
+
+        self.services_by_place = defaultdict(list)
+        for service_id, place_id in service_place:
+            if service_id in self.service_by_id:
+                self.services_by_place[place_id].append(self.service_by_id[service_id])
+        for place_services in self.services_by_place.values():
+            place_services.sort(key=lambda service: service.id)
+
+    def centers_by_type_and_city(self, type_id, city_id):
+        center_ids = self.center_ids_by_type_and_city.get((int(type_id), city_id), ())
+        return [center for center in self.centers_by_type.get(int(type_id), ()) if center.id in center_ids]
+
+    def places_by_center_and_city_id(self, center_id, city_id):
+        return self.places_by_center_and_city.get((int(center_id), city_id), [])
+
+
+def load_catalog_snapshot(session=None):
+    session = session or db_service.session
+    return CatalogSnapshot(
+        types=[CatalogType(*row) for row in session.execute(select(Type.id, Type.name).order_by(Type.id))],
+        cities=[CatalogCity(*row) for row in session.execute(select(City.id, City.name).order_by(City.id))],
+        centers=[CatalogCenter(*row) for row in
+                 session.execute(select(Center.id, Center.name, Center.type_id).order_by(Center.id))],
+        places=[CatalogPlace(*row) for row in
+                session.execute(select(Place.id, Place.center_id, Place.city_id, Place.address, Place.owner_id)
+                                .order_by(Place.id))],
+        services=[CatalogService(*row) for row in
+                  session.execute(select(Service.id, Service.name, Service.type_id, Service.duration)
+                                  .order_by(Service.id))],
+        service_place=session.execute(select(ServicePlace.service_id, ServicePlace.place_id)).all(),
+    )
+
+
+# Клавиатура, уже сериализованная в JSON: telebot отправляет её как есть, не собирая заново
+class SerializedMarkup(JsonSerializable):
+    def __init__(self, json_string):
+        self.json_string = json_string
+
+    def to_json(self):
+        return self.json_string
+
+
+class Catalog:
+    def __init__(self, loader=load_catalog_snapshot):
+        self._loader = loader
+        self._snapshot = None
+        self._markups = dict()
+        self._lock = RLock()
+        self.version = 0
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._loader()
+                snapshot = self._snapshot
+        return snapshot
+
+    def markup(self, key, build):
+        # key — (экран, вид услуги, город, сеть, ...); build собирает InlineKeyboardMarkup из снимка
+        markup = self._markups.get(key)
+        if markup is None:
+            with self._lock:
+                version = self.version
+                markup = SerializedMarkup(build().to_json())
+                if version == self.version:
+                    self._markups[key] = markup
+        return markup
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._markups.clear()
+            self.version += 1
+
+
+catalog = Catalog()
+cache_bus.subscribe('catalog', lambda key: catalog.invalidate())
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _mark_catalog_changes(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, CATALOG_MODELS):
+            session.info['catalog_changed'] = True
+            return
+
+
+@event.listens_for(OrmSession, 'do_orm_execute')
+def _mark_catalog_bulk_changes(orm_execute_state):
+    # Пакетные INSERT/UPDATE/DELETE (например, DatabaseService.upsert) идут мимо flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        if getattr(orm_execute_state.statement, 'table', None) in CATALOG_TABLES:
+            orm_execute_state.session.info['catalog_changed'] = True
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_catalog_on_commit(session):
+    if session.info.pop('catalog_changed', False):
+        catalog.invalidate()
+        cache_bus.publish('catalog')
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _forget_catalog_changes(session):
+    session.info.pop('catalog_changed', None)
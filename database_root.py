@@ -1,14 +1,29 @@
-from datetime import datetime, time
-
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Table
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
-
-from settings import NAME_OF_DB
+import re
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+from functools import wraps
+
+from sqlalchemy import create_engine, event, exists, inspect, insert, select, update, delete, literal, func, cast, union_all, and_, or_, text, Column, Integer, String, Boolean, Date, DateTime, ForeignKey, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session, joinedload, selectinload
+
+from settings import NAME_OF_DB, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, \
+    SQLITE_BUSY_TIMEOUT_MS, SQLITE_CACHE_SIZE_KB, BULK_CHUNK_SIZE, SEARCH_RESULTS_LIMIT, SEARCH_MIN_WORD_LENGTH, \
+    SEARCH_MAX_WORDS, SEARCH_RANK_LIMIT
+from user_cache import user_state_cache, user_state_from_user, UserState, \
+    USER_STATUS_PREPREUSER, USER_STATUS_PREUSER, USER_STATUS_USER
 
 # Base class for ORM models
 Base = declarative_base()
 
 
+# Значение связи, только если она уже загружена: __repr__ не должен сам ходить в БД за связанными объектами
+def _if_loaded(obj, name):
+    return inspect(obj).dict.get(name)
+
+
 # Таблица TYPE
 class Type(Base):
     __tablename__ = 'types'
@@ -57,12 +72,16 @@ class Service(Base):
         #     return self.get_duration().strftime("%Mм")
 
     def __repr__(self):
-        return f"Услуга '{self.name}' длительностью {self.get_duration_str()} из салонов: {[place.address for place in self.places]}"
+        places = _if_loaded(self, 'places')
+        if places is None:
+            return f"Услуга '{self.name}' длительностью {self.get_duration_str()}"
+        return f"Услуга '{self.name}' длительностью {self.get_duration_str()} из салонов: {[place.address for place in places]}"
 
 
 # Таблица CENTERS
 class Center(Base):
     __tablename__ = 'centers'
+    __table_args__ = (Index('ix_centers_type_id', 'type_id'),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
     type_id = Column(Integer, ForeignKey('types.id'), nullable=False)
@@ -93,6 +112,7 @@ class Center(Base):
 # Таблица PLACES
 class Place(Base):
     __tablename__ = 'places'
+    __table_args__ = (Index('ix_places_city_id_center_id', 'city_id', 'center_id'),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     center_id = Column(Integer, ForeignKey('centers.id'), nullable=False)
     address = Column(String, nullable=False)
@@ -123,7 +143,10 @@ class Place(Base):
         return GET_PLACE(_id)
 
     def __repr__(self):
-        return f"Салон '{self.address}' центра '{self.center.name}' с услугами: {self.services}"
+        center = _if_loaded(self, 'center')
+        services = _if_loaded(self, 'services')
+        return f"Салон '{self.address}' центра '{center.name if center else self.center_id}'" + \
+            (f" с услугами: {[service.name for service in services]}" if services is not None else "")
 
 
 # Таблица USERS
@@ -132,7 +155,8 @@ class User(Base):
     id = Column(Integer, primary_key=True)  # ID задаётся программой
     name = Column(String, nullable=True)
     number = Column(String, nullable=True)
-    list_of_records = Column(String, nullable=True)  # Хранение как строки ID-шников (JSON)
+    # Устарело: записи пользователя берутся из таблицы records (GET_UPCOMING_RECORDS), колонка больше не обновляется
+    list_of_records = Column(String, nullable=True)
     city_id = Column(Integer, ForeignKey('cities.id'), nullable=True)
 
     records = relationship('Record', back_populates='user')
@@ -151,6 +175,10 @@ class User(Base):
     def check_prepreuser(_id):
         return CHECK_PREPREUSER(_id)
 
+    @staticmethod
+    def get_state(_id):
+        return GET_USER_STATE(_id)
+
     @staticmethod
     def get_preuser_name(_id):
         return User.get_preuser(_id).name
@@ -176,12 +204,16 @@ class User(Base):
         return GET_USER(_id)
 
     def __repr__(self):
-        return f"Пользователь '{self.name}' из города '{self.city.name}'"
+        city = _if_loaded(self, 'city')
+        return f"Пользователь '{self.name}' из города '{city.name if city else self.city_id}'"
 
 
 # Таблица RECORDS
 class Record(Base):
     __tablename__ = 'records'
+    __table_args__ = (Index('ix_records_place_id_start_date', 'place_id', 'start_date'),
+                      Index('ix_records_user_id_active_start_date', 'user_id', 'active', 'start_date'),
+                      Index('ix_records_start_date', 'start_date'))
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     place_id = Column(Integer, ForeignKey('places.id'), nullable=False)
@@ -195,35 +227,343 @@ class Record(Base):
     service = relationship('Service', back_populates='records')
 
     def __repr__(self):
-        return f"Запись пользователя '{self.user.name}' в салон по адресу '{self.place.address}' на {self.start_date}"
+        user = _if_loaded(self, 'user')
+        place = _if_loaded(self, 'place')
+        return f"Запись пользователя '{user.name if user else self.user_id}' " \
+               f"в салон по адресу '{place.address if place else self.place_id}' на {self.start_date}"
+
+
+# Архив записей: прошедшие и отменённые записи, которые фоновая задача (archive.py) переносит из records,
+# чтобы records оставалась размером с будущие записи. Колонки те же, id сохраняется
+class RecordArchive(Base):
+    __tablename__ = 'records_archive'
+    __table_args__ = (Index('ix_records_archive_place_id_start_date', 'place_id', 'start_date'),
+                      Index('ix_records_archive_user_id_start_date', 'user_id', 'start_date'),
+                      Index('ix_records_archive_start_date', 'start_date'))
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    place_id = Column(Integer, ForeignKey('places.id'), nullable=False)
+    service_id = Column(Integer, ForeignKey('services.id'), nullable=False)
+    start_date = Column(DateTime, nullable=False)
+    end_date = Column(DateTime, nullable=False)
+    active = Column(Boolean, default=True, nullable=False)
+
+
+# Временная бронь слота: пока пользователь подтверждает запись, слот не показывается другим
+class SlotHold(Base):
+    __tablename__ = 'slot_holds'
+    __table_args__ = (Index('ix_slot_holds_place_id_start_date', 'place_id', 'start_date'),
+                      Index('ix_slot_holds_user_id', 'user_id'),
+                      Index('ix_slot_holds_expires_at', 'expires_at'))
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    place_id = Column(Integer, ForeignKey('places.id'), nullable=False)
+    service_id = Column(Integer, ForeignKey('services.id'), nullable=False)
+    start_date = Column(DateTime, nullable=False)
+    end_date = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+# Загрузка салона по дням: сколько минут занято активными записями, начинающимися в этот день. Обновляется
+# в той же транзакции, что и запись или отмена (_add_occupancy), и целиком пересчитывается при обновлении схемы
+class PlaceDayOccupancy(Base):
+    __tablename__ = 'place_day_occupancy'
+    place_id = Column(Integer, ForeignKey('places.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    busy_minutes = Column(Integer, default=0, nullable=False)
+    records = Column(Integer, default=0, nullable=False)
+
+
+# Дневные итоги записей для отчётов владельцам (reports.py): по салону, услуге, дню и часу начала.
+# Хранятся только за прошедшие дни, которые больше не меняются
+class RecordRollup(Base):
+    __tablename__ = 'record_rollups'
+    place_id = Column(Integer, ForeignKey('places.id'), primary_key=True)
+    service_id = Column(Integer, ForeignKey('services.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    hour = Column(Integer, primary_key=True)
+    records = Column(Integer, default=0, nullable=False)
+    cancelled = Column(Integer, default=0, nullable=False)
+    busy_minutes = Column(Integer, default=0, nullable=False)
+
+
+# Отправленные напоминания о записях: по ним после перезапуска бот не напоминает о записи второй раз
+class RecordReminder(Base):
+    __tablename__ = 'record_reminders'
+    record_id = Column(Integer, ForeignKey('records.id'), primary_key=True)
+    sent_at = Column(DateTime, nullable=False)
+
+
+# Исходящие уведомления владельцам салонов о новых и отменённых записях. Строка пишется в той же транзакции,
+# что и запись, а отправляет её фоновый диспетчер (outbox.py), поэтому запись не ждёт Telegram
+OUTBOX_NEW_RECORD = 'new_record'
+OUTBOX_CANCELLED_RECORD = 'cancelled_record'
+
+
+class OutboxMessage(Base):
+    __tablename__ = 'outbox'
+    __table_args__ = (Index('ix_outbox_sent_at_next_attempt_at', 'sent_at', 'next_attempt_at'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    recipient_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    record_id = Column(Integer, ForeignKey('records.id'), nullable=False)
+    kind = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
 
 
 class ServicePlace(Base):
     __tablename__ = 'service_place'
+    # Индекс по place_id нужен триггерам поиска: они собирают услуги салона при каждом изменении связей
+    __table_args__ = (Index('ix_service_place_service_id_place_id', 'service_id', 'place_id'),
+                      Index('ix_service_place_place_id', 'place_id'))
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     service_id = Column(Integer, ForeignKey('services.id'), nullable=False)
     place_id = Column(Integer, ForeignKey('places.id'), nullable=False)
 
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL позволяет читать параллельно с записью, остальные настройки уменьшают число обращений к диску
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def create_db_engine(database_url=f'sqlite:///{NAME_OF_DB}', pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                     pool_timeout=DB_POOL_TIMEOUT):
+    if not database_url.startswith('sqlite'):
+        return create_engine(database_url, pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
+    if database_url in ('sqlite://', 'sqlite:///:memory:'):
+        # БД в памяти живёт в одном соединении, пул ей не нужен
+        engine = create_engine(database_url)
+    else:
+        engine = create_engine(database_url, pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout,
+                               connect_args={"check_same_thread": False,
+                                             "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000})
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+# create_all создаёт индексы только вместе с новыми таблицами, поэтому в уже существующую БД
+# недостающие индексы добавляются отдельно
+def ensure_indexes(connection):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+# Полнотекстовый поиск салонов (SQLite FTS5, токенизатор trigram — ищет по любой подстроке от 3 символов
+# без учёта регистра): документ салона — название сети, адрес и названия его услуг, rowid — id салона.
+# Город хранится индексируемой колонкой вида '#12#': отбор по городу — часть MATCH, и FTS5 пересекает списки
+# совпадений сам, а не перебирает салоны со словом запроса во всех городах. Триггеры обновляют документы
+# затронутых салонов при любом изменении каталога, в том числе пакетном
+_PLACE_DOCUMENT = (
+    "INSERT INTO place_search (rowid, center, address, services, city) "
+    "SELECT places.id, centers.name, places.address, "
+    "(SELECT group_concat(DISTINCT services.name) FROM service_place "
+    "JOIN services ON services.id = service_place.service_id WHERE service_place.place_id = places.id), "
+    "'#' || places.city_id || '#' FROM places JOIN centers ON centers.id = places.center_id WHERE {}")
+
+
+def _refresh_places(condition):
+    return f"DELETE FROM place_search WHERE rowid IN (SELECT places.id FROM places WHERE {condition}); " + \
+        _PLACE_DOCUMENT.format(condition) + ";"
+
+
+_SEARCH_TRIGGERS = {
+    "place_search_places_insert": ("AFTER INSERT ON places", _refresh_places("places.id = new.id")),
+    "place_search_places_update": ("AFTER UPDATE ON places", "DELETE FROM place_search WHERE rowid = old.id; " +
+                                   _refresh_places("places.id = new.id")),
+    "place_search_places_delete": ("AFTER DELETE ON places", "DELETE FROM place_search WHERE rowid = old.id;"),
+    "place_search_centers_update": ("AFTER UPDATE OF name ON centers", _refresh_places("places.center_id = new.id")),
+    "place_search_services_update": ("AFTER UPDATE OF name ON services", _refresh_places(
+        "places.id IN (SELECT place_id FROM service_place WHERE service_id = new.id)")),
+    "place_search_services_delete": ("AFTER DELETE ON services", _refresh_places(
+        "places.id IN (SELECT place_id FROM service_place WHERE service_id = old.id)")),
+    "place_search_links_insert": ("AFTER INSERT ON service_place", _refresh_places("places.id = new.place_id")),
+    "place_search_links_update": ("AFTER UPDATE ON service_place", _refresh_places(
+        "places.id IN (old.place_id, new.place_id)")),
+    "place_search_links_delete": ("AFTER DELETE ON service_place", _refresh_places("places.id = old.place_id")),
+}
+SEARCH_DDL = ("CREATE VIRTUAL TABLE place_search USING fts5(center, address, services, city, "
+              "tokenize='trigram')",) + \
+    tuple(f"CREATE TRIGGER {name} {when} BEGIN {body} END" for name, (when, body) in _SEARCH_TRIGGERS.items())
+
+
+# Отпечаток схемы: таблицы, колонки и индексы всех моделей. Меняется при любом изменении моделей,
+# поэтому номер версии не нужно поднимать вручную
+def schema_version():
+    parts = list()
+    for table in Base.metadata.sorted_tables:
+        columns = ",".join(f"{column.name} {column.type}" for column in table.columns)
+        indexes = ",".join(sorted(f"{index.name}({','.join(column.name for column in index.columns)})"
+                                  for index in table.indexes))
+        parts.append(f"{table.name}:{columns};{indexes}")
+    parts += SEARCH_DDL
+    return zlib.crc32("|".join(parts).encode()) & 0x7fffffff
+
+
+SCHEMA_VERSION = schema_version()
+
+
+class SchemaMismatch(Exception):
+    pass
+
+
+# Расхождения живой схемы с моделями: create_all не меняет уже существующие таблицы, поэтому новая или удалённая
+# колонка и изменённый индекс в старой таблице сами не появятся — такую БД нужно мигрировать вручную
+def schema_differences(connection):
+    live = inspect(connection)
+    differences = list()
+    for table in Base.metadata.sorted_tables:
+        columns = {column["name"] for column in live.get_columns(table.name)}
+        expected = {column.name for column in table.columns}
+        if columns != expected:
+            differences.append(f"{table.name}: колонки {sorted(columns)} вместо {sorted(expected)}")
+        indexes = {index["name"]: index["column_names"] for index in live.get_indexes(table.name)}
+        for index in table.indexes:
+            index_columns = [column.name for column in index.columns]
+            if indexes.get(index.name) != index_columns:
+                differences.append(f"{table.name}: индекс {index.name}{tuple(index_columns)} "
+                                   f"{'отсутствует' if index.name not in indexes else 'отличается'}")
+    return differences
+
+
+# В SQLite версия схемы хранится в PRAGMA user_version: если она совпадает, create_all и проверка индексов
+# (десятки запросов к sqlite_master) пропускаются. Обновление идёт в одной транзакции BEGIN IMMEDIATE: процессы,
+# запущенные одновременно (workers.py), ждут блокировку и после неё снова проверяют версию, поэтому схему
+# обновляет только первый. Версия ставится, только если живая схема совпала с моделями.
+# Возвращает True, если схему пришлось обновлять
+def ensure_schema(engine):
+    sqlite = engine.dialect.name == 'sqlite'
+    if sqlite:
+        with engine.connect() as connection:
+            if connection.exec_driver_sql("PRAGMA user_version").scalar() == SCHEMA_VERSION:
+                return False
+    with engine.connect() as connection:
+        if sqlite:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            if connection.exec_driver_sql("PRAGMA user_version").scalar() == SCHEMA_VERSION:
+                connection.rollback()
+                return False
+        Base.metadata.create_all(connection)
+        ensure_indexes(connection)
+        differences = schema_differences(connection)
+        if differences:
+            connection.rollback()
+            raise SchemaMismatch("Схема БД не совпадает с моделями:\n" + "\n".join(differences))
+        rebuild_occupancy(connection)
+        if sqlite:
+            rebuild_search_index(connection)
+            connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        connection.commit()
+    return True
+
+
+# Полный пересчёт place_day_occupancy по активным записям: при обновлении схемы и после массовой загрузки записей
+def rebuild_occupancy(connection):
+    minutes = cast(func.round((func.julianday(Record.end_date) - func.julianday(Record.start_date)) * 24 * 60),
+                   Integer)
+    day = func.date(Record.start_date)
+    connection.execute(delete(PlaceDayOccupancy))
+    connection.execute(insert(PlaceDayOccupancy).from_select(
+        ['place_id', 'day', 'busy_minutes', 'records'],
+        select(Record.place_id, day, func.sum(minutes), func.count()).where(Record.active.is_(True))
+        .group_by(Record.place_id, day)))
+
+
+# Пересоздание таблицы поиска и её триггеров (SEARCH_DDL входит в версию схемы) и полное заполнение
+def rebuild_search_index(connection):
+    connection.exec_driver_sql("DROP TABLE IF EXISTS place_search")
+    for name in _SEARCH_TRIGGERS:
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+    for statement in SEARCH_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql(_PLACE_DOCUMENT.format("1"))
+
+
 # Инициализация базы данных
-def init_db(database_url=f'sqlite:///{NAME_OF_DB}'):
-    engine = create_engine(database_url)
-    Base.metadata.create_all(engine)
+def init_db(database_url=f'sqlite:///{NAME_OF_DB}', **engine_kwargs):
+    engine = create_db_engine(database_url, **engine_kwargs)
+    ensure_schema(engine)
     return sessionmaker(bind=engine)
 
 
+# Фабрика сессий, которая подключается к БД по умолчанию только при создании первой сессии, а не при импорте
+# модуля: процессы и скрипты, которые сразу переключаются на другую БД (configure_db) или вообще не ходят в БД,
+# не открывают файл БД и не проверяют схему
+class LazySessionMaker(sessionmaker):
+    def __init__(self, database_url=f'sqlite:///{NAME_OF_DB}', **kwargs):
+        super().__init__(**kwargs)
+        self._database_url = database_url
+        self._lock = threading.Lock()
+
+    def __call__(self, **local_kw):
+        if self.kw.get('bind') is None:
+            with self._lock:
+                if self.kw.get('bind') is None:
+                    engine = create_db_engine(self._database_url)
+                    ensure_schema(engine)
+                    self.configure(bind=engine)
+        return super().__call__(**local_kw)
+
+
 # CRUD методы
 class DatabaseService:
     def __init__(self, session):
         self.session = session
 
+    # Внутри unit_of_work изменения только отправляются в БД (flush), чтобы у объектов появились id,
+    # а коммит делается один раз при выходе из самого внешнего блока
     def commit(self):
-        self.session.commit()
+        if self.session.info.get('unit_of_work', 0):
+            self.session.flush()
+        else:
+            self.session.commit()
+
+    @contextmanager
+    def unit_of_work(self):
+        info = self.session.info
+        info['unit_of_work'] = info.get('unit_of_work', 0) + 1
+        try:
+            yield self
+        except Exception:
+            info['unit_of_work'] -= 1
+            if info['unit_of_work'] == 0:
+                self.session.rollback()
+            raise
+        info['unit_of_work'] -= 1
+        if info['unit_of_work'] == 0:
+            self.session.commit()
 
     def add(self, obj):
         self.session.add(obj)
-        self.session.commit()
+        self.commit()
+
+    def add_all(self, objs):
+        self.session.add_all(objs)
+        self.commit()
+
+    # Вставка или обновление строк (словарей) по ключевым колонкам одним INSERT ... ON CONFLICT на пачку
+    def upsert(self, model, rows, index_elements=('id',), chunk_size=BULK_CHUNK_SIZE):
+        rows = list(rows)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            statement = sqlite_insert(model).values(chunk)
+            updated = {column: statement.excluded[column] for column in chunk[0] if column not in index_elements}
+            if updated:
+                statement = statement.on_conflict_do_update(index_elements=list(index_elements), set_=updated)
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=list(index_elements))
+            self.session.execute(statement)
+        self.commit()
+        return len(rows)
 
     def get(self, model, obj_id):
         return self.session.query(model).filter_by(id=obj_id).first()
@@ -236,14 +576,14 @@ class DatabaseService:
         if obj:
             for key, value in kwargs.items():
                 setattr(obj, key, value)
-            self.session.commit()
+            self.commit()
         return obj
 
     def delete(self, model, obj_id):
         obj = self.session.query(model).filter_by(id=obj_id).first()
         if obj:
             self.session.delete(obj)
-            self.session.commit()
+            self.commit()
         return obj
 
     def list(self, model):
@@ -259,28 +599,116 @@ class DatabaseService:
             return query.filter(key==value)
 
 
-# Инициализация базы данных
-Session = init_db()
-cur_session = Session()
+# Инициализация базы данных. У каждого потока своя сессия, поэтому обработчики telebot
+# могут работать параллельно, не разделяя одно соединение
+Session = LazySessionMaker()
+cur_session = scoped_session(Session)
 db_service = DatabaseService(cur_session)
+_update_scope = threading.local()
+
+
+# Переключение на другую БД (например, временную для нагрузочных тестов)
+def configure_db(database_url, **engine_kwargs):
+    engine = create_db_engine(database_url, **engine_kwargs)
+    ensure_schema(engine)
+    cur_session.remove()
+    cur_session.configure(bind=engine)
+    user_state_cache.invalidate()
+    return engine
+
+
+# Одна сессия на обработку одного апдейта: в конце обработчика сессия закрывается,
+# а при ошибке изменения откатываются. Вложенные вызовы обработчиков используют внешнюю сессию
+def session_per_update(handler):
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_update_scope, 'depth', 0)
+        _update_scope.depth = depth + 1
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            cur_session.rollback()
+            raise
+        finally:
+            _update_scope.depth = depth
+            if depth == 0:
+                cur_session.remove()
+    return wrapper
+
+
+# Список SQL-запросов, выполненных внутри блока, например: with count_queries() as statements: ...
+@contextmanager
+def count_queries(engine=None):
+    engine = engine or cur_session.get_bind()
+    statements = list()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# Как count_queries, но при выходе из блока проверяет, что запросов было не больше limit
+@contextmanager
+def query_budget(limit, name="", engine=None):
+    with count_queries(engine) as statements:
+        yield statements
+    if len(statements) > limit:
+        raise QueryBudgetExceeded(f"{name}: {len(statements)} SQL-запросов при бюджете {limit}:\n" +
+                                  "\n".join(statements))
+
+
+# Профили загрузки связей для помощников GET_*, которые возвращают ORM-объекты. Связи «многие к одному»
+# подгружаются тем же запросом (joined), списки — одним дополнительным запросом IN (...) на все объекты
+# (selectin), поэтому обращение к связи у результата не порождает отдельный ленивый запрос на каждый объект
+LOAD_PROFILES = {
+    "GET_USER": (joinedload(User.city),),
+    "GET_CENTERS_BY_TYPE": (joinedload(Center.type),),
+    "GET_CENTER": (joinedload(Center.type),),
+    "GET_PLACES": (joinedload(Place.center), joinedload(Place.city)),
+    "GET_PLACES_BY_CENTER": (joinedload(Place.center), joinedload(Place.city)),
+    "GET_PLACES_BY_CENTER_AND_CITY": (joinedload(Place.center), joinedload(Place.city)),
+    "GET_PLACE": (joinedload(Place.center), joinedload(Place.city), selectinload(Place.services)),
+    "GET_SERVICE": (joinedload(Service.type), selectinload(Service.places)),
+    "GET_SERVICES_BY_PLACE": (joinedload(Service.type),),
+    "GET_RECORD": (joinedload(Record.user), joinedload(Record.place), joinedload(Record.service)),
+}
+
+
+def _profiled(model, profile):
+    return db_service.session.query(model).options(*LOAD_PROFILES[profile])
+
+
+def _get(model, _id, profile):
+    return _profiled(model, profile).filter(model.id == _id).first()
 
 
 def SET_USER_CITY(_id, city_id):
-    user = db_service.get(User, _id)
+    user = db_service.update(User, _id, city_id=city_id)
     if user:
-        db_service.update(User, _id, city_id=city_id)
+        user_state_cache.put(_id, user_state_from_user(user))
 
 
 def ADD_USER_TO_BD(_id, number):
     user = db_service.get(User, _id)
     if user:
-        db_service.update(User, _id, number=number)
+        user = db_service.update(User, _id, number=number)
+        user_state_cache.put(_id, user_state_from_user(user))
 
 
 def ADD_PREUSER_TO_BD(_id, name=None):
     user = db_service.get(User, _id)
     if user:
-        db_service.update(User, _id, name=name, number=None)
+        user = db_service.update(User, _id, name=name, number=None)
+        user_state_cache.put(_id, user_state_from_user(user))
 
 
 def ADD_PREPREUSER_TO_BD(_id):
@@ -288,34 +716,54 @@ def ADD_PREPREUSER_TO_BD(_id):
     if not user:
         user = User(id=_id, name=None, number=None, list_of_records='[]')
         db_service.add(user)
+    user_state_cache.put(_id, user_state_from_user(user))
+
+
+# Завершение регистрации одной записью в users; промежуточные шаги хранятся в wizard.py
+def COMPLETE_REGISTRATION(_id, name, number):
+    statement = sqlite_insert(User).values(id=_id, name=name, number=number, list_of_records='[]')
+    statement = statement.on_conflict_do_update(index_elements=['id'], set_=dict(name=name, number=number))
+    city_id = db_service.session.execute(statement.returning(User.city_id)).scalar()
+    db_service.commit()
+    user_state_cache.put(_id, UserState(USER_STATUS_USER, name, city_id))
+
+
+# Периодическое сохранение незавершённых регистраций [(id, имя)]. Пользователя, который уже
+# успел указать номер, черновик не перезаписывает
+def SAVE_REGISTRATION_DRAFTS(drafts):
+    statement = sqlite_insert(User)
+    statement = statement.on_conflict_do_update(index_elements=['id'], set_=dict(name=statement.excluded.name),
+                                                where=User.number.is_(None))
+    db_service.session.execute(statement, [dict(id=_id, name=name, number=None, list_of_records='[]')
+                                           for _id, name in drafts])
+    db_service.commit()
+    for _id, name in drafts:
+        user_state_cache.invalidate(_id)
 
 
 def GET_USER(_id):
-    return db_service.get(User, _id)
+    return _get(User, _id, "GET_USER")
+
+
+# Одно обращение к БД на все проверки этапа регистрации; дальше состояние берётся из кэша
+def GET_USER_STATE(_id):
+    state = user_state_cache.get(_id)
+    if state is None:
+        state = user_state_from_user(db_service.get(User, _id))
+        user_state_cache.put(_id, state)
+    return state
 
 
 def CHECK_PREPREUSER(_id):
-    now_user = db_service.get(User, _id)
-    if now_user:
-        if now_user.name is None and now_user.number is None:
-            return True
-    return False
+    return GET_USER_STATE(_id).status == USER_STATUS_PREPREUSER
 
 
 def CHECK_PREUSER(_id):
-    now_user = db_service.get(User, _id)
-    if now_user:
-        if now_user.name is not None and now_user.number is None:
-            return True
-    return False
+    return GET_USER_STATE(_id).status == USER_STATUS_PREUSER
 
 
 def CHECK_USER(_id):
-    now_user = db_service.get(User, _id)
-    if now_user:
-        if now_user.name is not None and now_user.number is not None:
-            return True
-    return False
+    return GET_USER_STATE(_id).status == USER_STATUS_USER
 
 
 def GET_TYPE(type_name):
@@ -338,132 +786,489 @@ def GET_CITIES():
     return db_service.list(City)
 
 
+def _city_id(city):
+    return city.id if isinstance(city, City) else city
+
+
 def GET_CENTERS_BY_TYPE(_type):
-    # return db_service.list_with_filter(Center, Center.type_id, GET_TYPE(_type))
-    return db_service.get(Type, _type).centers
+    return _profiled(Center, "GET_CENTERS_BY_TYPE").filter(Center.type_id == _type).order_by(Center.id).all()
+
 
+# Сети нужного вида, у которых есть хотя бы один салон в городе: один запрос по индексам
+# centers(type_id) и places(city_id, center_id) вместо обхода всех салонов всех сетей
 def GET_CENTERS_BY_TYPE_AND_CITY(_type, city):
-    result = list()
-    for cur_center in GET_CENTERS_BY_TYPE(_type):
-        for place_of_cur_center in cur_center.places:
-            if place_of_cur_center.city == city:
-                break
-        else:
-            continue
-        result.append(cur_center)
-    return result
+    has_place_in_city = exists().where(Place.center_id == Center.id, Place.city_id == _city_id(city))
+    return db_service.session.query(Center) \
+        .filter(Center.type_id == _type, has_place_in_city) \
+        .order_by(Center.id).all()
 
 
 def GET_CENTER(_id):
-    return db_service.get(Center, _id)
+    return _get(Center, _id, "GET_CENTER")
 
 
 def GET_PLACES_BY_CENTER(_center_id):
-    return db_service.list_with_filter(Place, Place.center_id, _center_id)
+    return _profiled(Place, "GET_PLACES_BY_CENTER").filter(Place.center_id == _center_id).all()
 
 
 def GET_PLACES_BY_CENTER_AND_CITY(_center_id, city):
-    return db_service.only_filter(Place.city, city,
-                                  query=db_service.only_filter(Place.center_id, _center_id, model=Place))
+    return _profiled(Place, "GET_PLACES_BY_CENTER_AND_CITY") \
+        .filter(Place.center_id == _center_id, Place.city_id == _city_id(city))
 
 
 def GET_PLACES():
-    return db_service.list(Place)
+    return _profiled(Place, "GET_PLACES").all()
 
 
 def GET_PLACE(_id):
-    return db_service.get(Place, _id)
+    return _get(Place, _id, "GET_PLACE")
+
+
+def GET_SERVICE(_id):
+    return _get(Service, _id, "GET_SERVICE")
+
+
+def GET_SERVICES_BY_PLACE(_place_id):
+    return _profiled(Service, "GET_SERVICES_BY_PLACE") \
+        .join(ServicePlace, ServicePlace.service_id == Service.id) \
+        .filter(ServicePlace.place_id == _place_id) \
+        .order_by(Service.id).all()
+
+
+def GET_SERVICE_LINKS():
+    # Все связи услуга–салон вместе с видом услуги, сетью и городом салона одним запросом
+    return db_service.session.query(ServicePlace.service_id, Service.type_id, ServicePlace.place_id,
+                                    Place.center_id, Place.city_id) \
+        .join(Service, Service.id == ServicePlace.service_id) \
+        .join(Place, Place.id == ServicePlace.place_id).all()
+
+
+def GET_ACTIVE_RECORD_INTERVALS(_place_id, since):
+    # Только активные записи, которые ещё не закончились, уже отсортированные по началу
+    return db_service.session.query(Record.id, Record.start_date, Record.end_date) \
+        .filter(Record.place_id == _place_id, Record.active.is_(True), Record.end_date > since) \
+        .order_by(Record.start_date).all()
+
+
+# Изменение загрузки дня салона в текущей транзакции: sign = 1 для новой записи и -1 для отменённой
+def _add_occupancy(place_id, start_date, end_date, sign):
+    minutes = sign * int((end_date - start_date).total_seconds() // 60)
+    statement = sqlite_insert(PlaceDayOccupancy).values(place_id=place_id, day=start_date.date(),
+                                                        busy_minutes=minutes, records=sign)
+    db_service.session.execute(statement.on_conflict_do_update(
+        index_elements=['place_id', 'day'],
+        set_=dict(busy_minutes=PlaceDayOccupancy.busy_minutes + minutes, records=PlaceDayOccupancy.records + sign)))
+
+
+# Занятые минуты салона по дням из [first_day, last_day] одним запросом по первичному ключу; дней без записей нет
+def GET_PLACE_OCCUPANCY(place_id, first_day, last_day):
+    return dict(db_service.session.query(PlaceDayOccupancy.day, PlaceDayOccupancy.busy_minutes)
+                .filter(PlaceDayOccupancy.place_id == place_id, PlaceDayOccupancy.day >= first_day,
+                        PlaceDayOccupancy.day <= last_day).all())
+
+
+# Вес совпадения слова запроса в названии сети, адресе и услугах салона
+SEARCH_WEIGHTS = (3, 2, 1)
+
+
+# Салоны по свободному тексту: id салонов, в документах которых есть все слова запроса (any_word — хотя бы
+# одно), от лучшего совпадения к худшему по SEARCH_WEIGHTS. Слова короче 3 символов триграммный индекс
+# не ищет, поэтому они отбрасываются. bm25() здесь не подходит: ради статистики по всему индексу он проверяет
+# каждое слово во всех салонах всех городов, и это в разы дольше самого поиска. Совпадений в одном городе
+# немного, поэтому они сортируются здесь же; без города ранжируются первые SEARCH_RANK_LIMIT совпадений
+def SEARCH_PLACES(query, city_id=None, limit=SEARCH_RESULTS_LIMIT, any_word=False):
+    words = [word for word in re.findall(r"\w+", query.lower()) if len(word) >= SEARCH_MIN_WORD_LENGTH]
+    words = words[:SEARCH_MAX_WORDS]
+    if not words:
+        return []
+    # Каждое слово в кавычках: иначе FTS5 примет слова вроде or/not за операторы
+    match = "{center address services} : (" + (" OR " if any_word else " ").join(f'"{word}"' for word in words) + ")"
+    if city_id is not None:
+        match = f'city : "#{int(city_id)}#" AND {match}'
+    rows = db_service.session.execute(text(
+        "SELECT rowid, center, address, services FROM place_search WHERE place_search MATCH :match LIMIT :scan"),
+        dict(match=match, scan=SEARCH_RANK_LIMIT)).all()
+
+    def score(row):
+        columns = [(column or "").lower() for column in row[1:]]
+        return -sum(weight for word in words for weight, column in zip(SEARCH_WEIGHTS, columns) if word in column)
+    return [row[0] for row in sorted(rows, key=lambda row: (score(row), row[0]))[:limit]]
+
+
+# Пересечение с активными записями салона. lookback — самая длинная услуга: записи, начавшиеся раньше
+# start - lookback, закончились до start, и индекс records(place_id, start_date) читается только в этом окне
+def _record_overlaps(place_id, start, end, lookback):
+    return exists().where(Record.place_id == place_id, Record.active.is_(True),
+                          Record.start_date < end, Record.start_date > start - lookback, Record.end_date > start)
+
+
+def _hold_overlaps(place_id, user_id, start, end, now):
+    return exists().where(SlotHold.place_id == place_id, SlotHold.user_id != user_id, SlotHold.expires_at > now,
+                          SlotHold.start_date < end, SlotHold.end_date > start)
+
+
+def _insert_if_free(model, values, conflicts):
+    # INSERT ... SELECT ... WHERE NOT EXISTS (...): проверка и вставка одним оператором, который SQLite выполняет
+    # под блокировкой записи, поэтому два процесса не могут одновременно занять один и тот же интервал
+    columns = list(values)
+    statement = insert(model).from_select(
+        columns, select(*(literal(values[column], type_=model.__table__.c[column].type) for column in columns))
+        .where(*(~conflict for conflict in conflicts)))
+    result = db_service.session.execute(statement)
+    return result.lastrowid if result.rowcount == 1 else None
+
+
+def GET_ACTIVE_SLOT_HOLDS(_place_id, now):
+    return db_service.session.query(SlotHold.user_id, SlotHold.start_date, SlotHold.end_date, SlotHold.expires_at) \
+        .filter(SlotHold.place_id == _place_id, SlotHold.expires_at > now).all()
+
+
+# У пользователя не больше одной брони: новая бронь заменяет прежнюю. Заодно удаляются просроченные брони
+def HOLD_SLOT(user_id, place_id, service_id, start_date, end_date, expires_at, now, lookback):
+    try:
+        db_service.session.query(SlotHold).filter(or_(SlotHold.user_id == user_id, SlotHold.expires_at <= now)) \
+            .delete(synchronize_session=False)
+        hold_id = _insert_if_free(SlotHold, dict(user_id=user_id, place_id=place_id, service_id=service_id,
+                                                 start_date=start_date, end_date=end_date, expires_at=expires_at),
+                                  [_record_overlaps(place_id, start_date, end_date, lookback),
+                                   _hold_overlaps(place_id, user_id, start_date, end_date, now)])
+        db_service.commit()
+    except Exception:
+        db_service.session.rollback()
+        raise
+    return hold_id
+
+
+def RELEASE_SLOT_HOLDS(user_id):
+    db_service.session.query(SlotHold).filter(SlotHold.user_id == user_id).delete(synchronize_session=False)
+    db_service.commit()
+
+
+# Уведомление владельцу салона в текущей транзакции
+def _notify_owner(record_id, place_id, kind, now):
+    db_service.session.execute(insert(OutboxMessage).from_select(
+        ['recipient_id', 'record_id', 'kind', 'created_at', 'next_attempt_at', 'attempts'],
+        select(Place.owner_id, literal(record_id), literal(kind), literal(now, type_=DateTime),
+               literal(now, type_=DateTime), literal(0)).where(Place.id == place_id)))
+
+
+# Запись создаётся только если интервал свободен от чужих записей и чужих действующих броней;
+# своя бронь пользователя в той же транзакции удаляется. Возвращает запись или None, если слот занят
+def ADD_RECORD_IF_FREE(user_id, place_id, service_id, start_date, end_date, now, lookback):
+    try:
+        record_id = _insert_if_free(Record, dict(user_id=user_id, place_id=place_id, service_id=service_id,
+                                                 start_date=start_date, end_date=end_date, active=True),
+                                    [_record_overlaps(place_id, start_date, end_date, lookback),
+                                     _hold_overlaps(place_id, user_id, start_date, end_date, now)])
+        if record_id is None:
+            db_service.session.rollback()
+            return None
+        db_service.session.query(SlotHold).filter(SlotHold.user_id == user_id).delete(synchronize_session=False)
+        _add_occupancy(place_id, start_date, end_date, 1)
+        _notify_owner(record_id, place_id, OUTBOX_NEW_RECORD, now)
+        db_service.commit()
+    except Exception:
+        db_service.session.rollback()
+        raise
+    return GET_RECORD(record_id)
+
+
+# Запись, которой уже нет в records, ищется в архиве (без связей: их читают только у предстоящих записей)
+def GET_RECORD(_id):
+    return _get(Record, _id, "GET_RECORD") or db_service.get(RecordArchive, _id)
+
+
+# Предстоящие записи пользователя страницами по limit штук. Страница продолжается от записи-курсора
+# (after — следующие, before — предыдущие) по ключу (start_date, id) и читается по индексу
+# records(user_id, active, start_date) без OFFSET, поэтому время не зависит от длины истории.
+# Возвращает на одну строку больше limit, если дальше в этом направлении есть ещё записи
+def GET_UPCOMING_RECORDS(_user_id, since, limit, after=None, before=None):
+    query = db_service.session.query(Record.id, Record.place_id, Record.service_id, Record.start_date) \
+        .filter(Record.user_id == _user_id, Record.active.is_(True), Record.start_date >= since)
+    cursor = after if after is not None else before
+    if cursor is not None:
+        cursor_start = db_service.session.query(Record.start_date).filter(Record.id == cursor).scalar_subquery()
+        if after is not None:
+            query = query.filter(or_(Record.start_date > cursor_start,
+                                     and_(Record.start_date == cursor_start, Record.id > cursor)))
+        else:
+            query = query.filter(or_(Record.start_date < cursor_start,
+                                     and_(Record.start_date == cursor_start, Record.id < cursor)))
+    if before is not None:
+        rows = query.order_by(Record.start_date.desc(), Record.id.desc()).limit(limit + 1).all()
+        return rows[::-1]
+    return query.order_by(Record.start_date, Record.id).limit(limit + 1).all()
+
+
+# Отменить можно только ещё не начавшуюся запись: кнопка из старого сообщения не должна снимать прошедшую
+def CANCEL_USER_RECORD(_user_id, _record_id):
+    now = datetime.now()
+    record = db_service.session.query(Record) \
+        .filter(Record.id == _record_id, Record.user_id == _user_id, Record.active.is_(True),
+                Record.start_date > now).first()
+    if record:
+        record.active = False
+        _add_occupancy(record.place_id, record.start_date, record.end_date, -1)
+        _notify_owner(record.id, record.place_id, OUTBOX_CANCELLED_RECORD, now)
+        db_service.commit()
+    return record
+
+
+def _not_reminded():
+    return ~exists().where(RecordReminder.record_id == Record.id)
+
+
+# Активные записи, о которых ещё не напоминали, с началом в (since, until], по индексу records(start_date)
+def GET_RECORDS_TO_REMIND(since, until):
+    return db_service.session.query(Record.id, Record.start_date) \
+        .filter(Record.active.is_(True), Record.start_date > since, Record.start_date <= until, _not_reminded()) \
+        .order_by(Record.start_date).all()
+
+
+# Отмечает напоминания об ещё активных и не начавшихся записях отправленными и возвращает только те записи,
+# которые отметил именно этот вызов (INSERT ... ON CONFLICT DO NOTHING RETURNING), поэтому даже несколько
+# процессов бота не пришлют одно напоминание дважды
+def CLAIM_REMINDERS(record_ids, now):
+    statement = sqlite_insert(RecordReminder).from_select(
+        ['record_id', 'sent_at'],
+        select(Record.id, literal(now, type_=DateTime))
+        .where(Record.id.in_(record_ids), Record.active.is_(True), Record.start_date > now)) \
+        .on_conflict_do_nothing(index_elements=['record_id']).returning(RecordReminder.record_id)
+    try:
+        claimed = db_service.session.execute(statement).scalars().all()
+        db_service.commit()
+    except Exception:
+        db_service.session.rollback()
+        raise
+    if not claimed:
+        return []
+    return db_service.session.query(Record.id, Record.user_id, Record.place_id, Record.service_id, Record.start_date) \
+        .filter(Record.id.in_(claimed)).order_by(Record.start_date).all()
+
+
+# Снимает отметку с напоминаний, которые так и не удалось доставить: их можно взять снова
+def RELEASE_REMINDERS(record_ids):
+    db_service.session.query(RecordReminder).filter(RecordReminder.record_id.in_(record_ids)) \
+        .delete(synchronize_session=False)
+    db_service.commit()
+
+
+# Берёт в работу до limit неотправленных уведомлений, время которых пришло: попытка засчитывается сразу,
+# а следующая назначается через lease, так что другой процесс их не возьмёт, а если этот процесс упадёт,
+# уведомления повторятся. Возвращает уведомления вместе с данными записи и клиента
+def CLAIM_OUTBOX(now, limit, lease, max_attempts):
+    due = select(OutboxMessage.id) \
+        .where(OutboxMessage.sent_at.is_(None), OutboxMessage.next_attempt_at <= now,
+               OutboxMessage.attempts < max_attempts) \
+        .order_by(OutboxMessage.next_attempt_at).limit(limit)
+    statement = update(OutboxMessage).where(OutboxMessage.id.in_(due.scalar_subquery())) \
+        .values(attempts=OutboxMessage.attempts + 1, next_attempt_at=now + lease).returning(OutboxMessage.id)
+    try:
+        claimed = db_service.session.execute(statement).scalars().all()
+        db_service.commit()
+    except Exception:
+        db_service.session.rollback()
+        raise
+    if not claimed:
+        return []
+    return db_service.session.query(OutboxMessage.id, OutboxMessage.recipient_id, OutboxMessage.kind,
+                                    OutboxMessage.attempts, Record.place_id, Record.service_id, Record.start_date,
+                                    User.name, User.number) \
+        .join(Record, Record.id == OutboxMessage.record_id).join(User, User.id == Record.user_id) \
+        .filter(OutboxMessage.id.in_(claimed)).order_by(OutboxMessage.id).all()
+
+
+# sent — id доставленных уведомлений, retry — пары (id, время следующей попытки)
+def FINISH_OUTBOX(sent, retry, now):
+    try:
+        if sent:
+            db_service.session.execute(update(OutboxMessage).where(OutboxMessage.id.in_(sent)).values(sent_at=now))
+        if retry:
+            db_service.session.execute(update(OutboxMessage), [{"id": message_id, "next_attempt_at": retry_at}
+                                                               for message_id, retry_at in retry])
+        db_service.commit()
+    except Exception:
+        db_service.session.rollback()
+        raise
+
+
+# Перенос в архив до limit записей, которые закончились раньше before или отменены, одной короткой транзакцией.
+# Не переносятся записи с недоставленными уведомлениями владельцу (их читает CLAIM_OUTBOX) и запись
+# с наибольшим id: SQLite выдаёт новый id как max(id) + 1, и без неё id архивной записи достался бы новой.
+# Возвращает число перенесённых записей
+def ARCHIVE_RECORDS(before, limit, max_outbox_attempts):
+    pending = exists().where(OutboxMessage.record_id == Record.id, OutboxMessage.sent_at.is_(None),
+                             OutboxMessage.attempts < max_outbox_attempts)
+    batch = select(Record.id).where(or_(Record.end_date < before, Record.active.is_(False)), ~pending,
+                                    Record.id < select(func.max(Record.id)).scalar_subquery()) \
+        .order_by(Record.id).limit(limit)
+    columns = [column.name for column in Record.__table__.columns]
+    try:
+        # Первая же команда транзакции — запись, поэтому транзакции не нужно из читающей становиться пишущей
+        record_ids = db_service.session.execute(
+            insert(RecordArchive).from_select(columns, select(*Record.__table__.columns)
+                                              .where(Record.id.in_(batch.scalar_subquery())))
+            .returning(RecordArchive.id)).scalars().all()
+        if record_ids:
+            db_service.session.execute(delete(Record).where(Record.id.in_(record_ids)))
+            db_service.session.execute(delete(RecordReminder).where(RecordReminder.record_id.in_(record_ids)))
+        db_service.commit()
+    except Exception:
+        db_service.session.rollback()
+        raise
+    return len(record_ids)
+
+
+# Номер дня от 1970-01-01 и секунды от 1970-01-01 в SQLite: отчёты читают только целые числа,
+# которые сразу складываются в массивы numpy без создания объектов datetime
+JULIAN_DAY_1970 = 2440587.5
+
+
+def _epoch_day(column):
+    return cast(func.julianday(column) - JULIAN_DAY_1970, Integer)
+
+
+def _epoch_seconds(column):
+    return cast(func.strftime('%s', column), Integer)
+
+
+# Записи с началом в [since, until) (только салонов place_ids, если они заданы) пачками по chunk_size строк,
+# по колонкам: (place_id, service_id, начало в секундах от 1970-01-01, длительность в минутах, active).
+# Результат читается курсором по мере обхода
+def STREAM_RECORD_COLUMNS(since, until, chunk_size, place_ids=None):
+    queries = list()
+    # История читается и из records, и из архива
+    for model in (Record, RecordArchive):
+        minutes = cast(func.round((func.julianday(model.end_date) - func.julianday(model.start_date)) * 24 * 60),
+                       Integer)
+        query = select(model.place_id, model.service_id, _epoch_seconds(model.start_date), minutes,
+                       cast(model.active, Integer)).where(model.start_date >= since, model.start_date < until)
+        if place_ids is not None:
+            query = query.where(model.place_id.in_(place_ids))
+        queries.append(query)
+    result = db_service.session.execute(union_all(*queries).execution_options(yield_per=chunk_size))
+    for rows in result.partitions():
+        yield rows
+
+
+# Дневные итоги салонов place_ids за [since, until): (place_id, service_id, номер дня от 1970-01-01, час,
+# записи, отмены, занятые минуты)
+def GET_ROLLUP_COLUMNS(place_ids, since, until):
+    return db_service.session.execute(
+        select(RecordRollup.place_id, RecordRollup.service_id, _epoch_day(RecordRollup.day), RecordRollup.hour,
+               RecordRollup.records, RecordRollup.cancelled, RecordRollup.busy_minutes)
+        .where(RecordRollup.place_id.in_(place_ids), RecordRollup.day >= since, RecordRollup.day < until)).all()
+
+
+# День, до которого (не включая) итоги уже посчитаны: следующий после последнего дня с итогами
+def GET_ROLLUPS_END():
+    last_day = db_service.session.query(func.max(RecordRollup.day)).scalar()
+    return last_day + timedelta(days=1) if last_day else None
+
+
+# Итоги за [since, until) заменяются целиком: пересчёт тех же дней ничего не удваивает
+def SAVE_ROLLUPS(since, until, rows):
+    try:
+        db_service.session.execute(delete(RecordRollup).where(RecordRollup.day >= since, RecordRollup.day < until))
+        if rows:
+            db_service.session.execute(insert(RecordRollup), rows)
+        db_service.commit()
+    except Exception:
+        db_service.session.rollback()
+        raise
 
 
 # Пример использования
 if __name__ == '__main__':
-    # Пример добавления типов
-    type1 = Type(name='🧔 Барбершоп')
-    type2 = Type(name='💇 Парикмахерская')
-    type3 = Type(name='💅 Маникюр')
-    db_service.add(type1)
-    db_service.add(type2)
-    db_service.add(type3)
-
-    # Пример добавления городов
-    city1 = City(name='Казань')
-    city2 = City(name='Москва')
-    city3 = City(name='Санкт-Петербург')
-    db_service.add(city1)
-    db_service.add(city2)
-    db_service.add(city3)
-
-    user = User(id=955999723, name='Арслан', number='79999999999', city_id=city1.id, list_of_records='[]')
-    db_service.add(user)
-
-    # Пример добавления центра с типом
-    center1 = Center(name='Бороды по колено', type_id=1)
-    center2 = Center(name='Бритый пупочек', type_id=1)
-    center3 = Center(name='Электромагнит у дома', type_id=1)
-    db_service.add(center1)
-    db_service.add(center2)
-    db_service.add(center3)
-
-    service1 = Service(name='Особенные усы', type=type1, duration=40)
-    service2 = Service(name='Мощнейшие бакенбарды', type=type1, duration=30)
-    service3 = Service(name='Дизайнерская борода', type=type1)
-    db_service.add(service1)
-    db_service.add(service2)
-    db_service.add(service3)
-
-    place1 = Place(center_id=1, address='ул. Чистопольская, дом 72', city_id=city1.id, owner_id=user.id, services=[service1, service2])
-    place2 = Place(center_id=2, address='ул. Кремлёвская, дом 13', city_id=city1.id, owner_id=user.id, services=[service2])
-    place3 = Place(center_id=2, address='ул. Кремлёвская, дом 102', city_id=city2.id, owner_id=user.id, services=[service1, service2, service3])
-    place4 = Place(center_id=2, address='ул. Баумана, дом 25', city_id=city1.id, owner_id=user.id, services=[service1])
-    db_service.add(place1)
-    db_service.add(place2)
-    db_service.add(place3)
-    db_service.add(place4)
-
-    # Пример добавления центра с типом
-    center1 = Center(name='УФФ МАРИЯ', type_id=2)
-    center2 = Center(name='Парикмахерская', type_id=2)
-    db_service.add(center1)
-    db_service.add(center2)
-
-    service1 = Service(name='Красивая стрижка', type=type2, duration=90)
-    service2 = Service(name='Короткая стрижка', type=type2, duration=25)
-    service3 = Service(name='Под нолик "Пора в армию"', type=type2, duration=15)
-    db_service.add(service1)
-    db_service.add(service2)
-    db_service.add(service3)
-
-    place1 = Place(center_id=center1.id, address='ул. Петровская, дом 14', city_id=city1.id, owner_id=user.id, services=[service1, service2, service3])
-    place2 = Place(center_id=center1.id, address='ул. Сексуальная, дом 69', city_id=city1.id, owner_id=user.id, services=[service1, service2, service3])
-    place3 = Place(center_id=center2.id, address='ул. Обычная, дом 33', city_id=city1.id, owner_id=user.id, services=[service3])
-    db_service.add(place1)
-    db_service.add(place2)
-    db_service.add(place3)
-
-
-    # Пример добавления центра с типом
-    center1 = Center(name='Маник и педик быстро и недорого', type_id=3)
-    center2 = Center(name='Иванова Ивана Ивановна', type_id=3)
-    db_service.add(center1)
-    db_service.add(center2)
-
-    service1 = Service(name='Нюд', type=type3, duration=120)
-    service2 = Service(name='Красный маник', type=type3)
-    db_service.add(service1)
-    db_service.add(service2)
-
-    place1 = Place(center_id=center1.id, address='ул. Суперская, дом 3/В', city_id=city1.id, owner_id=user.id, services=[service1, service2])
-    place2 = Place(center_id=center1.id, address='ул. Запрещённая, дом 228', city_id=city1.id, owner_id=user.id, services=[service1])
-    place3 = Place(center_id=center1.id, address='ул. Сколько лет КФУ, дом 220', city_id=city1.id, owner_id=user.id, services=[service2])
-    place4 = Place(center_id=center2.id, address='ул. Декабристов, дом 47', city_id=city1.id, owner_id=user.id, services=[service1])
-    db_service.add(place1)
-    db_service.add(place2)
-    db_service.add(place3)
-    db_service.add(place4)
-
-    record = Record(user_id=user.id, place_id=place3.id, service=service2, start_date=datetime(2024, 11, 29, 12),
-                    end_date=datetime(2024, 11, 29, 13))
-    db_service.add(record)
+    # Все начальные данные добавляются одной транзакцией
+    with db_service.unit_of_work():
+        # Пример добавления типов
+        type1 = Type(name='🧔 Барбершоп')
+        type2 = Type(name='💇 Парикмахерская')
+        type3 = Type(name='💅 Маникюр')
+        db_service.add(type1)
+        db_service.add(type2)
+        db_service.add(type3)
+
+        # Пример добавления городов
+        city1 = City(name='Казань')
+        city2 = City(name='Москва')
+        city3 = City(name='Санкт-Петербург')
+        db_service.add(city1)
+        db_service.add(city2)
+        db_service.add(city3)
+
+        user = User(id=955999723, name='Арслан', number='79999999999', city_id=city1.id, list_of_records='[]')
+        db_service.add(user)
+
+        # Пример добавления центра с типом
+        center1 = Center(name='Бороды по колено', type_id=1)
+        center2 = Center(name='Бритый пупочек', type_id=1)
+        center3 = Center(name='Электромагнит у дома', type_id=1)
+        db_service.add(center1)
+        db_service.add(center2)
+        db_service.add(center3)
+
+        service1 = Service(name='Особенные усы', type=type1, duration=40)
+        service2 = Service(name='Мощнейшие бакенбарды', type=type1, duration=30)
+        service3 = Service(name='Дизайнерская борода', type=type1)
+        db_service.add(service1)
+        db_service.add(service2)
+        db_service.add(service3)
+
+        place1 = Place(center_id=1, address='ул. Чистопольская, дом 72', city_id=city1.id, owner_id=user.id, services=[service1, service2])
+        place2 = Place(center_id=2, address='ул. Кремлёвская, дом 13', city_id=city1.id, owner_id=user.id, services=[service2])
+        place3 = Place(center_id=2, address='ул. Кремлёвская, дом 102', city_id=city2.id, owner_id=user.id, services=[service1, service2, service3])
+        place4 = Place(center_id=2, address='ул. Баумана, дом 25', city_id=city1.id, owner_id=user.id, services=[service1])
+        db_service.add(place1)
+        db_service.add(place2)
+        db_service.add(place3)
+        db_service.add(place4)
+
+        # Пример добавления центра с типом
+        center1 = Center(name='УФФ МАРИЯ', type_id=2)
+        center2 = Center(name='Парикмахерская', type_id=2)
+        db_service.add(center1)
+        db_service.add(center2)
+
+        service1 = Service(name='Красивая стрижка', type=type2, duration=90)
+        service2 = Service(name='Короткая стрижка', type=type2, duration=25)
+        service3 = Service(name='Под нолик "Пора в армию"', type=type2, duration=15)
+        db_service.add(service1)
+        db_service.add(service2)
+        db_service.add(service3)
+
+        place1 = Place(center_id=center1.id, address='ул. Петровская, дом 14', city_id=city1.id, owner_id=user.id, services=[service1, service2, service3])
+        place2 = Place(center_id=center1.id, address='ул. Сексуальная, дом 69', city_id=city1.id, owner_id=user.id, services=[service1, service2, service3])
+        place3 = Place(center_id=center2.id, address='ул. Обычная, дом 33', city_id=city1.id, owner_id=user.id, services=[service3])
+        db_service.add(place1)
+        db_service.add(place2)
+        db_service.add(place3)
+
+
+        # Пример добавления центра с типом
+        center1 = Center(name='Маник и педик быстро и недорого', type_id=3)
+        center2 = Center(name='Иванова Ивана Ивановна', type_id=3)
+        db_service.add(center1)
+        db_service.add(center2)
+
+        service1 = Service(name='Нюд', type=type3, duration=120)
+        service2 = Service(name='Красный маник', type=type3)
+        db_service.add(service1)
+        db_service.add(service2)
+
+        place1 = Place(center_id=center1.id, address='ул. Суперская, дом 3/В', city_id=city1.id, owner_id=user.id, services=[service1, service2])
+        place2 = Place(center_id=center1.id, address='ул. Запрещённая, дом 228', city_id=city1.id, owner_id=user.id, services=[service1])
+        place3 = Place(center_id=center1.id, address='ул. Сколько лет КФУ, дом 220', city_id=city1.id, owner_id=user.id, services=[service2])
+        place4 = Place(center_id=center2.id, address='ул. Декабристов, дом 47', city_id=city1.id, owner_id=user.id, services=[service1])
+        db_service.add(place1)
+        db_service.add(place2)
+        db_service.add(place3)
+        db_service.add(place4)
+
+        record = Record(user_id=user.id, place_id=place3.id, service=service2, start_date=datetime(2024, 11, 29, 12),
+                        end_date=datetime(2024, 11, 29, 13))
+        db_service.add(record)
 
     print('All Types:', db_service.list(Type))
     print('All Services:', db_service.list(Service))
@@ -0,0 +1,56 @@
+import telebot
+
+import screens
+from database_root import session_per_update
+from metrics import instrument_update
+from renderer import Renderer
+from router import router
+from send_queue import SendQueue
+from settings import BOT_NUM_THREADS
+
+
+# Бот с обработчиками всех апдейтов. Используется и обычным запуском (main.py), и процессами-обработчиками
+# многопроцессного режима (workers.py): там threaded=False, чтобы апдейты одного чата шли строго по порядку,
+# а параметры очереди отправки делят общий лимит Telegram между процессами
+def create_bot(token, threaded=True, num_threads=BOT_NUM_THREADS, **send_queue_options):
+    bot = telebot.TeleBot(token, threaded=threaded, num_threads=num_threads)
+    # Обработчики не ждут ответа Telegram: сообщения уходят через очередь с учётом лимитов Bot API
+    send_queue = SendQueue(bot, **send_queue_options)
+    # После нажатия кнопки экран по возможности показывается правкой старого сообщения, а не новым сообщением
+    renderer = Renderer(send_queue)
+
+    def send_replies(message, replies, edit=False):
+        renderer.render(message, replies, edit=edit)
+
+    @bot.message_handler(commands=['start'])
+    @instrument_update("start")
+    @session_per_update
+    def start(message):
+        send_replies(message, screens.on_start(message))
+
+    @bot.message_handler(commands=['report'])
+    @instrument_update("report")
+    @session_per_update
+    def report(message):
+        send_replies(message, screens.on_report(message))
+
+    @bot.message_handler(func=lambda message: True)
+    @instrument_update("handle_message")
+    @session_per_update
+    def handle_message(message):
+        send_replies(message, screens.on_message(message))
+
+    @bot.message_handler(content_types=['contact'])
+    @instrument_update("contact")
+    @session_per_update
+    def contact(message):
+        send_replies(message, screens.on_contact(message))
+
+    @bot.callback_query_handler(func=lambda call: True)
+    @instrument_update("callback", label=lambda call: f"callback/{router.route_name(call.data)}")
+    @session_per_update
+    def callback_inline(call):
+        if call.data:
+            send_replies(call.message, screens.on_callback(call), edit=True)
+
+    return bot, send_queue
@@ -0,0 +1,103 @@
+import csv
+import json
+import os
+import sys
+from itertools import islice
+
+from sqlalchemy import Integer, tuple_
+
+from database_root import db_service, session_per_update, Type, City, Center, Place, Service, ServicePlace
+from settings import BULK_CHUNK_SIZE
+
+# Потоковая загрузка справочников партнёрской сети. В папке лежат файлы <таблица>.csv или <таблица>.jsonl
+# (JSON Lines: один объект на строку), например places.csv с колонками id,center_id,address,city_id,owner_id.
+# Файлы читаются пачками по BULK_CHUNK_SIZE строк, поэтому память не зависит от размера файла,
+# а весь импорт выполняется одной транзакцией.
+IMPORT_ORDER = (Type, City, Center, Place, Service, ServicePlace)
+
+
+def read_rows(path):
+    with open(path, encoding='utf-8', newline='') as file:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def read_chunks(rows, chunk_size=BULK_CHUNK_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def convert_row(model, row):
+    # В CSV все значения строки: приводим их к типам колонок, пустые значения считаем NULL
+    result = dict()
+    for column in model.__table__.columns:
+        if column.name not in row:
+            continue
+        value = row[column.name]
+        if value == '' or value is None:
+            value = None
+        elif isinstance(column.type, Integer):
+            value = int(value)
+        result[column.name] = value
+    return result
+
+
+def find_file(directory, model):
+    for extension in ('.csv', '.jsonl'):
+        path = os.path.join(directory, model.__tablename__ + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def import_links(rows):
+    # У service_place нет уникального ключа по паре (услуга, салон), поэтому уже существующие связи
+    # отсеиваются одним запросом на пачку
+    pairs = {(row['service_id'], row['place_id']): row for row in rows}
+    existing = db_service.session.query(ServicePlace.service_id, ServicePlace.place_id) \
+        .filter(tuple_(ServicePlace.service_id, ServicePlace.place_id).in_(list(pairs))).all()
+    for pair in existing:
+        pairs.pop(tuple(pair), None)
+    new_rows = [row for row in pairs.values() if 'id' not in row]
+    if new_rows:
+        db_service.upsert(ServicePlace, new_rows)
+    with_ids = [row for row in pairs.values() if 'id' in row]
+    if with_ids:
+        db_service.upsert(ServicePlace, with_ids)
+    return len(pairs)
+
+
+@session_per_update
+def import_catalog(directory, chunk_size=BULK_CHUNK_SIZE):
+    imported = dict()
+    with db_service.unit_of_work():
+        for model in IMPORT_ORDER:
+            path = find_file(directory, model)
+            if path is None:
+                continue
+            count = 0
+            for chunk in read_chunks(read_rows(path), chunk_size):
+                rows = [convert_row(model, row) for row in chunk]
+                if model is ServicePlace:
+                    count += import_links(rows)
+                else:
+                    count += db_service.upsert(model, rows, chunk_size=chunk_size)
+                db_service.session.expunge_all()
+            imported[model.__tablename__] = count
+    return imported
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Использование: python importer.py <папка с файлами справочников>")
+        sys.exit(1)
+    for table, count in import_catalog(sys.argv[1]).items():
+        print(f"{table}: {count}")
@@ -0,0 +1,333 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from settings import METRICS_PORT, METRICS_FILE, METRICS_DUMP_INTERVAL, SLOW_UPDATE_MS, SLOW_UPDATE_LOG, \
+    SLOW_UPDATE_KEEP
+
+# Метрики обработки апдейтов. Каждый обработчик telebot оборачивается в instrument_update: на время апдейта
+# заводится UpdateStats, в который события движка SQLAlchemy складывают число и время SQL-запросов,
+# а очередь отправки — число запросов к Bot API. По завершении апдейта всё попадает в гистограммы
+# с меткой обработчика (для нажатий на кнопки — имя маршрута), которые отдаются в текстовом формате
+# Prometheus по HTTP (METRICS_PORT) и/или периодически записываются в файл (METRICS_FILE).
+# Если задан SLOW_UPDATE_MS, для каждого апдейта запоминаются тексты запросов, и апдейты дольше порога
+# пишутся в SLOW_UPDATE_LOG, а SLOW_UPDATE_KEEP самых медленных доступны по адресу /slow.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_current_update = ContextVar('current_update', default=None)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricFamily:
+    def __init__(self, name, kind, help_text, label_names, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = dict()
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = dict()
+
+    def counter(self, name, help_text, *label_names):
+        self._families[name] = MetricFamily(name, 'counter', help_text, label_names)
+
+    def histogram(self, name, help_text, buckets, *label_names):
+        self._families[name] = MetricFamily(name, 'histogram', help_text, label_names, buckets)
+
+    def inc(self, name, *labels, amount=1):
+        family = self._families[name]
+        with self._lock:
+            family.series[labels] = family.series.get(labels, 0) + amount
+
+    def observe(self, name, value, *labels):
+        family = self._families[name]
+        with self._lock:
+            histogram = family.series.get(labels)
+            if histogram is None:
+                histogram = family.series[labels] = Histogram(family.buckets)
+            histogram.observe(value)
+
+    def get(self, name, *labels):
+        with self._lock:
+            return self._families[name].series.get(labels)
+
+    def render(self):
+        lines = list()
+        with self._lock:
+            for family in self._families.values():
+                lines.append(f"# HELP {family.name} {family.help_text}")
+                lines.append(f"# TYPE {family.name} {family.kind}")
+                for labels, value in sorted(family.series.items()):
+                    if family.kind == 'counter':
+                        lines.append(f"{family.name}{_labels(family.label_names, labels)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*family.buckets, "+Inf"), value.counts):
+                        cumulative += count
+                        lines.append(f"{family.name}_bucket"
+                                     f"{_labels(family.label_names, labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{family.name}_sum{_labels(family.label_names, labels)} {value.sum}")
+                    lines.append(f"{family.name}_count{_labels(family.label_names, labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.counter('bot_updates_total', "Обработанные апдейты", 'handler', 'status')
+metrics.histogram('bot_update_duration_seconds', "Время обработки апдейта", LATENCY_BUCKETS, 'handler')
+metrics.histogram('bot_update_sql_statements', "SQL-запросов за апдейт", COUNT_BUCKETS, 'handler')
+metrics.histogram('bot_update_sql_seconds', "Время SQL-запросов за апдейт", LATENCY_BUCKETS, 'handler')
+metrics.histogram('bot_update_api_calls', "Запросов к Bot API за апдейт", COUNT_BUCKETS, 'handler')
+metrics.counter('bot_api_requests_total', "Выполненные запросы к Bot API", 'method', 'status')
+metrics.histogram('bot_api_request_seconds', "Время запроса к Bot API", LATENCY_BUCKETS, 'method')
+
+
+# pending — сколько ещё частей апдейта не закончилось: сам обработчик и отложенная работа (hold_update),
+# например ответы, которые отрисовщик ставит в очередь после правки сообщения. Метрики апдейта
+# записываются, когда закончится последняя часть
+class UpdateStats:
+    __slots__ = ('handler', 'sql_statements', 'sql_time', 'api_calls', 'queries', 'pending', 'elapsed', 'failed')
+
+    def __init__(self, handler, capture_queries=False):
+        self.handler = handler
+        self.sql_statements = 0
+        self.sql_time = 0.0
+        self.api_calls = 0
+        self.queries = list() if capture_queries else None
+        self.pending = 1
+        self.elapsed = 0.0
+        self.failed = False
+
+
+class SlowUpdateLog:
+    def __init__(self, threshold_ms=SLOW_UPDATE_MS, path=SLOW_UPDATE_LOG, keep=SLOW_UPDATE_KEEP):
+        self.threshold_ms = threshold_ms
+        self.path = path
+        self.keep = keep
+        self._worst = list()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold_ms is not None
+
+    def add(self, update, elapsed, failed):
+        elapsed_ms = elapsed * 1000
+        if elapsed_ms < self.threshold_ms:
+            return
+        entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "handler": update.handler, "ms": round(elapsed_ms, 2),
+                 "failed": failed, "sql_statements": update.sql_statements,
+                 "sql_ms": round(update.sql_time * 1000, 2), "api_calls": update.api_calls,
+                 "queries": [{"ms": round(ms, 3), "sql": statement} for ms, statement in update.queries]}
+        with self._lock:
+            if len(self._worst) < self.keep:
+                heapq.heappush(self._worst, (elapsed_ms, next(self._seq), entry))
+            elif self.keep:
+                heapq.heappushpop(self._worst, (elapsed_ms, next(self._seq), entry))
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def worst(self):
+        with self._lock:
+            return [entry for _, _, entry in sorted(self._worst, reverse=True)]
+
+
+slow_updates = SlowUpdateLog()
+
+
+_pending_lock = threading.Lock()
+
+
+def _finish_update(update, elapsed, failed):
+    update.elapsed = elapsed
+    update.failed = failed
+    release_update(update)
+
+
+# Отложенная работа текущего апдейта: метрики апдейта не записываются, пока для каждого hold_update
+# не вызван release_update. Саму работу нужно выполнять в контексте апдейта (contextvars.copy_context),
+# чтобы её запросы к Bot API и SQL учитывались в нём
+def hold_update():
+    update = _current_update.get()
+    if update is not None:
+        with _pending_lock:
+            update.pending += 1
+    return update
+
+
+def release_update(update):
+    if update is None:
+        return
+    with _pending_lock:
+        update.pending -= 1
+        if update.pending:
+            return
+    metrics.inc('bot_updates_total', update.handler, "error" if update.failed else "ok")
+    metrics.observe('bot_update_duration_seconds', update.elapsed, update.handler)
+    metrics.observe('bot_update_sql_statements', update.sql_statements, update.handler)
+    metrics.observe('bot_update_sql_seconds', update.sql_time, update.handler)
+    metrics.observe('bot_update_api_calls', update.api_calls, update.handler)
+    if update.queries is not None:
+        slow_updates.add(update, update.elapsed, update.failed)
+
+
+# handler — имя обработчика в метриках; label(*args) может уточнить его по самому апдейту (например, по маршруту)
+def instrument_update(handler_name, label=None):
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            if _current_update.get() is not None:
+                return handler(*args, **kwargs)
+            update = UpdateStats(label(*args) if label else handler_name, capture_queries=slow_updates.enabled)
+            token = _current_update.set(update)
+            started = time.perf_counter()
+            failed = False
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                _current_update.reset(token)
+                _finish_update(update, time.perf_counter() - started, failed)
+        return wrapper
+    return decorator
+
+
+def instrument_update_async(handler_name, label=None):
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(*args, **kwargs):
+            update = UpdateStats(label(*args) if label else handler_name, capture_queries=slow_updates.enabled)
+            token = _current_update.set(update)
+            started = time.perf_counter()
+            failed = False
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                _current_update.reset(token)
+                _finish_update(update, time.perf_counter() - started, failed)
+        return wrapper
+    return decorator
+
+
+def record_api_call():
+    update = _current_update.get()
+    if update is not None:
+        update.api_calls += 1
+
+
+def record_api_request(method, elapsed, status):
+    metrics.inc('bot_api_requests_total', method, status)
+    metrics.observe('bot_api_request_seconds', elapsed, method)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_update.get() is not None:
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    update = _current_update.get()
+    if update is None or not conn.info.get('metrics_started'):
+        return
+    elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+    update.sql_statements += 1
+    update.sql_time += elapsed
+    if update.queries is not None:
+        update.queries.append((elapsed * 1000, statement))
+
+
+def start_metrics_server(port=METRICS_PORT, host='0.0.0.0'):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.render().encode(), "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == '/slow':
+                body, content_type = json.dumps(slow_updates.worst(), ensure_ascii=False).encode(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+def dump_metrics(path=METRICS_FILE):
+    # Запись через временный файл, чтобы читатель никогда не увидел недописанный файл
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        file.write(metrics.render())
+    os.replace(path + ".tmp", path)
+
+
+def start_metrics_dump(path=METRICS_FILE, interval=METRICS_DUMP_INTERVAL):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                dump_metrics(path)
+            except OSError as e:
+                print(f"Не удалось записать метрики в {path}: {e}")
+
+    threading.Thread(target=loop, name='metrics-dump', daemon=True).start()
+
+
+def start_metrics_export():
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT)
+    if METRICS_FILE is not None:
+        start_metrics_dump(METRICS_FILE, METRICS_DUMP_INTERVAL)
@@ -0,0 +1,136 @@
+import threading
+from collections import defaultdict
+from concurrent.futures import wait
+from datetime import datetime, timedelta
+
+from catalog import catalog
+from database_root import session_per_update, CLAIM_OUTBOX, FINISH_OUTBOX, OUTBOX_NEW_RECORD
+from send_queue import LANE_NOTIFICATION
+from settings import OUTBOX_INTERVAL_SECONDS, OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS, OUTBOX_MAX_ATTEMPTS, \
+    OUTBOX_RETRY_BASE_SECONDS, OUTBOX_RETRY_MAX_SECONDS
+
+# Столько строк в одной сводке точно укладывается в лимит длины сообщения Telegram
+DIGEST_MAX_ROWS = 25
+
+
+# Фоновая отправка уведомлений владельцам салонов из таблицы outbox. Раз в OUTBOX_INTERVAL_SECONDS диспетчер
+# берёт пачку неотправленных уведомлений, собирает все уведомления одного владельца в одну сводку
+# и ставит сводки в очередь уведомлений. Доставленные уведомления отмечаются отправленными, а недоставленные
+# повторяются с паузой OUTBOX_RETRY_BASE_SECONDS, 2 * OUTBOX_RETRY_BASE_SECONDS, ... (не больше
+# OUTBOX_RETRY_MAX_SECONDS), всего до OUTBOX_MAX_ATTEMPTS попыток
+class OutboxDispatcher:
+    def __init__(self, send=None, interval=OUTBOX_INTERVAL_SECONDS, batch_size=OUTBOX_BATCH_SIZE,
+                 lease=timedelta(seconds=OUTBOX_LEASE_SECONDS), max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 retry_base=timedelta(seconds=OUTBOX_RETRY_BASE_SECONDS),
+                 retry_max=timedelta(seconds=OUTBOX_RETRY_MAX_SECONDS)):
+        self.send = send
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self.stats = {"notifications": 0, "digests": 0, "sent": 0, "retried": 0}
+
+    def retry_delay(self, attempts):
+        return min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+
+    # Одна пачка: возвращает число взятых уведомлений (если пачка полная, следующую можно брать сразу)
+    def run_once(self, now=None):
+        now = now or datetime.now()
+        rows = _claim(now, self.batch_size, self.lease, self.max_attempts)
+        if not rows:
+            return 0
+        by_recipient = defaultdict(list)
+        for row in rows:
+            by_recipient[row.recipient_id].append(row)
+
+        futures = dict()
+        for recipient_id, recipient_rows in by_recipient.items():
+            for start in range(0, len(recipient_rows), DIGEST_MAX_ROWS):
+                chunk = recipient_rows[start:start + DIGEST_MAX_ROWS]
+                futures[self.send(recipient_id, digest_text(chunk))] = chunk
+        # Недождавшиеся сводки повторятся, когда истечёт lease
+        done, _ = wait(futures, timeout=self.lease.total_seconds() / 2)
+        sent, retry = list(), list()
+        for future in done:
+            if future.exception() is None:
+                sent.extend(row.id for row in futures[future])
+            else:
+                retry.extend((row.id, now + self.retry_delay(row.attempts)) for row in futures[future])
+        _finish(sent, retry, datetime.now())
+
+        self.stats["notifications"] += len(rows)
+        self.stats["digests"] += len(futures)
+        self.stats["sent"] += len(sent)
+        self.stats["retried"] += len(retry)
+        return len(rows)
+
+    def start(self, send=None):
+        with self._cond:
+            self.send = send or self.send
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name='outbox', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped:
+            try:
+                full = self.run_once() == self.batch_size
+            except Exception as e:
+                print(f"Не удалось разослать уведомления салонам: {e}")
+                full = False
+            if full:
+                continue
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(self.interval)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+
+@session_per_update
+def _claim(now, limit, lease, max_attempts):
+    return CLAIM_OUTBOX(now, limit, lease, max_attempts)
+
+
+@session_per_update
+def _finish(sent, retry, now):
+    FINISH_OUTBOX(sent, retry, now)
+
+
+def digest_text(rows):
+    snapshot = catalog.snapshot()
+    lines = {True: list(), False: list()}
+    for row in sorted(rows, key=lambda row: row.start_date):
+        place = snapshot.place_by_id.get(row.place_id)
+        service = snapshot.service_by_id.get(row.service_id)
+        lines[row.kind == OUTBOX_NEW_RECORD].append(
+            f"• {row.start_date.strftime('%d.%m.%Y %H:%M')} — {service.name if service else 'услуга'}, "
+            f"{place.address if place else 'салон'}, клиент {row.name or 'без имени'}"
+            f"{f' (+{row.number})' if row.number else ''}")
+    parts = list()
+    if lines[True]:
+        parts.append("📥 Новые записи в ваши салоны:\n" + "\n".join(lines[True]))
+    if lines[False]:
+        parts.append("❌ Отменённые записи:\n" + "\n".join(lines[False]))
+    return "\n\n".join(parts)
+
+
+outbox_dispatcher = OutboxDispatcher()
+
+
+# Сводки идут в очередь уведомлений без coalesce_key: уведомления владельца уже собраны в сводки здесь,
+# а склеенные очередью сводки вернули бы одно будущее на несколько пачек, и часть строк не отметилась бы
+# отправленной
+def start_outbox(send_queue):
+    outbox_dispatcher.start(lambda chat_id, text: send_queue.send_message(chat_id, text, lane=LANE_NOTIFICATION))
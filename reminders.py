@@ -0,0 +1,177 @@
+import heapq
+import threading
+from datetime import datetime, timedelta
+
+from catalog import catalog
+from database_root import session_per_update, GET_RECORDS_TO_REMIND, CLAIM_REMINDERS, RELEASE_REMINDERS
+from send_queue import LANE_NOTIFICATION
+from settings import REMINDER_LEAD_MINUTES, REMINDER_WINDOW_HOURS, REMINDER_BATCH_SIZE, REMINDER_RETRY_SECONDS
+
+
+# Напоминания о записях без опроса таблицы records каждую минуту. В памяти держится только окно
+# из записей, напоминание о которых наступит в ближайшие REMINDER_WINDOW_HOURS часов, в куче по времени
+# напоминания; поток спит до ближайшего напоминания или до конца окна, а в конце окна читает следующее.
+# Новые записи и отмены попадают в кучу сразу (schedule/cancel), отменённые элементы просто пропускаются.
+# Перед отправкой пачка напоминаний отмечается в record_reminders, поэтому после перезапуска окно читается
+# заново без уже отправленных напоминаний и без отменённых за это время записей. Если отправка не удалась
+# (кончились повторы очереди отправки, ошибка сети), отметка снимается и напоминание повторяется через
+# retry_delay, пока запись не началась. Напоминания, взятые процессом, который упал до отправки, теряются:
+# в этом случае доставка не больше одного раза
+class ReminderScheduler:
+    def __init__(self, send=None, lead=timedelta(minutes=REMINDER_LEAD_MINUTES),
+                 window=timedelta(hours=REMINDER_WINDOW_HOURS), batch_size=REMINDER_BATCH_SIZE, loader=None,
+                 claimer=None, releaser=None, retry_delay=timedelta(seconds=REMINDER_RETRY_SECONDS)):
+        self.send = send
+        self.lead = lead
+        self.window = window
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._loader = loader or _load_window
+        self._claimer = claimer or _claim
+        self._releaser = releaser or _release
+        self._heap = list()
+        self._pending = dict()
+        self._window_end = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self.stats = {"loaded": 0, "scheduled": 0, "cancelled": 0, "sent": 0, "batches": 0, "retried": 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def load(self, now=None):
+        now = now or datetime.now()
+        window_end = now + self.window
+        rows = self._loader(now, window_end + self.lead)
+        with self._cond:
+            self._heap = [(start_date - self.lead, record_id, start_date) for record_id, start_date in rows]
+            heapq.heapify(self._heap)
+            self._pending = {record_id: start_date for record_id, start_date in rows}
+            self._window_end = window_end
+            self.stats["loaded"] += len(rows)
+            self._cond.notify_all()
+
+    # Новая запись: если напоминание о ней наступит до конца текущего окна, она сразу встаёт в кучу,
+    # иначе её прочитает следующее окно. О записи меньше чем за lead до начала не напоминают
+    def schedule(self, record_id, start_date, now=None):
+        now = now or datetime.now()
+        with self._cond:
+            remind_at = start_date - self.lead
+            if self._window_end is None or remind_at <= now or remind_at > self._window_end:
+                return
+            self._pending[record_id] = start_date
+            heapq.heappush(self._heap, (remind_at, record_id, start_date))
+            self.stats["scheduled"] += 1
+            self._cond.notify_all()
+
+    # Недоставленное напоминание: отметка в record_reminders снимается, и через retry_delay оно снова в куче
+    def retry(self, record_id, start_date, now=None):
+        now = now or datetime.now()
+        self._releaser([record_id])
+        with self._cond:
+            if record_id in self._pending:
+                return
+            self._pending[record_id] = start_date
+            heapq.heappush(self._heap, (now + self.retry_delay, record_id, start_date))
+            self.stats["retried"] += 1
+            self._cond.notify_all()
+
+    def cancel(self, record_id):
+        with self._cond:
+            if self._pending.pop(record_id, None) is not None:
+                self.stats["cancelled"] += 1
+
+    def due(self, now):
+        # Снимает с кучи до batch_size наступивших напоминаний, пропуская отменённые и перенесённые
+        result = list()
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now and len(result) < self.batch_size:
+                remind_at, record_id, start_date = heapq.heappop(self._heap)
+                if self._pending.get(record_id) == start_date:
+                    del self._pending[record_id]
+                    result.append(record_id)
+        return result
+
+    # Один шаг: отправка пачки наступивших напоминаний и, если окно кончилось, чтение следующего.
+    # Возвращает, сколько секунд можно спать до следующего события
+    def run_once(self, now=None):
+        now = now or datetime.now()
+        record_ids = self.due(now)
+        if record_ids:
+            self.stats["sent"] += self._claimer(record_ids, now, self.send, self.retry)
+            self.stats["batches"] += 1
+        if self._window_end is None or now >= self._window_end:
+            self.load(now)
+        with self._cond:
+            wake_at = min(self._heap[0][0], self._window_end) if self._heap else self._window_end
+        return 0 if len(record_ids) == self.batch_size else max((wake_at - now).total_seconds(), 0)
+
+    def start(self, send=None):
+        with self._cond:
+            self.send = send or self.send
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name='reminders', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped:
+            try:
+                wait = self.run_once()
+            except Exception as e:
+                print(f"Не удалось отправить напоминания: {e}")
+                wait = 60
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(wait)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+
+@session_per_update
+def _load_window(since, until):
+    return [(record_id, start_date) for record_id, start_date in GET_RECORDS_TO_REMIND(since, until)]
+
+
+def reminder_text(place_id, service_id, start_date):
+    snapshot = catalog.snapshot()
+    place = snapshot.place_by_id.get(place_id)
+    service = snapshot.service_by_id.get(service_id)
+    return (f"⏰ Напоминаем: {start_date.strftime('%d.%m.%Y в %H:%M')} вы записаны"
+            f"{f' на «{service.name}»' if service else ''}"
+            f"{f' в салон по адресу {place.address}' if place else ''}")
+
+
+# failed(record_id, start_date) вызывается, когда отправка напоминания завершилась ошибкой
+@session_per_update
+def _claim(record_ids, now, send, failed):
+    rows = CLAIM_REMINDERS(record_ids, now)
+    for record_id, user_id, place_id, service_id, start_date in rows:
+        future = send(user_id, reminder_text(place_id, service_id, start_date))
+
+        def done(future, record_id=record_id, start_date=start_date):
+            if future.exception() is not None:
+                failed(record_id, start_date)
+        future.add_done_callback(done)
+    return len(rows)
+
+
+@session_per_update
+def _release(record_ids):
+    RELEASE_REMINDERS(record_ids)
+
+
+reminder_scheduler = ReminderScheduler()
+
+
+# Напоминания идут в очередь уведомлений; несколько напоминаний одному пользователю, которые ещё не ушли,
+# склеиваются в одно сообщение с общим будущим, поэтому при ошибке повторяются все склеенные напоминания
+def start_reminders(send_queue):
+    reminder_scheduler.start(lambda chat_id, text: send_queue.send_message(chat_id, text, lane=LANE_NOTIFICATION,
+                                                                           coalesce_key='reminder'))
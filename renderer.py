@@ -0,0 +1,115 @@
+import contextvars
+import json
+import time
+
+from telebot.apihelper import ApiTelegramException
+from telebot.types import InlineKeyboardMarkup
+
+from catalog import SerializedMarkup
+from metrics import record_api_call, record_api_request, hold_update, release_update
+
+# Отрисовка экранов. После нажатия inline-кнопки первый ответ экрана по возможности заменяет текст и клавиатуру
+# старого сообщения (один editMessageText вместо sendMessage + deleteMessage), а остальные ответы отправляются
+# новыми сообщениями — уже после правки, чтобы не обогнать её. Если первый ответ нельзя показать правкой
+# (например, у него обычная клавиатура под полем ввода) или правка не удалась, все сообщения отправляются
+# заново, а старое удаляется. Если экран не изменился (кнопка без действия), старое сообщение не трогается.
+SEND = "send"
+EDIT = "edit"
+DELETE = "delete"
+
+
+def is_editable(reply):
+    return reply.markup is None or isinstance(reply.markup, (InlineKeyboardMarkup, SerializedMarkup))
+
+
+# Текст и клавиатура ответа совпадают с тем, что уже показано в сообщении
+def is_unchanged(message, reply):
+    markup = getattr(message, 'reply_markup', None)
+    current = markup.to_dict() if markup is not None else None
+    new = json.loads(reply.markup.to_json()) if reply.markup is not None else None
+    return (getattr(message, 'text', None) or "") == reply.text.strip() and current == new
+
+
+def plan_render(replies, edit, message=None):
+    if edit and replies and is_editable(replies[0]):
+        first = [] if message is not None and is_unchanged(message, replies[0]) else [(EDIT, replies[0])]
+        return first + [(SEND, reply) for reply in replies[1:]]
+    actions = [(SEND, reply) for reply in replies]
+    if edit:
+        actions.append((DELETE, None))
+    return actions
+
+
+def is_not_modified(error):
+    # Telegram отказывается править сообщение, если текст и клавиатура не изменились: экран уже показан
+    return isinstance(error, ApiTelegramException) and "message is not modified" in str(error.description)
+
+
+class Renderer:
+    def __init__(self, send_queue):
+        self.send_queue = send_queue
+        self.stats = {SEND: 0, EDIT: 0, DELETE: 0, "fallback": 0}
+
+    def render(self, message, replies, edit=False):
+        actions = plan_render(replies, edit, message)
+        if actions and actions[0][0] == EDIT:
+            reply = actions[0][1]
+            self.stats[EDIT] += 1
+            future = self.send_queue.edit_message_text(reply.text, message.chat.id, message.message_id,
+                                                       reply_markup=reply.markup)
+            # Колбэк выполняется в потоке отправки: остальные ответы учитываются в метриках того же апдейта
+            context = contextvars.copy_context()
+            update = hold_update()
+            future.add_done_callback(lambda done: context.run(self._after_edit, done, message, replies, update))
+        else:
+            self._perform(message, actions)
+
+    def _perform(self, message, actions):
+        for action, reply in actions:
+            self.stats[action] += 1
+            if action == SEND:
+                self.send_queue.send_message(message.chat.id, reply.text, reply_markup=reply.markup)
+            else:
+                self.send_queue.delete_message(message.chat.id, message.message_id)
+
+    # Остальные ответы ставятся в очередь только теперь; если правка не удалась, весь экран отправляется заново
+    def _after_edit(self, future, message, replies, update):
+        try:
+            error = future.exception()
+            if error is None or is_not_modified(error):
+                self._perform(message, [(SEND, reply) for reply in replies[1:]])
+                return
+            self.stats["fallback"] += 1
+            self._perform(message, [(SEND, reply) for reply in replies] + [(DELETE, None)])
+        finally:
+            release_update(update)
+
+
+async def _call_api(bot, method, *args, **kwargs):
+    # В асинхронном режиме очереди отправки нет, поэтому запросы к Bot API учитываются в метриках здесь
+    record_api_call()
+    started = time.perf_counter()
+    try:
+        result = await getattr(bot, method)(*args, **kwargs)
+    except Exception:
+        record_api_request(method, time.perf_counter() - started, "error")
+        raise
+    record_api_request(method, time.perf_counter() - started, "ok")
+    return result
+
+
+async def render_async(bot, message, replies, edit=False):
+    chat_id = message.chat.id
+    for action, reply in plan_render(replies, edit, message):
+        if action == EDIT:
+            try:
+                await _call_api(bot, 'edit_message_text', reply.text, chat_id, message.message_id,
+                                reply_markup=reply.markup)
+            except ApiTelegramException as e:
+                if not is_not_modified(e):
+                    await _call_api(bot, 'send_message', chat_id, reply.text, reply_markup=reply.markup)
+                    await _call_api(bot, 'delete_message', chat_id, message.message_id)
+        elif action == SEND:
+            await _call_api(bot, 'send_message', chat_id, reply.text, reply_markup=reply.markup)
+        else:
+            await _call_api(bot, 'delete_message', chat_id, message.message_id)
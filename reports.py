@@ -0,0 +1,168 @@
+import argparse
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from catalog import catalog
+from database_root import session_per_update, STREAM_RECORD_COLUMNS, GET_ROLLUP_COLUMNS, GET_ROLLUPS_END, \
+    SAVE_ROLLUPS
+from settings import WORK_DAY_START_HOUR, WORK_DAY_END_HOUR, REPORT_DAYS, REPORT_CHUNK_SIZE
+
+# Отчёты владельцам салонов: загрузка по дням недели и часам, записи, отмены и занятые минуты по салонам
+# и услугам. Записи читаются из БД пачками целых чисел прямо в массивы numpy и сворачиваются в итоги
+# (салон, услуга, день, час) без цикла по объектам. Итоги прошедших дней сохраняются в record_rollups,
+# поэтому повторный отчёт досчитывает из records только новые дни и сегодняшний.
+# Запуск отдельно: python reports.py --owner <id> --days 30
+EPOCH = date(1970, 1, 1)
+WEEKDAY_NAMES = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+# Колонки таблицы итогов: ключ и суммы
+PLACE, SERVICE, DAY, HOUR, RECORDS, CANCELLED, BUSY = range(7)
+KEY_COLUMNS = 4
+ROLLUP_COLUMNS = 7
+
+Report = namedtuple('Report', ['since', 'until', 'places', 'services', 'heatmap'])
+# records — все записи, cancelled — отменённые, busy_minutes — минуты неотменённых записей
+Totals = namedtuple('Totals', ['records', 'cancelled', 'busy_minutes'])
+
+
+def _empty():
+    return np.zeros((0, ROLLUP_COLUMNS), dtype=np.int64)
+
+
+# Сумма колонок RECORDS, CANCELLED и BUSY по одинаковым ключам (салон, услуга, день, час)
+def sum_by_key(table):
+    if len(table) == 0:
+        return _empty()
+    keys, inverse = np.unique(table[:, :KEY_COLUMNS], axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    sums = np.zeros((len(keys), ROLLUP_COLUMNS - KEY_COLUMNS), dtype=np.int64)
+    np.add.at(sums, inverse, table[:, KEY_COLUMNS:])
+    return np.hstack([keys, sums])
+
+
+# Пачка строк STREAM_RECORD_COLUMNS -> итоги по (салон, услуга, день, час)
+def records_to_rollups(rows):
+    chunk = np.array(rows, dtype=np.int64).reshape(-1, 5)
+    place, service, start, minutes, active = chunk.T
+    table = np.column_stack([place, service, start // 86400, start % 86400 // 3600,
+                             np.ones_like(active), 1 - active, minutes * active])
+    return sum_by_key(table)
+
+
+@session_per_update
+def stream_rollups(since, until, place_ids=None, chunk_size=REPORT_CHUNK_SIZE):
+    parts = [records_to_rollups(rows) for rows in STREAM_RECORD_COLUMNS(
+        datetime.combine(since, datetime.min.time()), datetime.combine(until, datetime.min.time()), chunk_size,
+        place_ids=place_ids)]
+    return sum_by_key(np.concatenate(parts)) if parts else _empty()
+
+
+# Досчитывает итоги прошедших дней, которых ещё нет в record_rollups. Возвращает день, с которого итогов нет
+@session_per_update
+def update_rollups(today=None):
+    today = today or date.today()
+    since = GET_ROLLUPS_END() or EPOCH
+    if since >= today:
+        return since
+    table = stream_rollups(since, today)
+    SAVE_ROLLUPS(since, today, [
+        dict(place_id=int(row[PLACE]), service_id=int(row[SERVICE]), day=EPOCH + timedelta(days=int(row[DAY])),
+             hour=int(row[HOUR]), records=int(row[RECORDS]), cancelled=int(row[CANCELLED]),
+             busy_minutes=int(row[BUSY]))
+        for row in table.tolist()])
+    return today
+
+
+@session_per_update
+def load_rollups(place_ids, since, until):
+    rows = GET_ROLLUP_COLUMNS(place_ids, since, until)
+    return np.array(rows, dtype=np.int64).reshape(-1, ROLLUP_COLUMNS) if rows else _empty()
+
+
+def _totals_by(table, column):
+    ids, inverse = np.unique(table[:, column], return_inverse=True)
+    sums = np.zeros((len(ids), 3), dtype=np.int64)
+    np.add.at(sums, inverse.ravel(), table[:, [RECORDS, CANCELLED, BUSY]])
+    return {int(_id): Totals(*map(int, row)) for _id, row in zip(ids, sums)}
+
+
+def build_report(table, since, until):
+    # 1970-01-01 — четверг, поэтому понедельник — это (день + 3) % 7 == 0
+    heatmap = np.zeros((7, 24), dtype=np.int64)
+    np.add.at(heatmap, ((table[:, DAY] + 3) % 7, table[:, HOUR]), table[:, RECORDS] - table[:, CANCELLED])
+    return Report(since, until, _totals_by(table, PLACE), _totals_by(table, SERVICE), heatmap)
+
+
+# Отчёт по всем салонам владельца за [since, until): прошедшие дни из итогов, остальные — из records
+@session_per_update
+def owner_report(owner_id, since=None, until=None):
+    until = until or date.today() + timedelta(days=1)
+    since = since or until - timedelta(days=REPORT_DAYS)
+    place_ids = [place.id for place in catalog.snapshot().place_by_id.values() if place.owner_id == owner_id]
+    if not place_ids:
+        return None
+    rolled_until = min(max(update_rollups(), since), until)
+    table = np.concatenate([load_rollups(place_ids, since, rolled_until),
+                            stream_rollups(rolled_until, until, place_ids=place_ids)])
+    return build_report(table, since, until)
+
+
+def _percent(part, total):
+    return f"{100 * part / total:.0f}%" if total else "—"
+
+
+def report_text(report):
+    snapshot = catalog.snapshot()
+    days = (report.until - report.since).days
+    work_minutes = (WORK_DAY_END_HOUR - WORK_DAY_START_HOUR) * 60 * days
+    lines = [f"📊 Отчёт за {report.since.strftime('%d.%m.%Y')} — "
+             f"{(report.until - timedelta(days=1)).strftime('%d.%m.%Y')}"]
+    if not report.places:
+        return "\n".join(lines + ["Записей за этот период нет"])
+
+    lines.append("\nСалоны (записи, отмены, загрузка):")
+    for place_id, totals in sorted(report.places.items(), key=lambda item: -item[1].busy_minutes):
+        place = snapshot.place_by_id.get(place_id)
+        lines.append(f"• {place.address if place else place_id}: {totals.records}, "
+                     f"{_percent(totals.cancelled, totals.records)}, {_percent(totals.busy_minutes, work_minutes)}")
+
+    lines.append("\nУслуги (записи, отмены, часы):")
+    for service_id, totals in sorted(report.services.items(), key=lambda item: -item[1].records):
+        service = snapshot.service_by_id.get(service_id)
+        lines.append(f"• {service.name if service else service_id}: {totals.records}, "
+                     f"{_percent(totals.cancelled, totals.records)}, {totals.busy_minutes / 60:.1f}")
+
+    busiest = np.argsort(report.heatmap, axis=None)[::-1][:3]
+    hours = [(int(index) // 24, int(index) % 24) for index in busiest if report.heatmap.flat[index] > 0]
+    if hours:
+        lines.append("\nСамые загруженные часы: " + ", ".join(
+            f"{WEEKDAY_NAMES[weekday]} {hour:02d}:00 ({report.heatmap[weekday, hour]})" for weekday, hour in hours))
+    return "\n".join(lines)
+
+
+def heatmap_text(report):
+    rows = ["    " + " ".join(f"{hour:>3}" for hour in range(WORK_DAY_START_HOUR, WORK_DAY_END_HOUR))]
+    for weekday, name in enumerate(WEEKDAY_NAMES):
+        rows.append(f"{name:>3} " + " ".join(f"{count:>3}" for count in
+                                             report.heatmap[weekday, WORK_DAY_START_HOUR:WORK_DAY_END_HOUR]))
+    return "\n".join(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--owner", type=int, required=True)
+    parser.add_argument("--days", type=int, default=REPORT_DAYS)
+    args = parser.parse_args()
+    until = date.today() + timedelta(days=1)
+    report = owner_report(args.owner, until - timedelta(days=args.days), until)
+    if report is None:
+        print(f"У пользователя {args.owner} нет салонов")
+        return
+    print(report_text(report))
+    print()
+    print(heatmap_text(report))
+
+
+if __name__ == '__main__':
+    main()
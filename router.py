@@ -0,0 +1,169 @@
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+
+# Маршрутизация нажатий на inline-кнопки. callback_data кодируется компактно:
+#   <версия><код маршрута>[.<аргумент>.<аргумент>...]
+# например "1g.6" вместо "start_record.6". Числа записываются в base36, дата — числом дней, а дата
+# со временем — числом минут от CALLBACK_EPOCH, так что даже маршрут записи (салон, услуга, слот)
+# занимает около 15 байт из 64, которые Telegram разрешает для callback_data.
+# Старые кнопки вида "<имя>.<аргументы>" из уже отправленных сообщений тоже распознаются.
+CALLBACK_VERSION = "1"
+CALLBACK_MAX_BYTES = 64
+CALLBACK_EPOCH = datetime(2020, 1, 1)
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def to_base36(number):
+    if number == 0:
+        return "0"
+    result = ""
+    while number:
+        number, digit = divmod(number, 36)
+        result = _DIGITS[digit] + result
+    return result
+
+
+def from_base36(text):
+    return int(text, 36)
+
+
+class IntArg:
+    @staticmethod
+    def encode(value):
+        return to_base36(int(value))
+
+    @staticmethod
+    def decode(text):
+        return from_base36(text)
+
+    @staticmethod
+    def decode_legacy(text):
+        return int(text)
+
+
+class DateArg:
+    @staticmethod
+    def encode(value):
+        return to_base36((value - CALLBACK_EPOCH.date()).days)
+
+    @staticmethod
+    def decode(text):
+        return CALLBACK_EPOCH.date() + timedelta(days=from_base36(text))
+
+    @staticmethod
+    def decode_legacy(text):
+        return datetime.strptime(text, "%Y%m%d").date()
+
+
+class DateTimeArg:
+    @staticmethod
+    def encode(value):
+        return to_base36(int((value - CALLBACK_EPOCH).total_seconds()) // 60)
+
+    @staticmethod
+    def decode(text):
+        return CALLBACK_EPOCH + timedelta(minutes=from_base36(text))
+
+    @staticmethod
+    def decode_legacy(text):
+        return datetime.strptime(text, "%Y%m%d%H%M")
+
+
+class CallbackDataError(ValueError):
+    pass
+
+
+class Route:
+    def __init__(self, name, code, handler, arg_types):
+        self.name = name
+        self.code = code
+        self.handler = handler
+        self.arg_types = arg_types
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class CallbackRouter:
+    def __init__(self):
+        self._by_code = dict()
+        self._by_name = dict()
+        self._stats_lock = Lock()
+
+    # Один и тот же name может иметь маршруты с разным числом аргументов (например, choose_city и choose_city.<id>)
+    def route(self, name, code, *arg_types):
+        def decorator(handler):
+            if code in self._by_code:
+                raise ValueError(f"Код маршрута '{code}' уже занят маршрутом '{self._by_code[code].name}'")
+            route = Route(name, code, handler, arg_types)
+            self._by_code[code] = route
+            self._by_name[(name, len(arg_types))] = route
+            return handler
+        return decorator
+
+    def encode(self, name, *args):
+        route = self._by_name[(name, len(args))]
+        data = CALLBACK_VERSION + route.code
+        for arg_type, arg in zip(route.arg_types, args):
+            data += "." + arg_type.encode(arg)
+        if len(data.encode()) > CALLBACK_MAX_BYTES:
+            raise CallbackDataError(f"callback_data длиннее {CALLBACK_MAX_BYTES} байт: {data}")
+        return data
+
+    def decode(self, data):
+        head, *raw_args = data.split(".")
+        if head[:1] == CALLBACK_VERSION:
+            route = self._by_code.get(head[1:])
+            decode = "decode"
+        else:
+            route = self._by_name.get((head, len(raw_args)))
+            decode = "decode_legacy"
+        if route is None or len(raw_args) != len(route.arg_types):
+            raise CallbackDataError(f"Нет обработчика для '{head}' с аргументами: {raw_args}")
+        try:
+            args = [getattr(arg_type, decode)(raw) for arg_type, raw in zip(route.arg_types, raw_args)]
+        except ValueError as e:
+            raise CallbackDataError(f"Неверные аргументы '{data}': {e}")
+        return route, args
+
+    # Имя маршрута для метрик; для неизвестных и испорченных данных — "unknown"
+    def route_name(self, data):
+        try:
+            return self.decode(data or "")[0].name
+        except CallbackDataError:
+            return "unknown"
+
+    def dispatch(self, call, fallback):
+        try:
+            route, args = self.decode(call.data)
+        except CallbackDataError as e:
+            print(e)
+            return fallback(call.message)
+
+        started = time.perf_counter()
+        failed = False
+        try:
+            return route.handler(call.message, *args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                route.calls += 1
+                route.errors += failed
+                route.total_time += elapsed
+                route.max_time = max(route.max_time, elapsed)
+
+    def stats(self):
+        with self._stats_lock:
+            return {f"{route.name}/{len(route.arg_types)}": {"calls": route.calls, "errors": route.errors,
+                                                             "total_time": route.total_time,
+                                                             "avg_time": route.total_time / route.calls if route.calls else 0.0,
+                                                             "max_time": route.max_time}
+                    for route in self._by_code.values()}
+
+
+router = CallbackRouter()
@@ -0,0 +1,553 @@
+import calendar
+from collections import namedtuple
+from datetime import date, datetime, timedelta, time
+
+from telebot import types
+
+from database_root import *
+from availability import GET_FREE_SLOTS, GET_FREE_DAYS, HOLD_RECORD, RELEASE_HOLD, BOOK_RECORD, \
+    CANCEL_RECORD, SlotIsBusy, SlotIsInvalid
+from catalog import catalog
+from router import router, IntArg, DateArg, DateTimeArg
+from service_index import service_index
+from wizard import wizard_store
+from settings import START_TEXT, MAIN_MENU_BUTTON_TEXT, MAIN_MENU_SECTION_TEXT, BOOKING_DAYS_AHEAD, \
+    RECORDS_PAGE_SIZE
+
+# Экраны бота. Каждый экран только обращается к БД и возвращает список сообщений, которые нужно отправить,
+# а отправляет их уже конкретный бот: синхронный (main.py) или асинхронный (async_main.py)
+Reply = namedtuple('Reply', ['text', 'markup'], defaults=[None])
+
+MONTH_NAMES = ("Январь", "Февраль", "Март", "Апрель", "Май", "Июнь", "Июль", "Август", "Сентябрь", "Октябрь",
+               "Ноябрь", "Декабрь")
+WEEKDAY_NAMES = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+# Подписи дней календаря: день вне окна записи и день, в который всё занято
+CALENDAR_EMPTY_DAY = "·"
+CALENDAR_FULL_DAY = "✖"
+
+
+def get_place_id_from_url(message):
+    message = message.text.split()
+    if len(message) > 1:
+        return message[1]
+    return None
+
+
+def get_preuser(message):
+    return User.get_preuser(message.chat.id)
+
+
+def get_user(message):
+    return User.get_user(message.chat.id)
+
+
+def check_user(message):
+    return User.check_user(message.chat.id)
+
+
+def check_preuser(message):
+    return User.check_preuser(message.chat.id)
+
+
+def check_prepreuser(message):
+    return User.check_prepreuser(message.chat.id)
+
+
+# Пока идёт регистрация, её шаг берётся из wizard_store, а не из БД
+def get_user_state(message):
+    draft = wizard_store.get(message.chat.id)
+    if draft is not None:
+        return draft.status
+    return User.get_state(message.chat.id).status
+
+
+def get_user_name(message):
+    draft = wizard_store.get(message.chat.id)
+    if draft is not None:
+        return draft.name
+    return User.get_state(message.chat.id).name
+
+
+def get_user_city_id(message):
+    return User.get_state(message.chat.id).city_id
+
+
+def check_preuser_name(message):
+    return User.get_preuser_name(message.chat.id)
+
+
+# Шаги регистрации меняют только черновик в памяти; в БД пользователь записывается, когда пришёл номер
+def edit_user(message, name=None, number=None):
+    if number is None:
+        if name is None:
+            wizard_store.put(message.chat.id, USER_STATUS_PREPREUSER)
+        else:
+            wizard_store.put(message.chat.id, USER_STATUS_PREUSER, name=name)
+    else:
+        COMPLETE_REGISTRATION(message.chat.id, get_user_name(message), number)
+        wizard_store.pop(message.chat.id)
+
+
+def generate_markup(items):
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for (name, callback_data) in items:
+        markup.add(types.InlineKeyboardButton(name, callback_data=callback_data))
+    return markup
+
+
+def on_start(message):
+    state = get_user_state(message)
+    if state == USER_STATUS_USER:
+        if get_place_id_from_url(message) is None:
+            return main_menu(message)
+        else:
+            place_id = int(get_place_id_from_url(message))
+            return start_record(message, place_id)
+    elif state == USER_STATUS_PREUSER:
+        return on_message(message)
+    else:
+        edit_user(message)
+        return [Reply(f"{START_TEXT} Отправьте, пожалуйста, ваше имя")]
+
+
+def on_message(message):
+    state = get_user_state(message)
+    if state == USER_STATUS_PREUSER:
+        keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
+        button_phone = types.KeyboardButton(text="Отправить номер телефона", request_contact=True)
+        keyboard.add(button_phone)
+        return [Reply('Теперь отправьте нам ваш номер', keyboard)]
+    elif state == USER_STATUS_PREPREUSER:
+        edit_user(message, name=message.text)
+        message.text = ""
+        return on_message(message)
+    elif state == USER_STATUS_USER:
+        return search_places(message)
+    else:
+        return [Reply(f"Я вас не понимаю")]
+
+
+# Любой текст зарегистрированного пользователя — поиск салонов его города по названию сети, адресу и услугам.
+# Сначала ищутся салоны со всеми словами запроса, если таких нет — хотя бы с одним
+def search_places(message):
+    city_id = get_user_city_id(message)
+    place_ids = SEARCH_PLACES(message.text or "", city_id) or SEARCH_PLACES(message.text or "", city_id, any_word=True)
+    snapshot = catalog.snapshot()
+    places = [snapshot.place_by_id[place_id] for place_id in place_ids if place_id in snapshot.place_by_id]
+    if not places:
+        return [Reply(f"Ничего не нашлось. Напишите название салона, улицу или услугу, например: маникюр",
+                      generate_markup([(MAIN_MENU_BUTTON_TEXT, router.encode("main_menu"))]))]
+
+    cur_places = [(f"{snapshot.center_by_id[place.center_id].name}, {place.address}",
+                   router.encode("start_record", place.id)) for place in places]
+    cur_places.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+    return [Reply(f"Вот что нашлось по запросу «{message.text}»:", generate_markup(cur_places))]
+
+
+def on_contact(message):
+    if message.contact is None:
+        return []
+    state = get_user_state(message)
+    if state == USER_STATUS_USER:
+        replies = [Reply(f"Я вас не понимаю, {get_user(message).name}. ")]
+    elif state == USER_STATUS_PREUSER:
+        edit_user(message, number=message.contact.phone_number)
+        return [Reply(f"Отлично! Осталось ещё немного до конца регистрации", types.ReplyKeyboardRemove())] + \
+            choose_city(message)
+    else:
+        replies = [Reply(f"Я вас не понимаю")]
+    return replies + main_menu(message)
+
+
+# Команда /report: отчёт владельцу по его салонам за REPORT_DAYS дней. numpy импортируется только здесь,
+# чтобы не замедлять запуск бота
+def on_report(message):
+    from reports import owner_report, report_text
+    report = owner_report(message.chat.id)
+    if report is None:
+        return [Reply(f"Отчёты доступны только владельцам салонов")]
+    return [Reply(report_text(report))]
+
+
+def on_callback(call):
+    return router.dispatch(call, fallback=i_dont_know_that_command)
+
+
+@router.route("main_menu", "a")
+def main_menu(message):
+    markup = catalog.markup(("main_menu",), lambda: generate_markup([(f"📝 Записаться", router.encode("start_record_by_type")),
+                                                                     (f"📔 Мои записи", router.encode("show_records")),
+                                                                     (f"🏙️ Поменять город", router.encode("choose_city"))]))
+
+    return [Reply(f"{MAIN_MENU_SECTION_TEXT()}\n\nЧем я могу вам помочь, {get_user_name(message)}?", markup)]
+
+
+@router.route("start_record_by_type", "b")
+def start_record_by_type(message):
+    def build():
+        cur_types = list()
+        for cur_type in catalog.snapshot().types:
+            cur_types.append((cur_type.name, router.encode("start_record_by_type_of_service", cur_type.id)))
+        cur_types.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+        return generate_markup(cur_types)
+    markup = catalog.markup(("start_record_by_type",), build)
+
+    return [Reply(f"Выберите вид услуги, на которую вы хотите записаться:", markup)]
+
+
+@router.route("start_record_by_type_of_service", "c", IntArg)
+def start_record_by_type_of_service(message, type_id):
+    markup = catalog.markup(("start_record_by_type_of_service", int(type_id)), lambda: generate_markup(
+        [(f"🎫 Запись по конкретной услуге", router.encode("start_record_by_service", type_id)),
+         (f"🏢 Запись в конкретный салон", router.encode("start_record_by_center", type_id)),
+         (f"⬅️ Вернуться к выбору вида услуги", router.encode("start_record_by_type")),
+         (MAIN_MENU_BUTTON_TEXT, router.encode("main_menu"))]))
+
+    return [Reply(f"Как именно вы хотели бы записаться?", markup)]
+
+
+# Запись по конкретной услуге: услуги выбранного вида в городе пользователя, затем сети, в салонах которых
+# есть эта услуга, затем сами салоны. Каждый шаг — поиск в service_index, без обхода связей услуга–салон
+@router.route("start_record_by_service", "d", IntArg)
+def start_record_by_service(message, type_id):
+    city_id = get_user_city_id(message)
+
+    def build():
+        snapshot = catalog.snapshot()
+        cur_services = list()
+        for service_id in service_index.services(city_id, type_id):
+            cur_services.append((snapshot.service_by_id[service_id].name,
+                                 router.encode("start_record_by_service_center", service_id)))
+        cur_services.append((f"⬅️ Вернуться к способу записи", router.encode("start_record_by_type_of_service", type_id)))
+        cur_services.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+        return generate_markup(cur_services)
+    markup = catalog.markup(("start_record_by_service", int(type_id), city_id), build)
+
+    return [Reply(f"Выберите услугу, на которую вы хотите записаться:", markup)]
+
+
+@router.route("start_record_by_service_center", "o", IntArg)
+def start_record_by_service_center(message, service_id):
+    city_id = get_user_city_id(message)
+    service = catalog.snapshot().service_by_id[int(service_id)]
+
+    def build():
+        snapshot = catalog.snapshot()
+        cur_centers = list()
+        for center_id in service_index.centers(city_id, service_id):
+            cur_centers.append((snapshot.center_by_id[center_id].name,
+                                router.encode("start_record_by_service_place", service_id, center_id)))
+        cur_centers.append((f"⬅️ Вернуться к выбору услуги", router.encode("start_record_by_service", service.type_id)))
+        cur_centers.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+        return generate_markup(cur_centers)
+    markup = catalog.markup(("start_record_by_service_center", int(service_id), city_id), build)
+
+    return [Reply(f"Выберите сеть салонов, в которой вы хотите записаться на услугу '{service.name}':", markup)]
+
+
+@router.route("start_record_by_service_place", "p", IntArg, IntArg)
+def start_record_by_service_place(message, service_id, center_id):
+    city_id = get_user_city_id(message)
+    center = catalog.snapshot().center_by_id[int(center_id)]
+
+    def build():
+        snapshot = catalog.snapshot()
+        cur_places = list()
+        for place_id in service_index.places(city_id, service_id, center_id):
+            cur_places.append((snapshot.place_by_id[place_id].address,
+                               router.encode("choose_record_date", place_id, service_id)))
+        cur_places.append((f"⬅️ Вернуться к выбору сети салонов", router.encode("start_record_by_service_center", service_id)))
+        cur_places.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+        return generate_markup(cur_places)
+    markup = catalog.markup(("start_record_by_service_place", int(service_id), int(center_id), city_id), build)
+
+    return [Reply(f"Выберите салон сети {center.name}, в который вы хотите записаться:", markup)]
+
+
+@router.route("start_record_by_center", "e", IntArg)
+def start_record_by_center(message, type_id):
+    city_id = get_user_city_id(message)
+
+    def build():
+        cur_centers = list()
+        for cur_center in catalog.snapshot().centers_by_type_and_city(type_id, city_id):
+            cur_centers.append((cur_center.name, router.encode("start_record_by_place", cur_center.id)))
+        cur_centers.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+        return generate_markup(cur_centers)
+    markup = catalog.markup(("start_record_by_center", int(type_id), city_id), build)
+
+    return [Reply(f"Выберите сеть салонов, в который вы хотите записаться:", markup)]
+
+
+@router.route("start_record_by_place", "f", IntArg)
+def start_record_by_place(message, center_id):
+    city_id = get_user_city_id(message)
+    center = catalog.snapshot().center_by_id[int(center_id)]
+
+    def build():
+        cur_places = list()
+        for cur_place in catalog.snapshot().places_by_center_and_city_id(center_id, city_id):
+            cur_places.append((cur_place.address, router.encode("start_record", cur_place.id)))
+        cur_places.append((f"⬅️ Вернуться к выбору сети салонов", router.encode("start_record_by_center", center.type_id)))
+        cur_places.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+        return generate_markup(cur_places)
+    markup = catalog.markup(("start_record_by_place", int(center_id), city_id), build)
+
+    return [Reply(f"Выберите салон сети {center.name}, в который вы хотите записаться:", markup)]
+
+
+@router.route("start_record", "g", IntArg)
+def start_record(message, place_id):
+    place = catalog.snapshot().place_by_id[int(place_id)]
+    center = catalog.snapshot().center_by_id[place.center_id]
+    markup = catalog.markup(("start_record", int(place_id)), lambda: generate_markup(
+        [(f"📅 Выбрать дату и время записи", router.encode("start_record_by_date", place_id)),
+         (f"⬅️ Вернуться к выбору салонов {center.name}", router.encode("start_record_by_place", place.center_id)),
+         (MAIN_MENU_BUTTON_TEXT, router.encode("main_menu"))]))
+
+    return [Reply(f"Сейчас вы планируете запись в '{center.name}' по адресу: {place.address}", markup)]
+
+
+@router.route("start_record_by_date", "h", IntArg)
+def start_record_by_date(message, place_id):
+    def build():
+        cur_services = list()
+        for cur_service in catalog.snapshot().services_by_place.get(int(place_id), ()):
+            duration = time(hour=cur_service.duration // 60, minute=cur_service.duration % 60)
+            cur_services.append((f"{cur_service.name} ({duration.strftime('%H:%M (чч:мм)')})",
+                                 router.encode("choose_record_date", place_id, cur_service.id)))
+        cur_services.append((f"⬅️ Вернуться к салону", router.encode("start_record", place_id)))
+        cur_services.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+        return generate_markup(cur_services)
+    markup = catalog.markup(("start_record_by_date", int(place_id)), build)
+
+    return [Reply(f"Выберите услугу, на которую вы хотите записаться:", markup)]
+
+
+# Календарь месяца для выбора даты записи. Свободные дни ведут к выбору времени, занятые отмечены
+# CALENDAR_FULL_DAY, а дни вне окна записи (BOOKING_DAYS_AHEAD дней от сегодня) — CALENDAR_EMPTY_DAY.
+# Загрузка всех дней месяца читается одним запросом (GET_FREE_DAYS). Кнопки без действия показывают тот же месяц
+def record_calendar_markup(message, place_id, service_id, month):
+    first_day = date.today()
+    last_day = first_day + timedelta(days=BOOKING_DAYS_AHEAD - 1)
+    month_start = max(month, first_day)
+    month_end = min(month.replace(day=calendar.monthrange(month.year, month.month)[1]), last_day)
+    free_days = GET_FREE_DAYS(place_id, service_id, month_start, month_end, user_id=message.chat.id)
+    same_month = router.encode("choose_record_month", place_id, service_id, month)
+
+    markup = types.InlineKeyboardMarkup(row_width=7)
+    markup.row(types.InlineKeyboardButton(f"{MONTH_NAMES[month.month - 1]} {month.year}", callback_data=same_month))
+    markup.row(*[types.InlineKeyboardButton(name, callback_data=same_month) for name in WEEKDAY_NAMES])
+    for week in calendar.Calendar().monthdatescalendar(month.year, month.month):
+        buttons = list()
+        for day in week:
+            if day.month != month.month or not month_start <= day <= month_end:
+                buttons.append(types.InlineKeyboardButton(CALENDAR_EMPTY_DAY, callback_data=same_month))
+            elif day in free_days:
+                buttons.append(types.InlineKeyboardButton(
+                    str(day.day), callback_data=router.encode("choose_record_time", place_id, service_id, day)))
+            else:
+                buttons.append(types.InlineKeyboardButton(
+                    CALENDAR_FULL_DAY, callback_data=router.encode("record_day_is_full", place_id, service_id, day)))
+        markup.row(*buttons)
+
+    navigation = list()
+    previous_month = (month - timedelta(days=1)).replace(day=1)
+    next_month = month_end + timedelta(days=1)
+    if previous_month >= first_day.replace(day=1):
+        navigation.append(types.InlineKeyboardButton(
+            f"⬅️ {MONTH_NAMES[previous_month.month - 1]}",
+            callback_data=router.encode("choose_record_month", place_id, service_id, previous_month)))
+    if next_month <= last_day:
+        navigation.append(types.InlineKeyboardButton(
+            f"{MONTH_NAMES[next_month.month - 1]} ➡️",
+            callback_data=router.encode("choose_record_month", place_id, service_id, next_month)))
+    if navigation:
+        markup.row(*navigation)
+    markup.row(types.InlineKeyboardButton(f"⬅️ Вернуться к выбору услуги",
+                                          callback_data=router.encode("start_record_by_date", place_id)))
+    markup.row(types.InlineKeyboardButton(MAIN_MENU_BUTTON_TEXT, callback_data=router.encode("main_menu")))
+    return markup
+
+
+@router.route("choose_record_date", "i", IntArg, IntArg)
+def choose_record_date(message, place_id, service_id):
+    return choose_record_month(message, place_id, service_id, date.today().replace(day=1))
+
+
+@router.route("choose_record_month", "v", IntArg, IntArg, DateArg)
+def choose_record_month(message, place_id, service_id, month):
+    return [Reply(f"Выберите дату записи:", record_calendar_markup(message, place_id, service_id, month))]
+
+
+@router.route("record_day_is_full", "w", IntArg, IntArg, DateArg)
+def record_day_is_full(message, place_id, service_id, day):
+    return [Reply(f"На {day.strftime('%d.%m.%Y')} свободного времени уже нет. Выберите, пожалуйста, другой день:",
+                  record_calendar_markup(message, place_id, service_id, day.replace(day=1)))]
+
+
+@router.route("choose_record_time", "j", IntArg, IntArg, DateArg)
+def choose_record_time(message, place_id, service_id, cur_day):
+    cur_slots = list()
+    for slot in GET_FREE_SLOTS(place_id, service_id, cur_day, user_id=message.chat.id):
+        cur_slots.append((slot.strftime("%H:%M"), router.encode("hold_record", place_id, service_id, slot)))
+    cur_slots.append((f"⬅️ Вернуться к выбору даты",
+                      router.encode("choose_record_month", place_id, service_id, cur_day.replace(day=1))))
+    cur_slots.append((MAIN_MENU_BUTTON_TEXT, router.encode("main_menu")))
+    markup = generate_markup(cur_slots)
+
+    return [Reply(f"Выберите время записи на {cur_day.strftime('%d.%m.%Y')}:", markup)]
+
+
+# Выбранный слот придерживается за пользователем на SLOT_HOLD_SECONDS, чтобы его не заняли, пока он подтверждает
+@router.route("hold_record", "u", IntArg, IntArg, DateTimeArg)
+def hold_record(message, place_id, service_id, start_date):
+    try:
+        expires_at = HOLD_RECORD(message.chat.id, place_id, service_id, start_date)
+    except SlotIsInvalid:
+        return [Reply(f"Это время уже недоступно для записи")] + main_menu(message)
+    except SlotIsBusy:
+        return [Reply(f"К сожалению, это время уже заняли. Выберите, пожалуйста, другое")] + \
+            choose_record_time(message, place_id, service_id, start_date.date())
+    snapshot = catalog.snapshot()
+    place = snapshot.place_by_id[int(place_id)]
+    markup = generate_markup(
+        [(f"✅ Подтвердить запись", router.encode("make_record", place_id, service_id, start_date)),
+         (f"⬅️ Выбрать другое время", router.encode("release_hold", place_id, service_id, start_date.date())),
+         (MAIN_MENU_BUTTON_TEXT, router.encode("release_hold_to_main_menu", place_id))])
+
+    return [Reply(f"{snapshot.service_by_id[int(service_id)].name} по адресу {place.address} "
+                  f"на {start_date.strftime('%d.%m.%Y %H:%M')}. Время придержано за вами "
+                  f"до {expires_at.strftime('%H:%M')}, подтвердите запись:", markup)]
+
+
+# Выходы с подтверждения записи снимают бронь, чтобы брошенный слот сразу стал доступен другим
+@router.route("release_hold", "x", IntArg, IntArg, DateArg)
+def release_hold(message, place_id, service_id, cur_day):
+    RELEASE_HOLD(message.chat.id, place_id)
+    return choose_record_time(message, place_id, service_id, cur_day)
+
+
+@router.route("release_hold_to_main_menu", "y", IntArg)
+def release_hold_to_main_menu(message, place_id):
+    RELEASE_HOLD(message.chat.id, place_id)
+    return main_menu(message)
+
+
+@router.route("make_record", "k", IntArg, IntArg, DateTimeArg)
+def make_record(message, place_id, service_id, start_date):
+    try:
+        record = BOOK_RECORD(message.chat.id, place_id, service_id, start_date)
+    except SlotIsInvalid:
+        return [Reply(f"Это время уже недоступно для записи")] + main_menu(message)
+    except SlotIsBusy:
+        return [Reply(f"К сожалению, это время уже заняли. Выберите, пожалуйста, другое")] + \
+            choose_record_time(message, place_id, service_id, start_date.date())
+    return [Reply(f"Вы записаны в салон по адресу {catalog.snapshot().place_by_id[record.place_id].address} "
+                  f"на {record.start_date.strftime('%d.%m.%Y %H:%M')}")] + main_menu(message)
+
+
+# Предстоящие записи пользователя от ближайшей к самой поздней, страницами по RECORDS_PAGE_SIZE.
+# Кнопки «назад»/«дальше» передают id крайней записи страницы, и следующая страница читается от неё по индексу
+def records_page(message, after=None, before=None):
+    rows = GET_UPCOMING_RECORDS(message.chat.id, datetime.now(), RECORDS_PAGE_SIZE, after=after, before=before)
+    more = len(rows) > RECORDS_PAGE_SIZE
+    if before is not None:
+        rows, has_prev, has_next = rows[-RECORDS_PAGE_SIZE:], more, True
+    else:
+        rows, has_prev, has_next = rows[:RECORDS_PAGE_SIZE], after is not None, more
+    if not rows:
+        if after is not None or before is not None:
+            return records_page(message)
+        markup = generate_markup([(f"📝 Записаться", router.encode("start_record_by_type")),
+                                  (MAIN_MENU_BUTTON_TEXT, router.encode("main_menu"))])
+        return [Reply(f"У вас пока нет предстоящих записей", markup)]
+
+    snapshot = catalog.snapshot()
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    for record_id, place_id, service_id, start_date in rows:
+        markup.add(types.InlineKeyboardButton(
+            f"{start_date.strftime('%d.%m.%Y %H:%M')} {snapshot.service_by_id[service_id].name}",
+            callback_data=router.encode("show_record", record_id)))
+    navigation = list()
+    if has_prev:
+        navigation.append(types.InlineKeyboardButton(f"⬅️ Раньше", callback_data=router.encode("show_records_before", rows[0].id)))
+    if has_next:
+        navigation.append(types.InlineKeyboardButton(f"Позже ➡️", callback_data=router.encode("show_records_after", rows[-1].id)))
+    if navigation:
+        markup.row(*navigation)
+    markup.add(types.InlineKeyboardButton(MAIN_MENU_BUTTON_TEXT, callback_data=router.encode("main_menu")))
+
+    return [Reply(f"Ваши предстоящие записи. Нажмите на запись, чтобы посмотреть подробности или отменить её:", markup)]
+
+
+@router.route("show_records", "l")
+def show_records(message):
+    return records_page(message)
+
+
+@router.route("show_records_after", "q", IntArg)
+def show_records_after(message, record_id):
+    return records_page(message, after=record_id)
+
+
+@router.route("show_records_before", "r", IntArg)
+def show_records_before(message, record_id):
+    return records_page(message, before=record_id)
+
+
+@router.route("show_record", "s", IntArg)
+def show_record(message, record_id):
+    record = GET_RECORD(record_id)
+    if record is None or record.user_id != message.chat.id or not record.active:
+        return [Reply(f"Эта запись уже отменена")] + records_page(message)
+    if record.end_date <= datetime.now():
+        return [Reply(f"Эта запись уже прошла")] + records_page(message)
+    snapshot = catalog.snapshot()
+    place = snapshot.place_by_id[record.place_id]
+    markup = generate_markup([(f"❌ Отменить запись", router.encode("cancel_record", record.id)),
+                              (f"⬅️ Вернуться к записям", router.encode("show_records")),
+                              (MAIN_MENU_BUTTON_TEXT, router.encode("main_menu"))])
+
+    return [Reply(f"{snapshot.service_by_id[record.service_id].name} в '{snapshot.center_by_id[place.center_id].name}' "
+                  f"по адресу {place.address} на {record.start_date.strftime('%d.%m.%Y %H:%M')}", markup)]
+
+
+@router.route("cancel_record", "t", IntArg)
+def cancel_record(message, record_id):
+    if CANCEL_RECORD(message.chat.id, record_id):
+        return [Reply(f"Запись отменена")] + records_page(message)
+    record = GET_RECORD(record_id)
+    if record is not None and record.user_id == message.chat.id and record.active:
+        return [Reply(f"Эта запись уже прошла")] + records_page(message)
+    return [Reply(f"Эта запись уже отменена")] + records_page(message)
+
+
+@router.route("choose_city", "m")
+def choose_city(message):
+    def build():
+        cities = list()
+        for city in catalog.snapshot().cities:
+            cities.append((city.name, router.encode("choose_city", city.id)))
+        return generate_markup(cities)
+    markup = catalog.markup(("choose_city",), build)
+
+    return [Reply(f"Выберите город, в котором хотите записаться:", markup)]
+
+
+@router.route("choose_city", "n", IntArg)
+def set_new_city_from_choose_city(message, city_id):
+    user = GET_USER_STATE(message.chat.id)
+    city_name = catalog.snapshot().city_by_id[int(city_id)].name
+    if user.city_id:
+        replies = [Reply(f"Отлично! Вы выбрали город: {city_name}")]
+    else:
+        replies = [Reply(f"Поздравляем с успешной регистрацией, {user.name}! Вы выбрали город: {city_name}")]
+    SET_USER_CITY(message.chat.id, city_id)
+    return replies + main_menu(message)
+
+
+def i_dont_know_that_command(message):
+    markup = catalog.markup(("i_dont_know_that_command",), lambda: generate_markup([(MAIN_MENU_BUTTON_TEXT, router.encode("main_menu"))]))
+
+    return [Reply(f"Пока что я такого не умею. Прости, {get_user_name(message)}, я глупый 😞", markup)]
@@ -0,0 +1,269 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+from metrics import record_api_call, record_api_request
+from settings import SEND_GLOBAL_RATE, SEND_GLOBAL_BURST, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_WORKERS, \
+    SEND_QUEUE_MAX, SEND_MAX_RETRIES
+
+# Очередь исходящих запросов к Bot API. Обработчики только ставят запрос в очередь и сразу освобождают поток,
+# а диспетчер отправляет запросы с учётом общего лимита и лимита на чат (token bucket), сначала ответы
+# на действия пользователя, потом уведомления. Запросы в один чат уходят строго по порядку, по одному за раз.
+# Уведомления с одинаковым coalesce_key, которые ещё не ушли, склеиваются в одно сообщение.
+LANE_INTERACTIVE = 0
+LANE_NOTIFICATION = 1
+LANES = (LANE_INTERACTIVE, LANE_NOTIFICATION)
+MAX_MESSAGE_LENGTH = 4096
+
+
+class SendQueueFull(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Через сколько секунд появится токен (0 — можно отправлять сейчас)
+    def delay(self, now):
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class SendJob:
+    __slots__ = ('method', 'args', 'kwargs', 'future', 'coalesce_key', 'attempts', 'enqueued_at')
+
+    def __init__(self, method, args, kwargs, coalesce_key=None):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+
+class ChatQueue:
+    __slots__ = ('chat_id', 'lanes', 'scheduled', 'busy', 'bucket', 'coalesce')
+
+    def __init__(self, chat_id, rate, burst):
+        self.chat_id = chat_id
+        self.lanes = {lane: deque() for lane in LANES}
+        self.scheduled = {lane: False for lane in LANES}
+        self.busy = False
+        self.bucket = TokenBucket(rate, burst)
+        self.coalesce = dict()
+
+    def idle(self):
+        return not self.busy and not any(self.lanes.values())
+
+
+class SendQueue:
+    def __init__(self, bot, global_rate=SEND_GLOBAL_RATE, global_burst=SEND_GLOBAL_BURST, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, workers=SEND_WORKERS, max_size=SEND_QUEUE_MAX,
+                 max_retries=SEND_MAX_RETRIES):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = dict()
+        self._ready = {lane: list() for lane in LANES}
+        self._seq = itertools.count()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._workers = workers
+        self._executor = None
+        self._thread = None
+        self._stopped = False
+        self.stats = {"submitted": 0, "sent": 0, "coalesced": 0, "retried": 0, "failed": 0, "max_depth": 0}
+
+    def __len__(self):
+        return self._size
+
+    def send_message(self, chat_id, text, lane=LANE_INTERACTIVE, coalesce_key=None, timeout=None, **kwargs):
+        return self.submit(chat_id, 'send_message', (chat_id, text), kwargs, lane=lane, coalesce_key=coalesce_key,
+                           timeout=timeout)
+
+    def edit_message_text(self, text, chat_id, message_id, lane=LANE_INTERACTIVE, timeout=None, **kwargs):
+        return self.submit(chat_id, 'edit_message_text', (text,), dict(chat_id=chat_id, message_id=message_id, **kwargs),
+                           lane=lane, timeout=timeout)
+
+    def delete_message(self, chat_id, message_id, lane=LANE_INTERACTIVE, timeout=None):
+        return self.submit(chat_id, 'delete_message', (chat_id, message_id), {}, lane=lane, timeout=timeout)
+
+    def submit(self, chat_id, method, args, kwargs, lane=LANE_INTERACTIVE, coalesce_key=None, timeout=None):
+        with self._cond:
+            self._start()
+            chat = self._chats.get(chat_id)
+            pending = chat.coalesce.get(coalesce_key) if chat is not None and coalesce_key is not None else None
+            if pending is not None and method == 'send_message' and \
+                    len(pending.args[1]) + len(args[1]) + 2 <= MAX_MESSAGE_LENGTH:
+                pending.args = (pending.args[0], f"{pending.args[1]}\n\n{args[1]}")
+                self.stats["coalesced"] += 1
+                return pending.future
+
+            # Обратное давление: если очередь переполнена, отправитель ждёт, пока она не разгрузится
+            if not self._cond.wait_for(lambda: self._size < self.max_size, timeout=timeout):
+                raise SendQueueFull(f"В очереди отправки уже {self._size} запросов")
+
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = ChatQueue(chat_id, self.chat_rate, self.chat_burst)
+            job = SendJob(method, args, kwargs, coalesce_key)
+            record_api_call()
+            chat.lanes[lane].append(job)
+            if coalesce_key is not None:
+                chat.coalesce[coalesce_key] = job
+            self._size += 1
+            self.stats["submitted"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], self._size)
+            self._schedule(chat, time.monotonic())
+            self._cond.notify_all()
+            return job.future
+
+    def _start(self):
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='send')
+            self._thread = threading.Thread(target=self._dispatch_loop, name='send-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _schedule(self, chat, ready_at):
+        if chat.busy:
+            return
+        for lane in LANES:
+            if chat.lanes[lane] and not chat.scheduled[lane]:
+                chat.scheduled[lane] = True
+                heapq.heappush(self._ready[lane], (ready_at, next(self._seq), chat.chat_id))
+
+    def _pick(self, now):
+        # Возвращает (чат, полоса) для отправки или время, которое стоит подождать
+        wait = None
+        for lane in LANES:
+            heap = self._ready[lane]
+            while heap:
+                ready_at, seq, chat_id = heap[0]
+                if ready_at > now:
+                    wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                    break
+                heapq.heappop(heap)
+                chat = self._chats.get(chat_id)
+                if chat is None:
+                    continue
+                chat.scheduled[lane] = False
+                if chat.busy or not chat.lanes[lane]:
+                    continue
+                delay = chat.bucket.delay(now)
+                if delay > 0:
+                    chat.scheduled[lane] = True
+                    heapq.heappush(heap, (now + delay, seq, chat_id))
+                    continue
+                return chat, lane, None
+        return None, None, wait
+
+    def _dispatch_loop(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                chat, lane, wait = self._pick(now)
+                if chat is None:
+                    self._cond.wait(wait)
+                    continue
+                global_delay = self._global.delay(now)
+                if global_delay > 0:
+                    chat.scheduled[lane] = True
+                    heapq.heappush(self._ready[lane], (now, next(self._seq), chat.chat_id))
+                    self._cond.wait(global_delay)
+                    continue
+                self._global.take(now)
+                chat.bucket.take(now)
+                job = chat.lanes[lane].popleft()
+                if job.coalesce_key is not None and chat.coalesce.get(job.coalesce_key) is job:
+                    del chat.coalesce[job.coalesce_key]
+                chat.busy = True
+                self._size -= 1
+                self._cond.notify_all()
+                self._executor.submit(self._execute, chat, lane, job)
+
+    def _execute(self, chat, lane, job):
+        job.attempts += 1
+        retry_after = None
+        started = time.perf_counter()
+        try:
+            result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts <= self.max_retries:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                record_api_request(job.method, time.perf_counter() - started, "retry")
+            else:
+                record_api_request(job.method, time.perf_counter() - started, "error")
+                self._fail(job, e)
+        except Exception as e:
+            record_api_request(job.method, time.perf_counter() - started, "error")
+            self._fail(job, e)
+        else:
+            record_api_request(job.method, time.perf_counter() - started, "ok")
+            job.future.set_result(result)
+            with self._cond:
+                self.stats["sent"] += 1
+
+        with self._cond:
+            now = time.monotonic()
+            if retry_after is not None:
+                # Telegram попросил подождать: запрос возвращается в начало очереди чата
+                self.stats["retried"] += 1
+                chat.lanes[lane].appendleft(job)
+                self._size += 1
+                chat.bucket.pause(now, retry_after)
+                self._global.pause(now, retry_after / 2)
+            chat.busy = False
+            if chat.idle():
+                del self._chats[chat.chat_id]
+            else:
+                self._schedule(chat, now + (retry_after or 0))
+            self._cond.notify_all()
+
+    def _fail(self, job, error):
+        print(f"Не удалось выполнить {job.method}{job.args}: {error}")
+        job.future.set_exception(error)
+        with self._cond:
+            self.stats["failed"] += 1
+
+    def join(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._size == 0 and not any(chat.busy for chat in self._chats.values()),
+                                       timeout=timeout)
+
+    def close(self, wait=True):
+        if wait:
+            self.join()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
@@ -0,0 +1,157 @@
+from collections import Counter
+from threading import RLock
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session as OrmSession
+
+import cache_bus
+from database_root import GET_SERVICE_LINKS, Service, Place, ServicePlace
+
+# Обратный индекс по таблице service_place для записи по конкретной услуге:
+#   (город, вид услуги) -> услуга -> сеть -> салоны
+# Индекс строится одним запросом при первом обращении, а при добавлении или удалении связей услуга–салон
+# обновляется точечно после коммита. Если изменились сами услуги или салоны (вид услуги, город, сеть)
+# или связи менялись пакетно, индекс просто перестраивается при следующем обращении.
+SERVICE_INDEX_TABLES = {Service.__table__, Place.__table__, ServicePlace.__table__}
+INDEXED_COLUMNS = {Service: ('type_id',), Place: ('center_id', 'city_id')}
+
+
+class ServiceIndex:
+    def __init__(self, loader=GET_SERVICE_LINKS):
+        self._loader = loader
+        self._lock = RLock()
+        self._loaded = False
+        self._clear()
+
+    def _clear(self):
+        self._tree = dict()
+        self._links = Counter()
+        self._service_type = dict()
+        self._place_key = dict()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._clear()
+            for service_id, type_id, place_id, center_id, city_id in self._loader():
+                self._add(service_id, type_id, place_id, center_id, city_id)
+            self._loaded = True
+
+    def _add(self, service_id, type_id, place_id, center_id, city_id):
+        self._service_type[service_id] = type_id
+        self._place_key[place_id] = (center_id, city_id)
+        # В service_place нет уникального ключа, поэтому одинаковые связи считаются, а не просто запоминаются
+        self._links[(service_id, place_id)] += 1
+        if self._links[(service_id, place_id)] == 1:
+            self._tree.setdefault((city_id, type_id), dict()).setdefault(service_id, dict()) \
+                .setdefault(center_id, set()).add(place_id)
+
+    def _remove(self, service_id, place_id):
+        key = (service_id, place_id)
+        if not self._links.get(key):
+            return
+        self._links[key] -= 1
+        if self._links[key]:
+            return
+        del self._links[key]
+        center_id, city_id = self._place_key[place_id]
+        services = self._tree[(city_id, self._service_type[service_id])]
+        centers = services[service_id]
+        centers[center_id].discard(place_id)
+        if not centers[center_id]:
+            del centers[center_id]
+        if not centers:
+            del services[service_id]
+        if not services:
+            del self._tree[(city_id, self._service_type[service_id])]
+
+    def services(self, city_id, type_id):
+        with self._lock:
+            self._ensure_loaded()
+            return sorted(self._tree.get((city_id, int(type_id)), ()))
+
+    def centers(self, city_id, service_id):
+        with self._lock:
+            self._ensure_loaded()
+            services = self._tree.get((city_id, self._service_type.get(int(service_id))), {})
+            return sorted(services.get(int(service_id), ()))
+
+    def places(self, city_id, service_id, center_id):
+        with self._lock:
+            self._ensure_loaded()
+            services = self._tree.get((city_id, self._service_type.get(int(service_id))), {})
+            return sorted(services.get(int(service_id), {}).get(int(center_id), ()))
+
+    def apply(self, added, removed):
+        # added и removed — пары (услуга, салон), закоммиченные одной транзакцией
+        with self._lock:
+            if not self._loaded:
+                return
+            for service_id, place_id in removed:
+                self._remove(service_id, place_id)
+            for service_id, place_id in added:
+                if service_id not in self._service_type or place_id not in self._place_key:
+                    # Первая связь новой услуги или нового салона: их вида, сети и города индекс ещё не знает
+                    self._loaded = False
+                    return
+                self._add(service_id, self._service_type[service_id], place_id, *self._place_key[place_id])
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+
+
+service_index = ServiceIndex()
+# Другие процессы бота не знают, какие именно связи изменились, и просто перечитывают индекс
+cache_bus.subscribe('service_index', lambda key: service_index.invalidate())
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _collect_service_link_changes(session, flush_context):
+    added, removed = session.info.setdefault('service_links', ([], []))
+    relationship_added, relationship_removed = set(), set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, ServicePlace):
+            if obj in session.deleted:
+                removed.append((obj.service_id, obj.place_id))
+            elif obj in session.new:
+                added.append((obj.service_id, obj.place_id))
+            else:
+                session.info['service_index_stale'] = True
+        elif isinstance(obj, (Service, Place)):
+            state = inspect(obj)
+            if obj in session.deleted or (obj in session.dirty and any(
+                    state.attrs[column].history.has_changes() for column in INDEXED_COLUMNS[type(obj)])):
+                session.info['service_index_stale'] = True
+            # Связи, изменённые через Service.places / Place.services; обе стороны связи видят одно и то же изменение
+            history = state.attrs['places' if isinstance(obj, Service) else 'services'].history
+            for other in history.added or ():
+                relationship_added.add((obj.id, other.id) if isinstance(obj, Service) else (other.id, obj.id))
+            for other in history.deleted or ():
+                relationship_removed.add((obj.id, other.id) if isinstance(obj, Service) else (other.id, obj.id))
+    added.extend(relationship_added)
+    removed.extend(relationship_removed)
+
+
+@event.listens_for(OrmSession, 'do_orm_execute')
+def _mark_service_index_bulk_changes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        if getattr(orm_execute_state.statement, 'table', None) in SERVICE_INDEX_TABLES:
+            orm_execute_state.session.info['service_index_stale'] = True
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _update_service_index_on_commit(session):
+    added, removed = session.info.pop('service_links', ([], []))
+    if session.info.pop('service_index_stale', False):
+        service_index.invalidate()
+    elif added or removed:
+        service_index.apply(added, removed)
+    else:
+        return
+    cache_bus.publish('service_index')
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _forget_service_link_changes(session):
+    session.info.pop('service_links', None)
+    session.info.pop('service_index_stale', None)
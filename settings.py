@@ -16,3 +16,103 @@ MAIN_MENU_BUTTON_TEXT = "⬅️ Вернуться на главную"
 
 def MAIN_MENU_SECTION_TEXT():
     return choice(MAIN_MENU_SECTION_TEXT_LIST)
+
+# Расписание салонов
+WORK_DAY_START_HOUR = 9
+WORK_DAY_END_HOUR = 21
+SLOT_STEP_MINUTES = 15
+BOOKING_DAYS_AHEAD = 14
+RECORDS_PAGE_SIZE = 5
+# Сколько секунд слот придержан за пользователем, пока он подтверждает запись
+SLOT_HOLD_SECONDS = 300
+# Число блокировок, между которыми распределяются салоны при записи (вместо одной общей блокировки)
+AVAILABILITY_LOCK_STRIPES = 64
+
+# Напоминания о записях: за сколько минут до начала, на сколько часов вперёд держать записи в памяти,
+# сколько напоминаний отправлять за один раз и через сколько секунд повторять недоставленное
+REMINDER_LEAD_MINUTES = 120
+REMINDER_WINDOW_HOURS = 24
+REMINDER_BATCH_SIZE = 50
+REMINDER_RETRY_SECONDS = 60
+
+# Уведомления владельцам салонов: раз в сколько секунд разбирается outbox, сколько уведомлений за раз,
+# на сколько секунд взятые уведомления закрепляются за процессом, и повторы с растущей паузой
+OUTBOX_INTERVAL_SECONDS = 10
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_LEASE_SECONDS = 120
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_SECONDS = 30
+OUTBOX_RETRY_MAX_SECONDS = 3600
+
+# Архив записей: раз в сколько секунд переносить, через сколько часов после окончания запись уходит в архив,
+# сколько записей в одной транзакции и пауза между транзакциями в секундах
+ARCHIVE_INTERVAL_SECONDS = 60 * 60
+ARCHIVE_AFTER_HOURS = 24
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_PAUSE_SECONDS = 0.05
+
+# Отчёты владельцам салонов (reports.py): за сколько последних дней и по сколько записей читать из БД за раз
+REPORT_DAYS = 30
+REPORT_CHUNK_SIZE = 10000
+
+# Поиск салонов по тексту сообщения: сколько салонов показывать, минимальная длина слова (триграммный
+# индекс не ищет слова короче 3 символов), сколько слов запроса учитывать и среди скольких совпадений
+# выбирать лучшие, если у пользователя не выбран город
+SEARCH_RESULTS_LIMIT = 8
+SEARCH_MIN_WORD_LENGTH = 3
+SEARCH_MAX_WORDS = 8
+SEARCH_RANK_LIMIT = 1000
+
+# Кэш состояний регистрации пользователей
+USER_STATE_CACHE_SIZE = 10000
+
+# Незавершённые регистрации в памяти: сколько чатов держать, через сколько секунд брошенная регистрация
+# забывается и раз в сколько секунд черновики сохраняются в БД
+WIZARD_STORE_SIZE = 10000
+WIZARD_TTL_SECONDS = 24 * 60 * 60
+WIZARD_FLUSH_SECONDS = 60
+
+# Пул соединений и параметры SQLite
+BOT_NUM_THREADS = 8
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 30
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_CACHE_SIZE_KB = 20000
+
+# Асинхронный режим: число потоков, в которых выполняются запросы к БД
+ASYNC_DB_THREADS = 8
+
+# Многопроцессный режим (python workers.py): число процессов-обработчиков (None — по числу ядер), потоков
+# в каждом из них и порт, на который Telegram присылает апдейты через webhook (None — апдейты забираются getUpdates)
+WORKER_PROCESSES = None
+WORKER_THREADS = 4
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = None
+# Публичный HTTPS-адрес webhook, который регистрируется в Telegram при запуске (None — зарегистрирован отдельно),
+# и секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token: апдейты без него
+# отклоняются. None — секрет генерируется при запуске (только вместе с WEBHOOK_URL)
+WEBHOOK_URL = None
+WEBHOOK_SECRET_TOKEN = None
+
+# Пакетная загрузка справочников
+BULK_CHUNK_SIZE = 1000
+
+# Очередь исходящих сообщений (ограничения Telegram: ~30 сообщений/с всего и ~1 сообщение/с в один чат)
+SEND_GLOBAL_RATE = 30
+SEND_GLOBAL_BURST = 30
+SEND_CHAT_RATE = 1
+SEND_CHAT_BURST = 3
+SEND_WORKERS = 8
+SEND_QUEUE_MAX = 10000
+SEND_MAX_RETRIES = 5
+
+# Метрики апдейтов: порт HTTP-эндпоинта /metrics (формат Prometheus) и/или файл, куда они записываются
+# раз в METRICS_DUMP_INTERVAL секунд. None — выключено
+METRICS_PORT = None
+METRICS_FILE = None
+METRICS_DUMP_INTERVAL = 60
+# Журнал медленных апдейтов со списком SQL-запросов: порог в мс (None — выключен), файл и сколько худших хранить
+SLOW_UPDATE_MS = None
+SLOW_UPDATE_LOG = 'slow_updates.jsonl'
+SLOW_UPDATE_KEEP = 20
@@ -0,0 +1,71 @@
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+from settings import USER_STATE_CACHE_SIZE
+
+# Этапы регистрации пользователя
+USER_STATUS_NEW = 0  # пользователя нет в БД (или его данные не подходят ни под один этап)
+USER_STATUS_PREPREUSER = 1  # пользователь создан, но ещё не отправил имя
+USER_STATUS_PREUSER = 2  # имя есть, номера ещё нет
+USER_STATUS_USER = 3  # регистрация завершена
+
+UserState = namedtuple('UserState', ['status', 'name', 'city_id'])
+
+
+def user_state_from_user(user):
+    if user is None:
+        return UserState(USER_STATUS_NEW, None, None)
+    if user.name is None and user.number is None:
+        status = USER_STATUS_PREPREUSER
+    elif user.name is not None and user.number is None:
+        status = USER_STATUS_PREUSER
+    elif user.name is not None and user.number is not None:
+        status = USER_STATUS_USER
+    else:
+        status = USER_STATUS_NEW
+    return UserState(status, user.name, user.city_id)
+
+
+# Ограниченный LRU-кэш состояний пользователей по chat id
+class UserStateCache:
+    def __init__(self, maxsize=USER_STATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            state = self._items.get(key)
+            if state is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return state
+
+    def put(self, key, state):
+        with self._lock:
+            self._items[key] = state
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._items), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+user_state_cache = UserStateCache()
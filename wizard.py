@@ -0,0 +1,133 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+
+from database_root import session_per_update, SAVE_REGISTRATION_DRAFTS
+from settings import WIZARD_STORE_SIZE, WIZARD_TTL_SECONDS, WIZARD_FLUSH_SECONDS
+
+
+# Шаг мастера одного чата. Шаги регистрации — те же USER_STATUS_*, что и у пользователя в БД
+class WizardState:
+    __slots__ = ('status', 'name', 'expires_at', 'dirty')
+
+    def __init__(self, status, name, expires_at):
+        self.status = status
+        self.name = name
+        self.expires_at = expires_at
+        self.dirty = True
+
+
+# Незавершённые мастера (сейчас — регистрация) по chat id в памяти процесса. Промежуточные шаги ничего
+# не пишут в БД: пользователь сохраняется один раз, когда мастер завершён, а раз в WIZARD_FLUSH_SECONDS
+# изменённые черновики сбрасываются в users, чтобы после перезапуска регистрация продолжилась с того же шага.
+# Брошенный мастер забывается через WIZARD_TTL_SECONDS, а сверх WIZARD_STORE_SIZE вытесняется самый давний
+class WizardStore:
+    def __init__(self, maxsize=WIZARD_STORE_SIZE, ttl=WIZARD_TTL_SECONDS, save=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.save = save
+        self.clock = clock
+        self.expired = 0
+        self.evicted = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            state = self._items.get(key)
+            if state is None:
+                return None
+            if state.expires_at <= self.clock():
+                del self._items[key]
+                self.expired += 1
+                return None
+            self._items.move_to_end(key)
+            return state
+
+    def put(self, key, status, name=None):
+        with self._lock:
+            self._items[key] = WizardState(status, name, self.clock() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evicted += 1
+
+    def pop(self, key):
+        with self._lock:
+            return self._items.pop(key, None)
+
+    # Изменённые с прошлого сброса черновики; заодно выбрасываются истёкшие
+    def take_dirty(self):
+        now = self.clock()
+        with self._lock:
+            for key in [key for key, state in self._items.items() if state.expires_at <= now]:
+                del self._items[key]
+                self.expired += 1
+            dirty = [(key, state) for key, state in self._items.items() if state.dirty]
+            for _, state in dirty:
+                state.dirty = False
+        return dirty
+
+    def flush(self):
+        dirty = self.take_dirty()
+        if not dirty:
+            return 0
+        try:
+            self.save([(key, state.name) for key, state in dirty])
+        except Exception:
+            for _, state in dirty:
+                state.dirty = True
+            raise
+        return len(dirty)
+
+    def start(self, interval=WIZARD_FLUSH_SECONDS):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, args=(interval,), name='wizard-flush', daemon=True)
+        self._thread.start()
+
+    def _loop(self, interval):
+        while True:
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(interval)
+                if self._stopped:
+                    return
+            self._flush_logged()
+
+    def _flush_logged(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Не удалось сохранить черновики регистрации: {e}")
+
+    # Остановка с последним сбросом черновиков: он делается уже после того, как поток сброса завершился,
+    # поэтому сохраняются и черновики, изменённые во время его последнего сброса
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self._flush_logged()
+
+    def stats(self):
+        return {"size": len(self._items), "maxsize": self.maxsize, "expired": self.expired, "evicted": self.evicted}
+
+
+wizard_store = WizardStore(save=session_per_update(SAVE_REGISTRATION_DRAFTS))
+
+
+# Поток сброса — фоновый и при выходе просто обрывается, поэтому последний сброс делается в atexit:
+# при обычной остановке main.py, async_main.py и процессов workers.py черновики не теряются
+def start_wizard_flush():
+    wizard_store.start()
+    atexit.register(wizard_store.stop)
@@ -0,0 +1,218 @@
+import json
+import multiprocessing
+import os
+import queue
+import hmac
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import apihelper
+
+from settings import WORKER_PROCESSES, WORKER_THREADS, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_URL, \
+    WEBHOOK_SECRET_TOKEN, SEND_GLOBAL_RATE, SEND_GLOBAL_BURST, METRICS_PORT, METRICS_FILE, METRICS_DUMP_INTERVAL
+
+# Многопроцессный режим. Один процесс (Supervisor) только получает апдейты — через getUpdates или webhook —
+# и раскладывает их по процессам-обработчикам по chat id, а внутри процесса — по его потокам. Все апдейты одного
+# чата попадают в один поток и обрабатываются строго по очереди, поэтому шаги регистрации и записи не обгоняют
+# друг друга, а разные чаты обрабатываются на всех ядрах. У каждого процесса свои соединения с БД, кэши
+# и очередь отправки; общий лимит Telegram делится между процессами поровну. Сброс кэшей после коммита
+# рассылается остальным процессам через cache_bus. Кэш состояний пользователей не рассылается: всё, что меняет
+# состояние пользователя, приходит из его же чата, то есть в тот же процесс.
+# Запуск: python workers.py (токен берётся из config.py, как в main.py)
+UPDATE_KINDS = ('message', 'edited_message', 'callback_query', 'my_chat_member', 'chat_member')
+
+
+def update_chat_id(update):
+    for kind in UPDATE_KINDS:
+        item = update.get(kind)
+        if item is None:
+            continue
+        message = item.get('message') if kind == 'callback_query' else item
+        if message and 'chat' in message:
+            return int(message['chat']['id'])
+        if 'from' in item:
+            return int(item['from']['id'])
+    return 0
+
+
+def run_worker(num, inboxes, token, threads, processed, database_url=None, api_url=None, send_queue_options=None):
+    # Импорты здесь: процесс запускается через spawn и создаёт движок БД и кэши сам
+    import cache_bus
+    from archive import start_archive
+    from database_root import configure_db
+    from handlers import create_bot
+    from metrics import start_metrics_server, start_metrics_dump
+    from outbox import start_outbox
+    from reminders import start_reminders
+    from wizard import start_wizard_flush
+    from telebot.types import Update
+
+    if api_url is not None:
+        apihelper.API_URL = api_url
+    if database_url is not None:
+        configure_db(database_url)
+    bot, send_queue = create_bot(token, threaded=False, **(send_queue_options or {}))
+    others = [inbox for other, inbox in enumerate(inboxes) if other != num]
+    cache_bus.set_transport(lambda kind, key: [inbox.put(("invalidate", kind, key)) for inbox in others])
+    # Напоминания и уведомления салонам забираются из БД атомарно, так что их может рассылать каждый процесс
+    start_reminders(send_queue)
+    start_outbox(send_queue)
+    # Черновики регистрации у каждого процесса свои: все апдейты чата приходят в один процесс
+    start_wizard_flush()
+    # Архив переносит один процесс: так пачки разных процессов не спорят за одни и те же записи
+    if num == 0:
+        start_archive()
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT + 1 + num)
+    if METRICS_FILE is not None:
+        start_metrics_dump(f"{METRICS_FILE}.{num}", METRICS_DUMP_INTERVAL)
+
+    def shard_loop(shard):
+        while True:
+            update = shard.get()
+            if update is None:
+                return
+            try:
+                bot.process_new_updates([Update.de_json(update)])
+            except Exception as e:
+                print(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+            with processed.get_lock():
+                processed.value += 1
+
+    shards = [queue.Queue() for _ in range(threads)]
+    shard_threads = [threading.Thread(target=shard_loop, args=(shard,), name=f'shard-{i}', daemon=True)
+                     for i, shard in enumerate(shards)]
+    for thread in shard_threads:
+        thread.start()
+
+    inbox = inboxes[num]
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        if item[0] == "update":
+            _, chat_id, update = item
+            shards[chat_id // len(inboxes) % threads].put(update)
+        else:
+            _, kind, key = item
+            cache_bus.apply(kind, key)
+
+    for shard in shards:
+        shard.put(None)
+    for thread in shard_threads:
+        thread.join()
+    send_queue.close()
+
+
+class Supervisor:
+    def __init__(self, token, processes=None, threads=WORKER_THREADS, database_url=None, api_url=None,
+                 send_queue_options=None):
+        self.token = token
+        self.processes = processes or WORKER_PROCESSES or os.cpu_count() or 1
+        self.threads = threads
+        self.database_url = database_url
+        self.api_url = api_url
+        self.send_queue_options = send_queue_options or {
+            "global_rate": SEND_GLOBAL_RATE / self.processes,
+            "global_burst": max(1, SEND_GLOBAL_BURST // self.processes)}
+        self._context = multiprocessing.get_context('spawn')
+        self._inboxes = [self._context.Queue() for _ in range(self.processes)]
+        self._processed = self._context.Value('q', 0)
+        self._workers = list()
+        self._stopped = threading.Event()
+        self.received = 0
+
+    @property
+    def processed(self):
+        return self._processed.value
+
+    def start(self):
+        for num in range(self.processes):
+            worker = self._context.Process(
+                target=run_worker, name=f'bot-worker-{num}', daemon=True,
+                args=(num, self._inboxes, self.token, self.threads, self._processed, self.database_url, self.api_url,
+                      self.send_queue_options))
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def dispatch(self, update):
+        chat_id = update_chat_id(update)
+        self._inboxes[chat_id % self.processes].put(("update", chat_id, update))
+        self.received += 1
+
+    def poll(self, timeout=20):
+        offset = None
+        while not self._stopped.is_set():
+            try:
+                updates = apihelper.get_updates(self.token, offset=offset, timeout=timeout,
+                                                long_polling_timeout=timeout)
+            except Exception as e:
+                print(f"Ошибка получения апдейтов: {e}")
+                time.sleep(1)
+                continue
+            for update in updates:
+                self.dispatch(update)
+                offset = update['update_id'] + 1
+
+    # Webhook за HTTPS-прокси. Принимаются только запросы с секретом, который Telegram получил в setWebhook,
+    # иначе любой, кто достучится до порта, мог бы прислать апдейт от имени любого чата. Если задан url,
+    # webhook регистрируется здесь же (с secret_token, сгенерированным, если он не задан)
+    def serve_webhook(self, port=WEBHOOK_PORT, host=WEBHOOK_HOST, url=WEBHOOK_URL,
+                      secret_token=WEBHOOK_SECRET_TOKEN):
+        if secret_token is None:
+            if url is None:
+                raise ValueError("Для webhook нужен WEBHOOK_SECRET_TOKEN (тот же, что передан в setWebhook)")
+            secret_token = secrets.token_urlsafe(32)
+        if url is not None:
+            apihelper.set_webhook(self.token, url=url, secret_token=secret_token)
+        supervisor = self
+        expected = secret_token.encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received = (self.headers.get('X-Telegram-Bot-Api-Secret-Token') or '').encode()
+                if not hmac.compare_digest(received, expected):
+                    self.send_error(403)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    supervisor.dispatch(json.loads(self.rfile.read(length)))
+                except ValueError:
+                    self.send_error(400)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+        return server
+
+    def stop(self, timeout=30):
+        self._stopped.set()
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+
+
+if __name__ == "__main__":
+    try:
+        from config import API_KEY
+    except Exception as e:
+        print("Ошибка получения ключа бота из файла config.py: {}".format(e))
+        exit()
+
+    supervisor = Supervisor(API_KEY).start()
+    if WEBHOOK_PORT is not None:
+        supervisor.serve_webhook(WEBHOOK_PORT, WEBHOOK_HOST, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN)
+        threading.Event().wait()
+    else:
+        supervisor.poll()